@@ -1,20 +1,47 @@
 import re
 import os
 import time
+import signal
 import logging
 import hashlib
+import shutil
+import tempfile
 
 from waitress import serve
 from werkzeug.utils import secure_filename
 from flask import Flask, request, render_template, jsonify
 
-from picblocks.blockhasher import BlockHasher
-from picblocks.blockhashmatcher import BlockHashMatcher
+# SMDA, imported along with BlockHasher and BlockHashMatcher, is only imported by the DbLoader in the background
+from picblocks.dbloader import DbLoader, DEFAULT_POLL_INTERVAL
+from picblocks.jobqueue import JobQueue, QueueFullError, JobFailedError, matchBuffer, matchReport, matchBatch, matchReportFile, matchSmdaFile, STATUS_DONE, STATUS_FAILED
+from picblocks.resultcache import ResultCache
+from picblocks.preforkserver import PreforkServer
 
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)-15s: %(name)-30s - %(message)s")
 LOG = logging.getLogger("flask-app")
 
+# number of processes for disassembling, hashing and matching submissions, and how many submissions may wait for them
+NUM_WORKERS = int(os.environ.get("PICBLOCKS_WORKERS", max(1, os.cpu_count() - 1)))
+MAX_QUEUED_JOBS = int(os.environ.get("PICBLOCKS_MAX_QUEUED_JOBS", 16))
+# in-memory limits for cached blockhash and match reports, plus an optional directory to keep them across restarts
+REPORT_CACHE_MB = int(os.environ.get("PICBLOCKS_REPORT_CACHE_MB", 512))
+MATCH_CACHE_MB = int(os.environ.get("PICBLOCKS_MATCH_CACHE_MB", 64))
+CACHE_PATH = os.environ.get("PICBLOCKS_CACHE_PATH", None)
+# candidate DBs in order of preference, prefer the memory-mapped compact DB, as it loads instantly and its pages are shared between processes
+DB_PATHS = os.environ["PICBLOCKS_DB_PATH"].split(os.pathsep) if "PICBLOCKS_DB_PATH" in os.environ else ["db/picblocksdb.pbdb", "db/picblocksdb.json"]
+# seconds between checks for a newer DB, which is then loaded and swapped in, 0 to disable
+DB_POLL_INTERVAL = int(os.environ.get("PICBLOCKS_DB_POLL_INTERVAL", DEFAULT_POLL_INTERVAL))
+PORT = int(os.environ.get("PICBLOCKS_PORT", 9001))
+# limit for uploaded SMDA reports and block reports, which are spooled to a temporary file for the job workers to parse
+MAX_REPORT_MB = int(os.environ.get("PICBLOCKS_MAX_REPORT_MB", 512))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# with a number of prefork workers, the whole service runs in that many forked processes, each running its jobs itself,
+# which are recycled after a number of requests or once they exceed a limit of private memory in MB
+PREFORK_WORKERS = int(os.environ.get("PICBLOCKS_PREFORK_WORKERS", 0))
+PREFORK_MAX_REQUESTS = int(os.environ.get("PICBLOCKS_PREFORK_MAX_REQUESTS", 0)) or None
+PREFORK_MAX_MEMORY_MB = int(os.environ.get("PICBLOCKS_PREFORK_MAX_MEMORY_MB", 0)) or None
+
 #TODO: Refactoring needed! Importing from external and unique source
 USE_DB = False
 db = None
@@ -34,12 +61,174 @@ if USE_DB:
 
 
 app = Flask(__name__)
-matcher = BlockHashMatcher()
-start = time.time()
-LOG.info("Loading BlocksDB")
-if os.path.exists("db/picblocksdb.json"):
-    matcher.loadDb("db/picblocksdb.json")
-LOG.info("Done! (%5.2fs)", (time.time() - start))
+# created once the first DB is loaded
+jobs = None
+# in prefork mode, the DB that workers are forked with and the directory through which they share the state of their jobs
+prefork_server = None
+prefork_matcher = None
+job_store_path = None
+report_cache = ResultCache(max_bytes=REPORT_CACHE_MB * 1024 * 1024, store_path=os.path.join(CACHE_PATH, "reports") if CACHE_PATH else None)
+match_cache = ResultCache(max_bytes=MATCH_CACHE_MB * 1024 * 1024, store_path=os.path.join(CACHE_PATH, "matches") if CACHE_PATH else None)
+
+
+def activate_db(matcher):
+    """ called by the DbLoader with every newly loaded DB, jobs submitted until then keep running against the previous one """
+    global jobs, prefork_matcher
+    if PREFORK_WORKERS:
+        # the workers are forked again to share the new DB, see start_prefork_worker()
+        prefork_matcher = matcher
+        if prefork_server is not None:
+            prefork_server.recycleWorkers()
+        return
+    # fork the workers only after loading the DB, so that they share it
+    if jobs is None:
+        jobs = JobQueue(matcher, num_processes=NUM_WORKERS, max_queued=MAX_QUEUED_JOBS)
+    else:
+        jobs.replaceMatcher(matcher)
+
+
+def start_prefork_worker():
+    """ called in every prefork worker, which runs its jobs in a thread, as there are already as many workers as cores """
+    global jobs
+    if prefork_matcher is not None:
+        jobs = JobQueue(prefork_matcher, num_processes=1, max_queued=MAX_QUEUED_JOBS, use_processes=False, store_path=job_store_path)
+
+
+def has_unfinished_jobs():
+    return jobs is not None and jobs.hasUnfinishedJobs()
+
+
+db_loader = DbLoader(DB_PATHS, on_load=activate_db, poll_interval=DB_POLL_INTERVAL).start()
+
+
+def get_not_ready_response():
+    """ return a response for requests that need the DB while it is still loading """
+    response = jsonify(db_loader.getStatus())
+    response.status_code = 503
+    response.headers["Retry-After"] = "5"
+    return response
+
+
+def cache_results(report_key, match_key, job_result):
+    if "blockhash_report" in job_result:
+        report_cache.put(report_key, job_result["blockhash_report"])
+    match_cache.put(match_key, job_result["match_report"])
+
+
+def prepare_submission(binary, sha256, filename, bitness=None, baseaddress=None):
+    """ return a submission with a cached match report, a cached blockhash report or only the binary, plus its cache keys """
+    from picblocks.blockhasher import BlockHasher, HASHER_VERSION
+    matcher = jobs.matcher
+    # the key captures everything besides the binary that the blockhash report depends on
+    report_key = (sha256, *BlockHasher().getBufferParameters(filename, bitness=bitness, baseaddress=baseaddress), HASHER_VERSION, matcher.hash_algorithm, matcher.hash_size)
+    match_key = report_key + (matcher.db_timestamp, )
+    match_report = match_cache.get(match_key)
+    if match_report is not None:
+        match_report["input_filename"] = filename
+        return {"match_report": match_report}, report_key, match_key
+    blockhash_report = report_cache.get(report_key)
+    if blockhash_report is not None:
+        blockhash_report["filename"] = filename
+        return {"blockhash_report": blockhash_report}, report_key, match_key
+    return {"binary": binary, "filename": filename, "bitness": bitness, "baseaddress": baseaddress}, report_key, match_key
+
+
+def submit_binary(binary, sha256, filename, bitness=None, baseaddress=None):
+    """ return the ID of a job matching the binary, reusing cached blockhash and match reports to skip disassembly and matching """
+    submission, report_key, match_key = prepare_submission(binary, sha256, filename, bitness, baseaddress)
+    if "match_report" in submission:
+        return jobs.addResult(submission)
+    if "blockhash_report" in submission:
+        return jobs.submit(matchReport, submission["blockhash_report"], callback=lambda job_result: cache_results(report_key, match_key, job_result))
+    return jobs.submit(matchBuffer, binary, filename, bitness, baseaddress, callback=lambda job_result: cache_results(report_key, match_key, job_result))
+
+
+def cache_batch_results(cache_keys, job_result):
+    for (report_key, match_key), blockhash_report, match_report in zip(cache_keys, job_result["blockhash_reports"], job_result["match_reports"]):
+        if blockhash_report is not None:
+            report_cache.put(report_key, blockhash_report)
+        if match_key is not None:
+            match_cache.put(match_key, match_report)
+
+
+def submit_binaries(binaries):
+    """ return the ID of a single job matching all (binary, sha256, filename) together, see submit_binary() """
+    submissions = []
+    cache_keys = []
+    for binary, sha256, filename in binaries:
+        submission, report_key, match_key = prepare_submission(binary, sha256, filename)
+        submissions.append(submission)
+        # match reports that were cached don't need to be cached again
+        cache_keys.append((report_key, None if "match_report" in submission else match_key))
+    if all("match_report" in submission for submission in submissions):
+        return jobs.addResult({"match_reports": [submission["match_report"] for submission in submissions]})
+    return jobs.submit(matchBatch, submissions, callback=lambda job_result: cache_batch_results(cache_keys, job_result))
+
+
+class UploadTooLargeError(Exception):
+    pass
+
+
+def receive_upload():
+    """ stream the request body into a temporary file within MAX_REPORT_MB, return its path and sha256 """
+    max_bytes = MAX_REPORT_MB * 1024 * 1024
+    if request.content_length is not None and request.content_length > max_bytes:
+        raise UploadTooLargeError(f"uploads are limited to {MAX_REPORT_MB} MB")
+    fd, filepath = tempfile.mkstemp(prefix="picblocks-upload-")
+    try:
+        sha256 = hashlib.sha256()
+        num_bytes = 0
+        with os.fdopen(fd, "wb") as fout:
+            while True:
+                chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                num_bytes += len(chunk)
+                if num_bytes > max_bytes:
+                    raise UploadTooLargeError(f"uploads are limited to {MAX_REPORT_MB} MB")
+                sha256.update(chunk)
+                fout.write(chunk)
+    except BaseException:
+        os.remove(filepath)
+        raise
+    return filepath, sha256.hexdigest()
+
+
+def submit_upload(function, filepath, report_key, match_key):
+    """ return the ID of a job applying function to an uploaded file, which takes over its removal unless cached reports are reused """
+    match_report = match_cache.get(match_key)
+    if match_report is not None:
+        os.remove(filepath)
+        return jobs.addResult({"match_report": match_report})
+    blockhash_report = report_cache.get(report_key) if report_key is not None else None
+    if blockhash_report is not None:
+        os.remove(filepath)
+        return jobs.submit(matchReport, blockhash_report, callback=lambda job_result: cache_results(report_key, match_key, job_result))
+    try:
+        return jobs.submit(function, filepath, callback=lambda job_result: cache_results(report_key, match_key, job_result))
+    except QueueFullError:
+        os.remove(filepath)
+        raise
+
+
+def submit_smda_report(filepath, sha256):
+    """ return the ID of a job hashing and matching an uploaded SmdaReport, skipping its disassembly """
+    from picblocks.blockhasher import HASHER_VERSION
+    matcher = jobs.matcher
+    report_key = ("smda_report", sha256, HASHER_VERSION, matcher.hash_algorithm, matcher.hash_size)
+    return submit_upload(matchSmdaFile, filepath, report_key, report_key + (matcher.db_timestamp, ))
+
+
+def submit_block_report(filepath, sha256):
+    """ return the ID of a job matching an uploaded block report, skipping disassembly and hashing """
+    return submit_upload(matchReportFile, filepath, None, ("blockhash_report", sha256, jobs.matcher.db_timestamp))
+
+
+def get_job_response(job_id):
+    job_dict = jobs.getJob(job_id).toDict()
+    job_dict["status_url"] = f"/api/jobs/{job_id}"
+    job_dict["result_url"] = f"/api/jobs/{job_id}/result"
+    return jsonify(job_dict), 202
 
 
 def render_report(report, template):
@@ -98,11 +287,14 @@ def render_report(report, template):
 @app.route("/")
 def index():
     LOG.info("request to /index")
-    return render_template('index.html', db_timestamp=matcher.db_timestamp)
+    return render_template('index.html', db_timestamp=jobs.matcher.db_timestamp if jobs is not None else "loading")
 
 @app.route("/about")
 def about():
     LOG.info("request to /about")
+    if jobs is None:
+        return get_not_ready_response()
+    matcher = jobs.matcher
     stats = matcher.getDbStats()
     return render_template(
         'about.html', 
@@ -137,32 +329,168 @@ def get_stats():
 @app.route('/blocks', methods=['GET', 'POST'])
 def upload_file():
     LOG.info("request to /blocks")
+    if jobs is None:
+        return get_not_ready_response()
     if request.method == 'POST':
         f = request.files['binary']
         binary = f.read()
-        LOG.info(f"received binary with sha256: {hashlib.sha256(binary).hexdigest()}")
+        sha256 = hashlib.sha256(binary).hexdigest()
+        LOG.info(f"received binary with sha256: {sha256}")
         form_bitness = int(request.form["bitness"]) if ("bitness" in request.form and request.form["bitness"] in ["32", "64"]) else None
         form_baseaddress = int(request.form["baseaddress"], 16) if ("baseaddress" in request.form and re.match("^0x[0-9a-fA-F]{1,16}$", request.form["baseaddress"])) else None
-        hasher = BlockHasher()
-        blockhash_report = hasher.processBuffer(binary, secure_filename(f.filename), bitness=form_bitness, baseaddress=form_baseaddress)
-        report = matcher.match(blockhash_report)
+        try:
+            job_id = submit_binary(binary, sha256, secure_filename(f.filename), form_bitness, form_baseaddress)
+        except QueueFullError as exc:
+            return str(exc), 503
+        # the form waits for its result, but the work itself happens in a worker process
+        try:
+            report = jobs.waitForResult(job_id)["match_report"]
+        except JobFailedError:
+            LOG.error(f"job {job_id} failed.")
+            return "Processing the binary failed.", 500
         LOG.info("matching completed.")
         return render_report(report, "report.html")
 
 
 @app.route('/api/blocks', methods=['POST'])
 def upload_api_file():
+    """ enqueue a binary for matching and immediately return the ID of its job, to be polled via /api/jobs/<job_id> """
     LOG.info("request to /api/blocks")
+    if jobs is None:
+        return get_not_ready_response()
     if request.method == 'POST':
         binary = request.stream.read()
-        LOG.info(f"received binary with sha256: {hashlib.sha256(binary).hexdigest()}")
-        hasher = BlockHasher()
-        blockhash_report = hasher.processBuffer(binary, f"sha256:{hashlib.sha256(binary).hexdigest()}")
-        report = matcher.match(blockhash_report)
-        LOG.info("matching completed.")
-        return jsonify(report)
+        sha256 = hashlib.sha256(binary).hexdigest()
+        LOG.info(f"received binary with sha256: {sha256}")
+        try:
+            job_id = submit_binary(binary, sha256, f"sha256:{sha256}")
+        except QueueFullError as exc:
+            return jsonify({"error": str(exc)}), 503
+        return get_job_response(job_id)
+
+
+@app.route('/api/blocks/batch', methods=['POST'])
+def upload_api_files():
+    """ enqueue several binaries, submitted as multipart files named "binaries", to be matched together in a single job """
+    LOG.info("request to /api/blocks/batch")
+    if jobs is None:
+        return get_not_ready_response()
+    binaries = []
+    for f in request.files.getlist("binaries"):
+        binary = f.read()
+        sha256 = hashlib.sha256(binary).hexdigest()
+        binaries.append((binary, sha256, secure_filename(f.filename) or f"sha256:{sha256}"))
+    if not binaries:
+        return jsonify({"error": "no files submitted as binaries"}), 400
+    LOG.info(f"received {len(binaries)} binaries.")
+    try:
+        job_id = submit_binaries(binaries)
+    except QueueFullError as exc:
+        return jsonify({"error": str(exc)}), 503
+    return get_job_response(job_id)
+
+
+def upload_api_report(submit_report):
+    if jobs is None:
+        return get_not_ready_response()
+    try:
+        filepath, sha256 = receive_upload()
+    except UploadTooLargeError as exc:
+        return jsonify({"error": str(exc)}), 413
+    LOG.info(f"received report with sha256: {sha256}")
+    try:
+        job_id = submit_report(filepath, sha256)
+    except QueueFullError as exc:
+        return jsonify({"error": str(exc)}), 503
+    return get_job_response(job_id)
+
+
+@app.route('/api/blocks/smda', methods=['POST'])
+def upload_api_smda_report():
+    """ enqueue a SmdaReport, serialized as JSON, to be hashed and matched without disassembling the binary again """
+    LOG.info("request to /api/blocks/smda")
+    return upload_api_report(submit_smda_report)
+
+
+@app.route('/api/blocks/report', methods=['POST'])
+def upload_api_block_report():
+    """ enqueue a precomputed block report, in JSON or binary format, to be matched right away """
+    LOG.info("request to /api/blocks/report")
+    return upload_api_report(submit_block_report)
+
+
+@app.route('/healthz', methods=['GET'])
+def get_health():
+    """ the service is up, regardless of whether its DB is loaded already """
+    return jsonify({"status": "ok", "uptime": time.time() - db_loader.started})
+
+
+@app.route('/readyz', methods=['GET'])
+def get_readiness():
+    """ report the progress of loading the DB, with status 200 once a DB is loaded and serving, 503 before """
+    return jsonify(db_loader.getStatus()), 200 if jobs is not None else 503
+
+
+@app.route('/api/jobs', methods=['GET'])
+def get_jobs_stats():
+    if jobs is None:
+        return get_not_ready_response()
+    return jsonify(jobs.getStats())
+
+
+@app.route('/api/cache', methods=['GET'])
+def get_cache_stats():
+    return jsonify({"blockhash_reports": report_cache.getStats(), "match_reports": match_cache.getStats()})
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    if jobs is None:
+        return get_not_ready_response()
+    job = jobs.getJob(job_id)
+    if job is None:
+        return jsonify({"error": "unknown job"}), 404
+    return jsonify(job.toDict())
+
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    if jobs is None:
+        return get_not_ready_response()
+    job = jobs.getJob(job_id)
+    if job is None:
+        return jsonify({"error": "unknown job"}), 404
+    job_dict = job.toDict()
+    if job_dict["status"] == STATUS_DONE:
+        job_result = job.getResult()
+        # batch jobs result in a list of match reports, in order of their files
+        return jsonify(job_result["match_reports"] if "match_reports" in job_result else job_result["match_report"])
+    if job_dict["status"] == STATUS_FAILED:
+        return jsonify(job_dict), 500
+    return jsonify(job_dict), 202
+
+
+def handle_sigterm(signum, frame):
+    # lets waitress shut down like upon Ctrl+C
+    raise SystemExit(0)
+
+
+def serve_prefork():
+    global prefork_server, job_store_path
+    job_store_path = tempfile.mkdtemp(prefix="picblocks-jobs-")
+    prefork_server = PreforkServer(app, host="127.0.0.1", port=PORT, num_workers=PREFORK_WORKERS, max_requests=PREFORK_MAX_REQUESTS, max_memory_mb=PREFORK_MAX_MEMORY_MB, after_fork=start_prefork_worker, is_busy=has_unfinished_jobs)
+    try:
+        prefork_server.run()
+    finally:
+        shutil.rmtree(job_store_path, ignore_errors=True)
 
 
-if __name__ == '__main__':
+if __name__ == '__main__' and PREFORK_WORKERS:
+    serve_prefork()
+elif __name__ == '__main__':
+    signal.signal(signal.SIGTERM, handle_sigterm)
     # start up server as WSGI applet through waitress
-    serve(app, host="127.0.0.1", port=9001)
+    serve(app, host="127.0.0.1", port=PORT)
+    # job workers forked after the server started hold its socket, and would keep the port bound if left running
+    if jobs is not None:
+        jobs.shutdown()
@@ -0,0 +1,69 @@
+# Benchmark for the blockhash function of BlockHasher.calculateInstructionsHash
+# Escapes all blocks of the given binaries once, then measures how many blockhashes per second each way of turning the escaped
+# instructions into a hash achieves: the original per-character ord() conversion with sha256 and the current encoding with each
+# of the selectable algorithms, and verifies that sha256 hashes are unchanged. Finally, full hashing of the binaries is timed per algorithm.
+# Usage: python -m benchmarks.benchmark_blockhash <binary_path> [<binary_path> ...]
+
+import sys
+import time
+import struct
+import hashlib
+import logging
+
+from smda.Disassembler import Disassembler
+from smda.intel.IntelInstructionEscaper import IntelInstructionEscaper
+
+from picblocks.blockhasher import BlockHasher, HASH_ALGORITHMS
+
+
+def originalHash(escaped_binary_seq):
+    as_bytes = bytes([ord(c) for c in "".join(escaped_binary_seq)])
+    return struct.unpack("I", hashlib.sha256(as_bytes).digest()[:4])[0]
+
+
+def encodedHash(escaped_binary_seq, hash_algorithm):
+    as_bytes = "".join(escaped_binary_seq).encode("latin-1")
+    if hash_algorithm == "blake2b":
+        return int.from_bytes(hashlib.blake2b(as_bytes, digest_size=4).digest(), "little")
+    return int.from_bytes(hashlib.sha256(as_bytes).digest()[:4], "little")
+
+
+def measure(name, function, escaped_blocks):
+    start = time.time()
+    hashes = [function(escaped_binary_seq) for escaped_binary_seq in escaped_blocks]
+    duration = time.time() - start
+    print(f"{name:>26}: {len(escaped_blocks) / duration:12,.0f} hashes/s")
+    return hashes
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"usage: {sys.argv[0]} <binary_path> <optional:more_binary_paths>")
+        sys.exit(1)
+    logging.disable(logging.INFO)
+    smda_reports = []
+    escaped_blocks = []
+    for filepath in sys.argv[1:]:
+        print(f"disassembling {filepath}")
+        smda_report = Disassembler().disassembleFile(filepath)
+        smda_reports.append(smda_report)
+        image_lower = smda_report.base_addr
+        image_upper = image_lower + smda_report.binary_size
+        for function in smda_report.getFunctions():
+            for _, block in sorted(function.blocks.items()):
+                escaped_blocks.append([instruction.getEscapedBinary(IntelInstructionEscaper, escape_intraprocedural_jumps=True, lower_addr=image_lower, upper_addr=image_upper) for instruction in block])
+    print(f"hashing {len(escaped_blocks)} escaped blocks")
+    reference = measure("ord() + sha256", originalHash, escaped_blocks)
+    for hash_algorithm in HASH_ALGORITHMS:
+        hashes = measure(f"encode() + {hash_algorithm}", lambda escaped_binary_seq: encodedHash(escaped_binary_seq, hash_algorithm), escaped_blocks)
+        if hash_algorithm == "sha256" and hashes != reference:
+            print("sha256 hashes DIFFER from the original ones")
+            sys.exit(1)
+    num_blocks = sum(smda_report.num_blocks for smda_report in smda_reports)
+    for hash_algorithm in HASH_ALGORITHMS:
+        hasher = BlockHasher(hash_algorithm=hash_algorithm)
+        start = time.time()
+        for smda_report in smda_reports:
+            hasher.extractBlockhashes(smda_report)
+        duration = time.time() - start
+        print(f"{'extractBlockhashes ' + hash_algorithm:>26}: {duration:8.3f}s, {num_blocks / duration:10,.0f} blocks/s")
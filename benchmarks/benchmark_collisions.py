@@ -0,0 +1,77 @@
+# Collision benchmark for 32 and 64 bit blockhashes
+# Escapes all blocks of a corpus once and counts (hash, size) keys shared by different escaped blocks for each hash size,
+# i.e. blocks that the DB would wrongly treat as identical, and how many of them come from different binaries.
+# As collisions only become frequent for large corpora, the expected number of colliding pairs by the birthday bound and the
+# memory of the hash column of a DB are extrapolated to larger numbers of distinct blocks.
+# Usage: python -m benchmarks.benchmark_collisions <binary_or_directory_path> [<binary_or_directory_path> ...]
+
+import os
+import sys
+import time
+import hashlib
+import logging
+from collections import defaultdict
+
+from smda.Disassembler import Disassembler
+from smda.intel.IntelInstructionEscaper import IntelInstructionEscaper
+
+from picblocks.blockhasher import HASH_SIZES, DEFAULT_HASH_ALGORITHM
+
+MIN_BLOCK_SIZE = 4
+EXTRAPOLATED_NUM_BLOCKS = [10 ** 6, 10 ** 7, 10 ** 8, 10 ** 9]
+
+
+def iterateFilepaths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, subdirs, files in os.walk(path):
+                subdirs.sort()
+                for filename in sorted(files):
+                    yield os.path.join(root, filename)
+        else:
+            yield path
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"usage: {sys.argv[0]} <binary_or_directory_path> <optional:more_paths>")
+        sys.exit(1)
+    logging.disable(logging.INFO)
+    # distinct escaped blocks with their size and the binaries they occur in
+    blocks = {}
+    for filepath in iterateFilepaths(sys.argv[1:]):
+        try:
+            smda_report = Disassembler().disassembleFile(filepath)
+        except Exception:
+            smda_report = None
+        if smda_report is None or smda_report.status != "ok":
+            print(f"skipping {filepath}")
+            continue
+        image_lower = smda_report.base_addr
+        image_upper = image_lower + smda_report.binary_size
+        for function in smda_report.getFunctions():
+            for _, block in sorted(function.blocks.items()):
+                if len(block) >= MIN_BLOCK_SIZE:
+                    escaped = "".join(instruction.getEscapedBinary(IntelInstructionEscaper, escape_intraprocedural_jumps=True, lower_addr=image_lower, upper_addr=image_upper) for instruction in block).encode("latin-1")
+                    size = sum(len(instruction.bytes) // 2 for instruction in block)
+                    blocks.setdefault((escaped, size), set()).add(filepath)
+    num_blocks = len(blocks)
+    print(f"{num_blocks} distinct blocks")
+    for hash_size in HASH_SIZES:
+        start = time.time()
+        keys = defaultdict(list)
+        for escaped, size in blocks:
+            keys[(int.from_bytes(hashlib.sha256(escaped).digest()[:hash_size], "little"), size)].append((escaped, size))
+        colliding_keys = [colliding for colliding in keys.values() if len(colliding) > 1]
+        num_colliding_blocks = sum(len(colliding) for colliding in colliding_keys)
+        # binaries sharing a key only through a collision, which pollutes the unique bytes of their families
+        num_cross_binary = sum(1 for colliding in colliding_keys if len(set.union(*[blocks[block] for block in colliding])) > 1)
+        duration = time.time() - start
+        print(f"{8 * hash_size} bit {DEFAULT_HASH_ALGORITHM}: {len(colliding_keys)} colliding keys with {num_colliding_blocks} blocks, {num_cross_binary} of them across binaries ({duration:.3f}s)")
+    print("extrapolation by the birthday bound, ignoring that keys also differ in size:")
+    for extrapolated in sorted(set(EXTRAPOLATED_NUM_BLOCKS + [num_blocks])):
+        columns = []
+        for hash_size in HASH_SIZES:
+            expected_pairs = extrapolated * (extrapolated - 1) / 2 / 2 ** (8 * hash_size)
+            columns.append(f"{8 * hash_size} bit: {expected_pairs:14,.3f} colliding pairs, {extrapolated * hash_size / 2 ** 20:10,.1f} MiB hash column")
+        print(f"{extrapolated:>14,d} blocks - " + " | ".join(columns))
@@ -0,0 +1,68 @@
+# Benchmark for BlockHasher.extractBlockhashes
+# Disassembles the given binaries once, then hashes them without escape cache, with a cache per report and with
+# one cache shared across all reports, first cold and then warm, as it is in a batch worker after its first reports.
+# Verifies that the block reports are identical and prints the best timing of several rounds and hit rates.
+# Usage: python -m benchmarks.benchmark_hashing <binary_path> [<binary_path> ...]
+
+import sys
+import json
+import time
+import logging
+
+from smda.Disassembler import Disassembler
+
+from picblocks.blockhasher import BlockHasher
+from picblocks.escapecache import EscapedInstructionCache, DEFAULT_CACHE_SIZE
+
+
+NUM_ROUNDS = 5
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"usage: {sys.argv[0]} <binary_path> <optional:more_binary_paths>")
+        sys.exit(1)
+    logging.disable(logging.INFO)
+    smda_reports = []
+    for filepath in sys.argv[1:]:
+        print(f"disassembling {filepath}")
+        smda_reports.append(Disassembler().disassembleFile(filepath))
+    num_blocks = sum(smda_report.num_blocks for smda_report in smda_reports)
+    # each variant is timed by the best of NUM_ROUNDS rounds, the cold shared cache is created anew for every round
+    variants = {
+        "no cache": lambda: BlockHasher(),
+        "per report": lambda: BlockHasher(escape_cache_size=DEFAULT_CACHE_SIZE),
+        "shared": lambda: BlockHasher(escape_cache=EscapedInstructionCache()),
+        "warm": lambda: BlockHasher(escape_cache=warm_cache),
+    }
+    warm_cache = EscapedInstructionCache()
+    # hash once untimed, which also fills the warm cache
+    for smda_report in smda_reports:
+        BlockHasher(escape_cache=warm_cache).extractBlockhashes(smda_report)
+    results = {}
+    for name, create_hasher in variants.items():
+        durations = []
+        for _ in range(NUM_ROUNDS):
+            hasher = create_hasher()
+            hits = 0
+            misses = 0
+            shared_hits = hasher.escape_cache.hits if hasher.escape_cache is not None else 0
+            shared_misses = hasher.escape_cache.misses if hasher.escape_cache is not None else 0
+            start = time.time()
+            results[name] = []
+            for smda_report in smda_reports:
+                results[name].append(hasher.extractBlockhashes(smda_report))
+                if hasher.escape_cache_stats is not None and hasher.escape_cache is None:
+                    hits += hasher.escape_cache_stats["hits"]
+                    misses += hasher.escape_cache_stats["misses"]
+            durations.append(time.time() - start)
+            if hasher.escape_cache is not None:
+                hits, misses = hasher.escape_cache.hits - shared_hits, hasher.escape_cache.misses - shared_misses
+        duration = min(durations)
+        hit_rate = 100 * hits / (hits + misses) if hits + misses else 0
+        print(f"{name:>10}: {duration:8.3f}s, {num_blocks / duration:10,.0f} blocks/s, {hits:,d} hits, {misses:,d} misses ({hit_rate:5.2f}% hit rate)")
+    reference = json.dumps(results["no cache"], sort_keys=True)
+    for name in variants:
+        is_identical = json.dumps(results[name], sort_keys=True) == reference
+        print(f"{name:>10}: {'identical' if is_identical else 'DIFFERENT'} block reports")
+        if not is_identical:
+            sys.exit(1)
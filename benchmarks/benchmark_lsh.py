@@ -0,0 +1,67 @@
+# Recall benchmark for the MinHash LSH index used by BlockHashMatcher.matchSamples(use_lsh=True)
+# Ranks the samples of a DB for each block report exhaustively and via the candidates of LSH indices with different numbers of bands,
+# and reports the recall of the exact top-k samples, how often the best family of matching is among the candidates and the time spent.
+# The sample a report was loaded as is left out of both, as it would be found trivially.
+# Usage: python -m benchmarks.benchmark_lsh <db_path> <block_reports_path> [<top_k>]
+
+import os
+import sys
+import time
+import logging
+
+from picblocks.blockhashmatcher import BlockHashMatcher
+from picblocks.blockreport import readBlockReport
+from picblocks.minhash import MinHashIndex, DEFAULT_NUM_PERMUTATIONS
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(f"usage: {sys.argv[0]} <db_path> <block_reports_path> <optional:top_k>")
+        sys.exit(1)
+    logging.disable(logging.INFO)
+    top_k = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    matcher = BlockHashMatcher()
+    matcher.loadDb(sys.argv[1])
+    sample_matcher = matcher._getSampleMatcher()
+    filename_to_sample_ids = {}
+    for sample_id, filename in matcher.sample_id_to_sample.items():
+        filename_to_sample_ids.setdefault(filename, set()).add(sample_id)
+    queries = []
+    for filename in sorted(os.listdir(sys.argv[2])):
+        if filename.endswith(".blocks"):
+            blockhash_report = readBlockReport(sys.argv[2] + os.sep + filename)
+            keys, _ = matcher._getReportKeys(blockhash_report)
+            if not keys:
+                continue
+            own_sample_ids = filename_to_sample_ids.get(blockhash_report["filename"], set())
+            match_report = matcher.matchLeavingOut(blockhash_report, own_sample_ids)
+            best_family = match_report["family_matches"][0]["family"] if match_report["family_matches"] else None
+            queries.append((keys, own_sample_ids, best_family))
+    print(f"ranking the top {top_k} samples for {len(queries)} reports")
+    start = time.time()
+    exact_rankings = []
+    for keys, own_sample_ids, _ in queries:
+        ranked = sample_matcher.rank(keys, top_k=top_k + len(own_sample_ids))
+        exact_rankings.append([sample_id for sample_id, _ in ranked if sample_id not in own_sample_ids][:top_k])
+    duration = time.time() - start
+    print(f"{'exact':>12}: {1000 * duration / len(queries):8.3f}ms per report")
+    for num_bands in [8, 16, 32]:
+        start = time.time()
+        minhash_index = MinHashIndex.fromCompactDb(sample_matcher.compact_db, num_permutations=DEFAULT_NUM_PERMUTATIONS, num_bands=num_bands)
+        index_duration = time.time() - start
+        num_relevant = 0
+        num_found = 0
+        num_candidates = 0
+        num_best_family_found = 0
+        start = time.time()
+        for (keys, own_sample_ids, best_family), exact_ranking in zip(queries, exact_rankings):
+            candidate_ids = [sample_id for sample_id, _ in minhash_index.query(minhash_index.computeSignature(keys)) if sample_id not in own_sample_ids]
+            ranked = [sample_id for sample_id, _ in sample_matcher.rank(keys, top_k=top_k, candidate_ids=candidate_ids)]
+            num_relevant += len(exact_ranking)
+            num_found += len(set(exact_ranking).intersection(ranked))
+            num_candidates += len(candidate_ids)
+            if best_family in [matcher.family_id_to_family[sample_matcher.sample_family_ids[sample_id]] for sample_id in candidate_ids]:
+                num_best_family_found += 1
+        duration = time.time() - start
+        recall = num_found / num_relevant if num_relevant else 1
+        print(f"{num_bands:>3} bands x {DEFAULT_NUM_PERMUTATIONS // num_bands} rows: {1000 * duration / len(queries):8.3f}ms per report, recall@{top_k} {recall:.3f}, best family among candidates {num_best_family_found / len(queries):.3f}, {num_candidates / len(queries):.1f} candidates per report (index built in {index_duration:.3f}s)")
@@ -0,0 +1,115 @@
+# Regression benchmark for BlockHashMatcher.match
+# Matches block reports with the original per-fid matching loop as reference and with all current engines,
+# verifies that the resulting match reports are identical and reports the time spent per engine.
+# Usage: python -m benchmarks.benchmark_matching <db_path> <block_reports_path> [<fid_multiplier>]
+# The optional fid multiplier replicates the fids of every input block to emulate blocks occurring in many functions.
+
+import os
+import sys
+import json
+import math
+import time
+import logging
+from collections import defaultdict
+
+from picblocks.blockhashmatcher import BlockHashMatcher
+
+
+def referenceScores(matcher, blockhash_report):
+    """ the original matching loop, which rescans every DB bucket once per fid of the input block """
+    family_bytes = defaultdict(int)
+    non_library_bytes = defaultdict(int)
+    adj_family_bytes = defaultdict(int)
+    unique_family_bytes = defaultdict(int)
+    family_blocks = defaultdict(int)
+    non_library_blocks = defaultdict(int)
+    adj_family_blocks = defaultdict(int)
+    unique_family_blocks = defaultdict(int)
+    unmatched_score = 0
+    unmatched_blocks = 0
+    for blockhash, data in blockhash_report["blockhashes"].items():
+        int_hash = int(blockhash)
+        for size, fids in data.items():
+            int_size = int(size)
+            family_ids = set()
+            for fid in fids:
+                if int_hash in matcher.blockhashes:
+                    if int_size in matcher.blockhashes[int_hash]:
+                        entries = matcher.blockhashes[int_hash][int_size]
+                        families = set([entry[0] for entry in entries])
+                        has_library = any([entry[3] for entry in entries])
+                        family_adjustment_value = 1 if len(families) < 3 else 1 + int(math.log(len(families), 2))
+                        for entry in entries:
+                            family_id = entry[0]
+                            if family_id not in family_ids:
+                                family_ids.add(family_id)
+                                family_bytes[family_id] += int_size
+                                family_blocks[family_id] += 1
+                                if not has_library:
+                                    non_library_bytes[family_id] += int_size
+                                    non_library_blocks[family_id] += 1
+                                    adj_family_bytes[family_id] += int_size / family_adjustment_value
+                                    adj_family_blocks[family_id] += 1 / family_adjustment_value
+                                    if len(families) == 1:
+                                        unique_family_bytes[family_id] += int_size
+                                        unique_family_blocks[family_id] += 1
+                    else:
+                        unmatched_score += int_size
+                else:
+                    unmatched_score += int_size
+                    unmatched_blocks += 1
+    return {
+        "family_bytes": family_bytes,
+        "family_blocks": family_blocks,
+        "non_library_bytes": non_library_bytes,
+        "non_library_blocks": non_library_blocks,
+        "adj_family_bytes": adj_family_bytes,
+        "adj_family_blocks": adj_family_blocks,
+        "unique_family_bytes": unique_family_bytes,
+        "unique_family_blocks": unique_family_blocks,
+        "unmatched_score": unmatched_score,
+        "unmatched_blocks": unmatched_blocks,
+    }
+
+
+def multiplyFids(blockhash_report, fid_multiplier):
+    for blockhash, data in blockhash_report["blockhashes"].items():
+        for size, fids in data.items():
+            data[size] = [fid * fid_multiplier + offset for fid in fids for offset in range(fid_multiplier)]
+    return blockhash_report
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(f"usage: {sys.argv[0]} <db_path> <block_reports_path> <optional:fid_multiplier>")
+        sys.exit(1)
+    logging.disable(logging.INFO)
+    fid_multiplier = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    matcher = BlockHashMatcher()
+    matcher.loadDb(sys.argv[1])
+    matcher.updateAggregates()
+    reports = []
+    for filename in sorted(os.listdir(sys.argv[2])):
+        if filename.endswith(".blocks"):
+            with open(sys.argv[2] + os.sep + filename, "r") as fin:
+                reports.append(multiplyFids(json.load(fin), fid_multiplier))
+    print(f"matching {len(reports)} reports, fids multiplied by {fid_multiplier}")
+    engines = {"reference": lambda report: matcher._buildMatchReport(report, referenceScores(matcher, report))}
+    engines["python"] = lambda report: matcher.match(report, engine="python")
+    try:
+        matcher.match(reports[0], engine="numpy")
+        engines["numpy"] = lambda report: matcher.match(report, engine="numpy")
+    except ImportError:
+        print("numpy not available, skipping numpy engine")
+    results = {}
+    for name, engine in engines.items():
+        start = time.time()
+        results[name] = [engine(report) for report in reports]
+        duration = time.time() - start
+        print(f"{name:>10}: {duration:8.3f}s total, {1000 * duration / len(reports):8.3f}ms per report")
+    reference = json.dumps(results["reference"], sort_keys=True)
+    for name in engines:
+        is_identical = json.dumps(results[name], sort_keys=True) == reference
+        print(f"{name:>10}: {'identical' if is_identical else 'DIFFERENT'} match reports")
+        if not is_identical:
+            sys.exit(1)
@@ -0,0 +1,47 @@
+# Memory benchmark for loading a JSON DB
+# Measures the memory held by the blockhashes of a JSON DB once loaded as nested {hash: {size: [entries]}} dict, as BlockHashMatcher
+# used to keep them, and as the in-memory CompactDb that loadDb() now converts them into, as well as the peak during loading.
+# Memory is traced with tracemalloc, so only allocations of Python objects and arrays are counted.
+# Usage: python -m benchmarks.benchmark_memory <json_db_path>
+
+import sys
+import json
+import time
+import logging
+import tracemalloc
+
+from picblocks.blockhashmatcher import BlockHashMatcher
+
+
+def loadNested(db_path):
+    with open(db_path, "r") as fin:
+        blockhash_db = json.load(fin)
+    return {int(k): {int(ki): vi for ki, vi in v.items()} for k, v in blockhash_db["blockhashes"].items()}
+
+
+def loadCompact(db_path):
+    matcher = BlockHashMatcher()
+    matcher.loadDb(db_path)
+    return matcher
+
+
+def measure(name, load, db_path):
+    tracemalloc.start()
+    start = time.time()
+    loaded = load(db_path)
+    duration = time.time() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:>8}: {current / 2 ** 20:9.2f} MiB held, {peak / 2 ** 20:9.2f} MiB peak, loaded in {duration:.3f}s")
+    del loaded
+    return current
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"usage: {sys.argv[0]} <json_db_path>")
+        sys.exit(1)
+    logging.disable(logging.INFO)
+    nested = measure("nested", loadNested, sys.argv[1])
+    compact = measure("compact", loadCompact, sys.argv[1])
+    print(f"reduction: {nested / compact:.1f}x")
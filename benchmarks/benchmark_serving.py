@@ -0,0 +1,66 @@
+# Throughput benchmark for the web service
+# Starts app.py with the default single serving process and with PICBLOCKS_PREFORK_WORKERS forked serving processes and,
+# for each, submits binaries to /blocks from concurrent clients, which wait for their match reports, to report requests per second.
+# Result caches are disabled unless --cached is given, so that every request is disassembled, hashed and matched.
+# Usage: python -m benchmarks.benchmark_serving <binary_or_directory_path> [<prefork_workers, e.g. 0,1,2,4>] [<num_requests>] [<num_clients>] [--cached]
+# Run from the repository root, the DB is loaded as by app.py (e.g. set PICBLOCKS_DB_PATH), the service listens on PICBLOCKS_PORT (default: 9051).
+
+import os
+import sys
+import time
+import uuid
+import subprocess
+import urllib.request
+from multiprocessing import Pool
+
+from benchmarks.benchmark_startup import waitForStatus
+
+
+def postBinary(task):
+    """ submit a binary as multipart form to /blocks and return the HTTP status once its report is rendered """
+    url, filepath = task
+    boundary = uuid.uuid4().hex
+    with open(filepath, "rb") as fin:
+        binary = fin.read()
+    body = f"--{boundary}\r\nContent-Disposition: form-data; name=\"binary\"; filename=\"{os.path.basename(filepath)}\"\r\nContent-Type: application/octet-stream\r\n\r\n".encode("utf-8")
+    body += binary + f"\r\n--{boundary}--\r\n".encode("utf-8")
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+    try:
+        with urllib.request.urlopen(request, timeout=600) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as exc:
+        return exc.code
+
+
+def measureThroughput(env, port, filepaths, num_requests, num_clients):
+    process = subprocess.Popen([sys.executable, "app.py"], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        waitForStatus(f"http://127.0.0.1:{port}/readyz", 200)
+        tasks = [(f"http://127.0.0.1:{port}/blocks", filepaths[index % len(filepaths)]) for index in range(num_requests)]
+        with Pool(num_clients) as pool:
+            start = time.time()
+            statuses = pool.map(postBinary, tasks, chunksize=1)
+            duration = time.time() - start
+    finally:
+        process.terminate()
+        process.wait()
+    return duration, sum(1 for status in statuses if status != 200)
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    input_path = args[0]
+    filepaths = [os.path.join(input_path, filename) for filename in sorted(os.listdir(input_path))] if os.path.isdir(input_path) else [input_path]
+    prefork_workers = [int(num_workers) for num_workers in args[1].split(",")] if len(args) > 1 else [0, 1, 2, 4]
+    num_requests = int(args[2]) if len(args) > 2 else 64
+    num_clients = int(args[3]) if len(args) > 3 else 16
+    port = int(os.environ.get("PICBLOCKS_PORT", 9051))
+    env = dict(os.environ, PICBLOCKS_PORT=str(port), PICBLOCKS_DB_POLL_INTERVAL="0", PICBLOCKS_MAX_QUEUED_JOBS=str(num_requests))
+    if "--cached" not in sys.argv:
+        env.update({"PICBLOCKS_REPORT_CACHE_MB": "0", "PICBLOCKS_MATCH_CACHE_MB": "0"})
+    for num_workers in prefork_workers:
+        env["PICBLOCKS_PREFORK_WORKERS"] = str(num_workers)
+        duration, num_failed = measureThroughput(env, port, filepaths, num_requests, num_clients)
+        mode = f"{num_workers} prefork workers" if num_workers else "single process"
+        print(f"{mode:>20}: {num_requests} requests in {duration:.2f}s, {num_requests / duration:7.2f} requests/s, {num_failed} failed")
@@ -0,0 +1,54 @@
+# Startup benchmark for the web service
+# Starts app.py as a subprocess and measures the time until its first byte (a response of /healthz) and until it is ready to match
+# (/readyz responding with status 200), i.e. until the DB is loaded in the background and the job workers are forked.
+# Usage: python -m benchmarks.benchmark_startup [<db_path>] [<num_runs>]
+# Without a db_path, app.py loads its default DB. Run from the repository root, the service listens on PICBLOCKS_PORT (default: 9050).
+
+import os
+import sys
+import time
+import urllib.error
+import urllib.request
+import subprocess
+
+
+def waitForStatus(url, expected_status, timeout=600):
+    """ poll url until it responds with expected_status and return the time that took """
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                status = response.status
+        except urllib.error.HTTPError as exc:
+            status = exc.code
+        except (urllib.error.URLError, ConnectionError, OSError):
+            status = None
+        if status == expected_status:
+            return time.time() - start
+        time.sleep(0.01)
+    raise TimeoutError(f"{url} did not respond with status {expected_status} within {timeout}s")
+
+
+def measureStartup(env, port):
+    start = time.time()
+    process = subprocess.Popen([sys.executable, "app.py"], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        waitForStatus(f"http://127.0.0.1:{port}/healthz", 200)
+        first_byte = time.time() - start
+        waitForStatus(f"http://127.0.0.1:{port}/readyz", 200)
+        ready = time.time() - start
+    finally:
+        process.terminate()
+        process.wait()
+    return first_byte, ready
+
+
+if __name__ == "__main__":
+    port = int(os.environ.get("PICBLOCKS_PORT", 9050))
+    env = dict(os.environ, PICBLOCKS_PORT=str(port), PICBLOCKS_DB_POLL_INTERVAL="0")
+    if len(sys.argv) > 1:
+        env["PICBLOCKS_DB_PATH"] = sys.argv[1]
+    num_runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    for run in range(num_runs):
+        first_byte, ready = measureStartup(env, port)
+        print(f"run {run + 1}: first byte after {first_byte:.3f}s, ready after {ready:.3f}s")
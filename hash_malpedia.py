@@ -6,15 +6,19 @@ import sys
 import json
 import struct
 import logging
-import traceback
-from multiprocessing import Pool, cpu_count
-
-import tqdm
+from multiprocessing import cpu_count
 
 from smda.Disassembler import Disassembler
 
 from picblocks.blockhasher import BlockHasher
 from picblocks.blockhashmatcher import BlockHashMatcher
+from picblocks.batchhasher import BatchHasher, getWorkerEscapeCache
+from picblocks.dbbuilder import DbBuilder, getReportPaths
+
+
+dump_file_pattern = re.compile("dump7?_0x[0-9a-fA-F]{8,16}")
+unpacked_file_pattern = re.compile("_unpacked(_x64)?$")
+logger = logging.getLogger('smda-multithreaded')
 
 
 
@@ -145,14 +149,6 @@ def readFileContent(file_path):
     return file_content
 
 
-def getAllReportFilenames(output_path):
-    report_filenames = set([])
-    for root, subdir, files in os.walk(output_path):
-        for filename in files:
-            report_filenames.add(filename)
-    return report_filenames
-
-
 def getFamilyName(input_path):
     family_name = ""
     abs_path = os.path.abspath(input_path)
@@ -182,10 +178,9 @@ def getMalpediaFilePath(input_path):
 
 
 def work(input_element):
-    if input_element['filename'] + ".blocks" in input_element['finished_reports']:
-        print("Skipping file {}".format(input_element['filepath']))
-        return
+    """ returns a blockhash report for the input element or None if it is skipped, writing is done by the BatchHasher """
     REPORT = None
+    blockhash_report = None
     INPUT_FILEPATH = input_element['filepath']
     INPUT_FILENAME = input_element['filename']
     MALPEDIA_PATH = input_element['malpedia_path']
@@ -197,42 +192,53 @@ def work(input_element):
     if in_family_path.startswith("module"):
         return
     disassembler = Disassembler()
-    hasher = BlockHasher()
+    hasher = BlockHasher(escape_cache=getWorkerEscapeCache())
+    # failures are raised, so that the BatchHasher journals them as errors and retries them on the next run
     try:
         if "elf." in INPUT_FILEPATH and ("x86" in INPUT_FILEPATH or "x64" in INPUT_FILEPATH) and re.search(unpacked_file_pattern, input_element['filename']):
             print("Analyzing file: {}".format(INPUT_FILEPATH))
-            try:
-                REPORT = disassembler.disassembleFile(INPUT_FILEPATH)
-            except AttributeError:
-                logger.error("exception for: " + str(INPUT_FILENAME))
+            REPORT = disassembler.disassembleFile(INPUT_FILEPATH)
         elif "win." in INPUT_FILEPATH and re.search(unpacked_file_pattern, input_element['filename']):
             print("Analyzing file: {}".format(INPUT_FILEPATH))
-            try:
-                REPORT = disassembler.disassembleFile(INPUT_FILEPATH)
-            except AttributeError:
-                logger.error("AttributeError for: " + str(INPUT_FILENAME))
+            REPORT = disassembler.disassembleFile(INPUT_FILEPATH)
         elif re.search(dump_file_pattern, input_element['filename']):
             print("Analyzing file: {}".format(INPUT_FILEPATH))
             BUFFER = readFileContent(INPUT_FILEPATH)
             BASE_ADDR = parseBaseAddrFromArgs(INPUT_FILENAME)
             BITNESS = getBitnessFromFilename(INPUT_FILENAME)
-            try:
-                REPORT = disassembler.disassembleBuffer(BUFFER, BASE_ADDR, BITNESS)
-            except AttributeError:
-                logger.error("AttributeError for: " + str(INPUT_FILENAME))
-        if REPORT:
-            REPORT.family = getFamilyName(INPUT_FILEPATH)
-            REPORT.version = getSampleVersion(INPUT_FILEPATH, REPORT.family)
-            REPORT.filename = os.path.basename(malpedia_relative_path)
-            blockhash_report = hasher.processSmda(REPORT)
-            with open("block-reports/" + INPUT_FILENAME + ".blocks", "w") as fout:
-                json.dump(blockhash_report, fout, indent=1, sort_keys=True)
-                logger.info("Wrote " + "block-reports/" + INPUT_FILENAME + ".blocks")
-    except Exception:
-        print("RunTimeError, we skip!")
-        print("smda: " + str( INPUT_FILENAME ))
-        traceback.print_exc()
-    return None
+            REPORT = disassembler.disassembleBuffer(BUFFER, BASE_ADDR, BITNESS)
+    except AttributeError:
+        logger.error("AttributeError for: " + str(INPUT_FILENAME))
+        raise
+    if REPORT:
+        REPORT.family = getFamilyName(INPUT_FILEPATH)
+        REPORT.version = getSampleVersion(INPUT_FILEPATH, REPORT.family)
+        REPORT.filename = os.path.basename(malpedia_relative_path)
+        blockhash_report = hasher.processSmda(REPORT)
+    return blockhash_report
+
+
+def iterateInputElements(malpedia_path):
+    """ lazily walk malpedia, so that hashing can start right away """
+    # Find all targets (everything) to disassemble in malpedia.
+    file_index = 0
+    for root, subdir, files in os.walk(malpedia_path):
+        subdir.sort()
+        if ".git" in root:
+            continue
+        for filename in sorted(files):
+            if not (re.search(unpacked_file_pattern, filename) or re.search(dump_file_pattern, filename)):
+                continue
+            # TODO remove sampling after experiments
+            file_index += 1
+            if file_index % 10 != 0:
+                continue
+            filepath = root + os.sep + filename
+            yield {
+                "filename": filename,
+                "filepath": filepath,
+                "malpedia_path": malpedia_path
+            }
 
 
 if __name__ == "__main__":
@@ -243,7 +249,6 @@ if __name__ == "__main__":
                         datefmt='%Y-%m-%d %H:%M:%S',
                         level=logging.INFO)
 
-    logger = logging.getLogger('smda-multithreaded')
     formatter = logging.Formatter('%(process)d - %(processName)s - %(threadName)s - %(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
     # Add logger to stdout
@@ -256,41 +261,14 @@ if __name__ == "__main__":
         print("usage: %s <malpedia_root>" % sys.argv[0])
         sys.exit(1)
     malpedia_path = sys.argv[1]
-    finished_reports = getAllReportFilenames("block-reports")
-    dump_file_pattern = re.compile("dump7?_0x[0-9a-fA-F]{8,16}")
-    unpacked_file_pattern = re.compile("_unpacked(_x64)?$")
-    input_queue = []
-    # Find all targets (everything) to disassemble in malpedia.
-    file_index = 0
-    for root, subdir, files in sorted(os.walk(malpedia_path)):
-        if ".git" in root:
-            continue
-        for filename in sorted(files):
-            if not (re.search(unpacked_file_pattern, filename) or re.search(dump_file_pattern, filename)):
-                continue
-            # TODO remove sampling after experiments
-            file_index += 1
-            if file_index % 10 != 0:
-                continue
-            filepath = root + os.sep + filename
-            input_element = {
-                "filename": filename,
-                "finished_reports": finished_reports,
-                "filepath": filepath,
-                "malpedia_path": malpedia_path
-            }
-            input_queue.append(input_element)
-    results = []
-    # Use Pooling for parallel processing
-    with Pool(cpu_count() - 2) as pool:
-        for result in tqdm.tqdm(pool.imap_unordered(work, input_queue), total=len(input_queue)):
-            results.append(result)
+    # already hashed samples are skipped based on the journal in block-reports, failed ones are retried, workers hashing a sample for more than an hour are replaced
+    # reports are written in the compact binary format, use python -m picblocks.blockreport to convert them to JSON
+    batch_hasher = BatchHasher("block-reports", num_processes=max(1, cpu_count() - 2), timeout=3600, work_function=work, retry_failed=True, report_format="binary")
+    stats = batch_hasher.run(iterateInputElements(malpedia_path))
+    print(json.dumps(stats, indent=1, sort_keys=True))
     print("Produced all block reports, now aggregating a DB...")
+    DbBuilder(num_processes=max(1, cpu_count() - 2)).build(getReportPaths("block-reports"), "db/picblocksdb.json")
     matcher = BlockHashMatcher()
-    for filename in tqdm.tqdm(os.listdir("block-reports")):
-        if filename.endswith(".blocks"):
-            matcher.load("block-reports" + os.sep + filename)
+    matcher.loadDb("db/picblocksdb.json")
     print(json.dumps(matcher.getDbStats(), indent=1, sort_keys=True))
-    print("saving DB...")
-    matcher.saveDb("db/picblocksdb.json")
     print("DONE, shutting down")
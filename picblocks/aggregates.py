@@ -0,0 +1,19 @@
+import math
+from collections import namedtuple
+
+
+# everything match() needs to know about a DB bucket (all entries of one (hash, size) key), independent of the input
+# families are ordered by their first occurrence in the bucket, which determines the order of family matches on ties
+BucketAggregate = namedtuple("BucketAggregate", ["families", "has_library", "adjustment_value", "is_unique"])
+
+
+def getFamilyAdjustmentValue(num_families):
+    """ block scores are increasingly penalized when occurring in three or more families """
+    return 1 if num_families < 3 else 1 + int(math.log(num_families, 2))
+
+
+def aggregateEntries(entries):
+    """ aggregate a list of (family_id, sample_id, fid, is_library) entries into a BucketAggregate """
+    families = tuple(dict.fromkeys(entry[0] for entry in entries))
+    has_library = any(entry[3] for entry in entries)
+    return BucketAggregate(families, has_library, getFamilyAdjustmentValue(len(families)), len(families) == 1)
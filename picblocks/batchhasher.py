@@ -0,0 +1,290 @@
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+
+from .escapecache import EscapedInstructionCache
+from .blockhasher import BlockHasher, HASH_ALGORITHMS, DEFAULT_HASH_ALGORITHM, HASH_SIZES, DEFAULT_HASH_SIZE
+from .blockreport import writeBinaryBlockReport, COMPRESSIONS, DEFAULT_COMPRESSION
+from .reportarchive import ReportArchive
+
+# Only do basicConfig if no handlers have been configured
+if len(logging._handlerList) == 0:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
+
+DEFAULT_TIMEOUT = 600
+JOURNAL_FILENAME = "journal.tsv"
+# journal status values
+STATUS_OK = "ok"
+STATUS_SKIPPED = "skipped"
+STATUS_ERROR = "error"
+STATUS_TIMEOUT = "timeout"
+# block reports are written as indented JSON or in the compact binary format of blockreport.py
+REPORT_FORMATS = ["json", "binary"]
+# set in each worker process, which keeps escaped instructions cached across all reports it hashes
+_ESCAPE_CACHE = None
+
+
+def calculateFileSha256(filepath):
+    sha256 = hashlib.sha256()
+    with open(filepath, "rb") as fin:
+        for chunk in iter(lambda: fin.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def getWorkerEscapeCache():
+    """ return the escape cache of the current worker process, for work functions to pass to their BlockHasher, None outside of workers """
+    return _ESCAPE_CACHE
+
+
+def hashFile(work_item):
+    """ default work function: hash a single file and label it with family and version of the work item """
+    blockhash_report = BlockHasher(escape_cache=_ESCAPE_CACHE, hash_algorithm=work_item.get("hash_algorithm", DEFAULT_HASH_ALGORITHM), hash_size=work_item.get("hash_size", DEFAULT_HASH_SIZE)).processFile(work_item["filepath"])
+    blockhash_report["family"] = work_item.get("family", "")
+    blockhash_report["version"] = work_item.get("version", "")
+    return blockhash_report
+
+
+def hashFileWithMinHash(work_item):
+    """ like hashFile(), but adds the MinHash signature to the report """
+    blockhash_report = BlockHasher(escape_cache=_ESCAPE_CACHE, with_minhash=True, hash_algorithm=work_item.get("hash_algorithm", DEFAULT_HASH_ALGORITHM), hash_size=work_item.get("hash_size", DEFAULT_HASH_SIZE)).processFile(work_item["filepath"])
+    blockhash_report["family"] = work_item.get("family", "")
+    blockhash_report["version"] = work_item.get("version", "")
+    return blockhash_report
+
+
+def _workerLoop(connection, work_function):
+    """ receive work items until None is sent, reply with (status, blockhash_report, message) """
+    global _ESCAPE_CACHE
+    logging.disable(logging.INFO)
+    _ESCAPE_CACHE = EscapedInstructionCache()
+    while True:
+        work_item = connection.recv()
+        if work_item is None:
+            break
+        try:
+            blockhash_report = work_function(work_item)
+            if blockhash_report is None:
+                connection.send((STATUS_SKIPPED, None, ""))
+            else:
+                connection.send((STATUS_OK, blockhash_report, ""))
+        except Exception:
+            connection.send((STATUS_ERROR, None, traceback.format_exc()))
+
+
+class BatchJournal(object):
+    """ append-only journal of processed samples as lines of <sha256>\\t<status>\\t<filename> """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.entries = {}
+        if os.path.exists(filepath):
+            with open(filepath, "r") as fin:
+                for line in fin:
+                    fields = line.rstrip("\n").split("\t")
+                    # a crash may have left an incomplete last line, which we simply ignore
+                    if len(fields) == 3 and len(fields[0]) == 64:
+                        self.entries[fields[0]] = fields[1]
+        self._fout = open(filepath, "a")
+
+    def isFinished(self, sha256, retry_failed=False):
+        if sha256 not in self.entries:
+            return False
+        return not retry_failed or self.entries[sha256] in [STATUS_OK, STATUS_SKIPPED]
+
+    def record(self, sha256, status, filename):
+        self.entries[sha256] = status
+        self._fout.write(f"{sha256}\t{status}\t{filename}\n")
+        self._fout.flush()
+        os.fsync(self._fout.fileno())
+
+    def close(self):
+        self._fout.close()
+
+
+class _Worker(object):
+
+    def __init__(self, work_function):
+        self.connection, worker_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_workerLoop, args=(worker_connection, work_function), daemon=True)
+        self.process.start()
+        self.work_item = None
+        self.start_time = None
+
+    def assign(self, work_item):
+        self.work_item = work_item
+        self.start_time = time.time()
+        self.connection.send(work_item)
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+class BatchHasher(object):
+    """
+    Hash a stream of work items (dicts with at least a "filepath") with a pool of worker processes.
+    Only num_processes items are in flight at any time, results are sent back to this process as single writer,
+    and every finished sample is recorded in an append-only journal by its sha256, so that an interrupted run can be resumed.
+    Workers exceeding the timeout for a sample are killed and replaced.
+    """
+
+    def __init__(self, output_path, num_processes=None, timeout=DEFAULT_TIMEOUT, journal_path=None, work_function=hashFile, retry_failed=False, report_format="json", compression=DEFAULT_COMPRESSION, archive_path=None):
+        self.output_path = output_path
+        self.num_processes = num_processes if num_processes else max(1, multiprocessing.cpu_count() - 1)
+        self.timeout = timeout
+        self.journal_path = journal_path if journal_path is not None else os.path.join(output_path, JOURNAL_FILENAME)
+        self.work_function = work_function
+        self.retry_failed = retry_failed
+        if report_format not in REPORT_FORMATS:
+            raise ValueError(f"Unknown report format: {report_format}")
+        self.report_format = report_format
+        self.compression = compression
+        # reports are appended to a report archive instead of being written into output_path, which still holds the journal
+        self.archive = ReportArchive(archive_path) if archive_path is not None else None
+        self.stats = {STATUS_OK: 0, STATUS_SKIPPED: 0, STATUS_ERROR: 0, STATUS_TIMEOUT: 0, "resumed": 0}
+
+    def _writeReport(self, work_item, blockhash_report):
+        """ write atomically, so that a report exists if and only if it is complete """
+        if self.archive is not None:
+            self.archive.append(blockhash_report, compression=self.compression)
+            return self.archive.filepath
+        output_filepath = os.path.join(self.output_path, os.path.basename(work_item["filepath"]) + ".blocks")
+        if self.report_format == "binary":
+            writeBinaryBlockReport(blockhash_report, output_filepath + ".tmp", compression=self.compression)
+        else:
+            with open(output_filepath + ".tmp", "w") as fout:
+                json.dump(blockhash_report, fout, indent=1, sort_keys=True)
+        os.replace(output_filepath + ".tmp", output_filepath)
+        return output_filepath
+
+    def _finish(self, journal, worker, status, blockhash_report=None, message=""):
+        work_item = worker.work_item
+        if status == STATUS_OK:
+            output_filepath = self._writeReport(work_item, blockhash_report)
+            LOG.info("Wrote %s", output_filepath)
+        elif status in [STATUS_ERROR, STATUS_TIMEOUT]:
+            LOG.error("%s for %s %s", status, work_item["filepath"], message)
+        journal.record(work_item["sha256"], status, os.path.basename(work_item["filepath"]))
+        self.stats[status] += 1
+        worker.work_item = None
+        worker.start_time = None
+
+    def _iterateUnfinished(self, work_items, journal):
+        for work_item in work_items:
+            if "sha256" not in work_item:
+                work_item["sha256"] = calculateFileSha256(work_item["filepath"])
+            if journal.isFinished(work_item["sha256"], retry_failed=self.retry_failed):
+                self.stats["resumed"] += 1
+                continue
+            yield work_item
+
+    def run(self, work_items):
+        """ process all work items, which may be a lazy iterable, e.g. a generator walking a directory tree """
+        os.makedirs(self.output_path, exist_ok=True)
+        journal = BatchJournal(self.journal_path)
+        pending_items = self._iterateUnfinished(work_items, journal)
+        workers = [_Worker(self.work_function) for _ in range(self.num_processes)]
+        is_exhausted = False
+        try:
+            while True:
+                for index, worker in enumerate(workers):
+                    if worker.work_item is None and not is_exhausted:
+                        work_item = next(pending_items, None)
+                        if work_item is None:
+                            is_exhausted = True
+                        else:
+                            worker.assign(work_item)
+                busy_workers = {worker.connection: worker for worker in workers if worker.work_item is not None}
+                if not busy_workers:
+                    break
+                for connection in wait(list(busy_workers), timeout=1):
+                    worker = busy_workers[connection]
+                    try:
+                        status, blockhash_report, message = connection.recv()
+                    except EOFError:
+                        status, blockhash_report, message = STATUS_ERROR, None, "worker died"
+                        workers[workers.index(worker)] = self._replaceWorker(worker)
+                    self._finish(journal, worker, status, blockhash_report, message)
+                for index, worker in enumerate(workers):
+                    if worker.work_item is not None and time.time() - worker.start_time > self.timeout:
+                        self._finish(journal, worker, STATUS_TIMEOUT, message=f"after {self.timeout}s")
+                        workers[index] = self._replaceWorker(worker)
+        finally:
+            for worker in workers:
+                if worker.work_item is not None:
+                    worker.kill()
+                else:
+                    worker.stop()
+            journal.close()
+        return self.stats
+
+    def _replaceWorker(self, worker):
+        worker.kill()
+        return _Worker(self.work_function)
+
+
+def walkFiles(input_path, filename_pattern=None, family=None, hash_algorithm=DEFAULT_HASH_ALGORITHM, hash_size=DEFAULT_HASH_SIZE):
+    """ lazily yield work items for all files below input_path, using the parent folder as family unless given """
+    for root, subdirs, files in os.walk(input_path):
+        subdirs.sort()
+        if ".git" in root.split(os.sep):
+            continue
+        for filename in sorted(files):
+            if filename_pattern is not None and not re.search(filename_pattern, filename):
+                continue
+            filepath = os.path.join(root, filename)
+            yield {
+                "filepath": filepath,
+                "family": family if family is not None else os.path.basename(os.path.abspath(root)),
+                "version": "",
+                "hash_algorithm": hash_algorithm,
+                "hash_size": hash_size,
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hash all files in a directory tree into block reports, resumable via a journal.")
+    parser.add_argument("input_path", help="root of the directory tree with binaries to hash.")
+    parser.add_argument("-o", "--output", default="block-reports", help="directory to write block reports to (default: block-reports).")
+    parser.add_argument("-p", "--processes", type=int, default=None, help="number of worker processes (default: number of CPUs - 1).")
+    parser.add_argument("-t", "--timeout", type=int, default=DEFAULT_TIMEOUT, help=f"seconds after which a worker hashing a single sample is killed (default: {DEFAULT_TIMEOUT}).")
+    parser.add_argument("-j", "--journal", default=None, help=f"path of the resume journal (default: <output>/{JOURNAL_FILENAME}).")
+    parser.add_argument("-f", "--family", default=None, help="family label for all samples (default: name of the containing folder).")
+    parser.add_argument("--pattern", default=None, help="only hash files with a name matching this regular expression.")
+    parser.add_argument("--retry-failed", action="store_true", help="retry samples that previously failed or timed out.")
+    parser.add_argument("--hash-algorithm", choices=HASH_ALGORITHMS, default=DEFAULT_HASH_ALGORITHM, help=f"digest to take blockhashes from, DBs only accept reports of a single one (default: {DEFAULT_HASH_ALGORITHM}).")
+    parser.add_argument("--hash-size", type=int, choices=HASH_SIZES, default=DEFAULT_HASH_SIZE, help=f"bytes per blockhash, 8 avoids collisions in large corpora (default: {DEFAULT_HASH_SIZE}).")
+    parser.add_argument("--minhash", action="store_true", help="add MinHash signatures to the block reports, to skip computing them when matching.")
+    parser.add_argument("--format", choices=REPORT_FORMATS, default="json", help="format of the block reports, binary ones are much smaller and streamed when loaded (default: json).")
+    parser.add_argument("--compression", choices=COMPRESSIONS, default=DEFAULT_COMPRESSION, help=f"compression of binary block reports (default: {DEFAULT_COMPRESSION}).")
+    parser.add_argument("--archive", default=None, help="append block reports to this report archive instead of writing them into the output directory, which then only holds the journal.")
+    args = parser.parse_args()
+    work_function = hashFileWithMinHash if args.minhash else hashFile
+    batch_hasher = BatchHasher(args.output, num_processes=args.processes, timeout=args.timeout, journal_path=args.journal, work_function=work_function, retry_failed=args.retry_failed, report_format=args.format, compression=args.compression, archive_path=args.archive)
+    stats = batch_hasher.run(walkFiles(args.input_path, filename_pattern=args.pattern, family=args.family, hash_algorithm=args.hash_algorithm, hash_size=args.hash_size))
+    print(json.dumps(stats, indent=1, sort_keys=True))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,22 +2,69 @@ import os
 import re
 import sys
 import json
-import struct
 import hashlib
 import logging
+from multiprocessing import Pool
 
 from smda.Disassembler import Disassembler
 from smda.common.SmdaReport import SmdaReport, SmdaFunction
+from smda.common.SmdaInstruction import SmdaInstruction
 from smda.intel.IntelInstructionEscaper import IntelInstructionEscaper
 
+from .escapecache import EscapedInstructionCache
+from .minhash import computeSignature, getPermutations
+
 # Only do basicConfig if no handlers have been configured
 if len(logging._handlerList) == 0:
     logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
 LOG = logging.getLogger(__name__)
 
 
+# increment whenever blockhashes or reports change, as this invalidates cached reports
+HASHER_VERSION = 3
+# digests of escaped blocks that blockhashes can be taken from, which is recorded in reports and DBs as they are not comparable
+HASH_ALGORITHMS = ["sha256", "blake2b"]
+DEFAULT_HASH_ALGORITHM = "sha256"
+# bytes of the digest kept as blockhash, 32 bit hashes start to collide for unrelated blocks in large corpora
+HASH_SIZES = [4, 8]
+DEFAULT_HASH_SIZE = 4
+# reports with fewer functions than this are always hashed serially, as spawning a pool would not pay off
+MIN_FUNCTIONS_FOR_POOL = 1000
+# number of contiguous function shards handed out per worker process, for some load balancing
+SHARDS_PER_PROCESS = 4
+
+
+def _hashFunctionShard(shard):
+    """ worker for parallel hashing, a shard is a list of (function_id, [[instruction_dict, ...], ...]) plus image boundaries """
+    functions, image_lower, image_upper, min_block_size, escape_cache_size, hash_algorithm, hash_size = shard
+    instruction_functions = []
+    for function_id, blocks in functions:
+        instruction_functions.append((function_id, [[SmdaInstruction.fromDict(ins) for ins in block] for block in blocks]))
+    escape_cache = EscapedInstructionCache(escape_cache_size) if escape_cache_size else None
+    return BlockHasher(hash_algorithm=hash_algorithm, hash_size=hash_size)._hashFunctions(instruction_functions, image_lower, image_upper, min_block_size, escape_cache=escape_cache)
+
+
 class BlockHasher(object):
 
+    def __init__(self, num_processes=1, escape_cache_size=0, escape_cache=None, with_minhash=False, hash_algorithm=DEFAULT_HASH_ALGORITHM, hash_size=DEFAULT_HASH_SIZE):
+        if hash_algorithm not in HASH_ALGORITHMS:
+            raise ValueError(f"Unknown hash algorithm: {hash_algorithm}")
+        if hash_size not in HASH_SIZES:
+            raise ValueError(f"Unsupported hash size: {hash_size}")
+        # when > 1, extractBlockhashes shards the functions of large reports across a pool of this many processes
+        self.num_processes = num_processes
+        # a cache only pays off once it is warm, so pass an EscapedInstructionCache to share one across reports (e.g. of a batch worker),
+        # escape_cache_size > 0 instead uses a fresh cache of this size per report
+        self.escape_cache_size = escape_cache_size
+        self.escape_cache = escape_cache
+        # hit/miss counters of the escape cache(s) used for the last report
+        self.escape_cache_stats = None
+        # add the MinHash signature of the (hash, size) keys to reports, see MinHashIndex
+        self.with_minhash = with_minhash
+        # blake2b is considerably faster than sha256, of which we only keep a few bytes anyway
+        self.hash_algorithm = hash_algorithm
+        self.hash_size = hash_size
+
     def parseBitnessFromFilename(self, filepath):
         # try to infer base addr from filename, in case we process a mapped image / memory dump
         baddr_match = re.search(re.compile("0x(?P<base_addr>[0-9a-fA-F]{8,16})$"), filepath)
@@ -49,12 +96,19 @@ class BlockHasher(object):
             file_content = fin.read()
         return file_content
 
-    def processBuffer(self, buffer, filename, bitness=None, baseaddress=None):
-        LOG.info("now analyzing {}".format(filename))
-        DISASSEMBLER = Disassembler()
+    def getBufferParameters(self, filename, bitness=None, baseaddress=None):
+        """ return (bitness, baseaddress) used by processBuffer for a mapped buffer, or (None, None) if it is processed as unmapped file """
         if "_0x" in filename or baseaddress:
             BASE_ADDR = baseaddress if baseaddress is not None else self.parseBaseAddrFromFilename(filename)
             BITNESS = bitness if bitness is not None else self.parseBitnessFromFilename(filename)
+            return BITNESS, BASE_ADDR
+        return None, None
+
+    def processBuffer(self, buffer, filename, bitness=None, baseaddress=None):
+        LOG.info("now analyzing {}".format(filename))
+        DISASSEMBLER = Disassembler()
+        BITNESS, BASE_ADDR = self.getBufferParameters(filename, bitness=bitness, baseaddress=baseaddress)
+        if BASE_ADDR is not None:
             SMDA_REPORT = DISASSEMBLER.disassembleBuffer(buffer, BASE_ADDR, BITNESS)
         else:
             SMDA_REPORT = DISASSEMBLER.disassembleUnmappedBuffer(buffer)
@@ -85,16 +139,26 @@ class BlockHasher(object):
         blockhash_report = self.extractBlockhashes(smda_report)
         return blockhash_report
 
-    def calculateBlockhash(self, block, lower_addr, upper_addr, hash_size=4):
-        escaped_binary_seq = []
-        for instruction in block.getInstructions():
-            escaped_binary_seq.append(instruction.getEscapedBinary(IntelInstructionEscaper, escape_intraprocedural_jumps=True, lower_addr=lower_addr, upper_addr=upper_addr))
-        as_bytes = bytes([ord(c) for c in "".join(escaped_binary_seq)])
-        if hash_size == 8:
-            return struct.unpack("Q", hashlib.sha256(as_bytes).digest()[:8])[0]
-        return struct.unpack("I", hashlib.sha256(as_bytes).digest()[:4])[0]
+    def calculateBlockhash(self, block, lower_addr, upper_addr, hash_size=None):
+        return self.calculateInstructionsHash(block.getInstructions(), lower_addr, upper_addr, hash_size=hash_size)
+
+    def calculateInstructionsHash(self, instructions, lower_addr, upper_addr, hash_size=None, escape_cache=None):
+        hash_size = self.hash_size if hash_size is None else hash_size
+        if escape_cache is not None:
+            escaped_binary_seq = escape_cache.escapeInstructions(instructions, lower_addr=lower_addr, upper_addr=upper_addr)
+        else:
+            escaped_binary_seq = []
+            for instruction in instructions:
+                escaped_binary_seq.append(instruction.getEscapedBinary(IntelInstructionEscaper, escape_intraprocedural_jumps=True, lower_addr=lower_addr, upper_addr=upper_addr))
+        # escaped instructions only consist of characters < 256, so latin-1 maps them to the same bytes as ord() did
+        as_bytes = "".join(escaped_binary_seq).encode("latin-1")
+        if self.hash_algorithm == "blake2b":
+            digest = hashlib.blake2b(as_bytes, digest_size=hash_size).digest()
+        else:
+            digest = hashlib.sha256(as_bytes).digest()[:hash_size]
+        return int.from_bytes(digest, "little")
 
-    def getBlockhashesForFunction(self, smda_function: "SmdaFunction", image_lower: int, image_upper: int, min_block_size=4, hash_size=4):
+    def getBlockhashesForFunction(self, smda_function: "SmdaFunction", image_lower: int, image_upper: int, min_block_size=4, hash_size=None):
         blockhashes = {}
         for block in smda_function.getBlocks():
             if block.length >= min_block_size:
@@ -119,6 +183,69 @@ class BlockHasher(object):
                 blockhashes[block_hash]["count"] += 1
         return list(blockhashes.values())
 
+    def _hashFunctions(self, functions, image_lower, image_upper, min_block_size, escape_cache=None):
+        """ hash all blocks of (function_id, [[instruction, ...], ...]) functions into {hash: {size: set(function_ids)}} plus counters """
+        blockhashes = {}
+        block_bytes = 0
+        num_all_blocks = 0
+        num_blocks = 0
+        num_functions_hashed = 0
+        for function_id, blocks in functions:
+            for instructions in blocks:
+                num_all_blocks += 1
+                if len(instructions) >= min_block_size:
+                    num_blocks += 1
+                    block_size = sum([len(ins.bytes) // 2 for ins in instructions])
+                    block_hash = self.calculateInstructionsHash(instructions, lower_addr=image_lower, upper_addr=image_upper, escape_cache=escape_cache)
+                    if block_hash not in blockhashes:
+                        blockhashes[block_hash] = {}
+                    if block_size not in blockhashes[block_hash]:
+                        blockhashes[block_hash][block_size] = set()
+                    blockhashes[block_hash][block_size].add(function_id)
+                    block_bytes += block_size
+                    num_functions_hashed += 1
+        return {
+            "blockhashes": blockhashes,
+            "block_bytes": block_bytes,
+            "num_all_blocks": num_all_blocks,
+            "num_blocks": num_blocks,
+            "num_functions_hashed": num_functions_hashed,
+            "escape_cache_stats": escape_cache.getStats() if escape_cache is not None else None,
+        }
+
+    def _hashFunctionsParallel(self, functions, image_lower, image_upper, min_block_size):
+        """ hash contiguous shards of functions in a process pool and merge them in order, yielding the same result as a serial run """
+        num_shards = self.num_processes * SHARDS_PER_PROCESS
+        shard_size = (len(functions) + num_shards - 1) // num_shards
+        shards = []
+        for shard_start in range(0, len(functions), shard_size):
+            shard_functions = []
+            for function_id, function in functions[shard_start:shard_start + shard_size]:
+                shard_functions.append((function_id, [[ins.toDict() for ins in block] for _, block in sorted(function.blocks.items())]))
+            shards.append((shard_functions, image_lower, image_upper, min_block_size, self.escape_cache_size, self.hash_algorithm, self.hash_size))
+        LOG.info("hashing %d functions in %d shards using %d processes.", len(functions), len(shards), self.num_processes)
+        merged = {"blockhashes": {}, "block_bytes": 0, "num_all_blocks": 0, "num_blocks": 0, "num_functions_hashed": 0, "escape_cache_stats": None}
+        with Pool(self.num_processes) as pool:
+            # merging shards in order of their function ids preserves the insertion order of hashes and sizes
+            for hashed in pool.imap(_hashFunctionShard, shards):
+                for block_hash, by_size in hashed["blockhashes"].items():
+                    if block_hash not in merged["blockhashes"]:
+                        merged["blockhashes"][block_hash] = {}
+                    for block_size, function_ids in by_size.items():
+                        if block_size not in merged["blockhashes"][block_hash]:
+                            merged["blockhashes"][block_hash][block_size] = set()
+                        merged["blockhashes"][block_hash][block_size].update(function_ids)
+                for counter in ["block_bytes", "num_all_blocks", "num_blocks", "num_functions_hashed"]:
+                    merged[counter] += hashed[counter]
+                if hashed["escape_cache_stats"] is not None:
+                    # workers use their own caches, so only hits and misses can be summed up meaningfully
+                    stats = merged["escape_cache_stats"] or {"hits": 0, "misses": 0}
+                    stats["hits"] += hashed["escape_cache_stats"]["hits"]
+                    stats["misses"] += hashed["escape_cache_stats"]["misses"]
+                    stats["hit_rate"] = stats["hits"] / (stats["hits"] + stats["misses"]) if stats["hits"] + stats["misses"] else 0
+                    merged["escape_cache_stats"] = stats
+        return merged
+
     def extractBlockhashes(self, smda_report, min_block_size=4):
         output = {
             "family": smda_report.family,
@@ -129,39 +256,39 @@ class BlockHasher(object):
             "filesize": smda_report.binary_size,
             "is_library": smda_report.is_library,
             "min_block_size": min_block_size,
+            "hash_algorithm": self.hash_algorithm,
+            "hash_size": self.hash_size,
             "num_hashes": 0,
             "num_functions": 0,
             "num_functions_hashed": 0,
             "num_blocks": 0,
             "num_all_blocks": 0,
             "block_bytes": 0,
+            "function_offsets": [],
             "blockhashes": {}
         }
-        blockhashes = {}
         image_lower = smda_report.base_addr
         image_upper = image_lower + smda_report.binary_size
-        function_id = 0
-        num_all_blocks = 0
-        num_blocks = 0
-        num_functions = 0
-        num_functions_hashed = 0
-        for function in smda_report.getFunctions():
-            function_offset = function.offset
-            num_functions += 1
-            for block in function.getBlocks():
-                num_all_blocks += 1
-                if block.length >= min_block_size:
-                    num_blocks += 1
-                    block_size = sum([len(ins.bytes) // 2 for ins in block.getInstructions()])
-                    block_hash = self.calculateBlockhash(block, lower_addr=image_lower, upper_addr=image_upper)
-                    if block_hash not in blockhashes:
-                        blockhashes[block_hash] = {}
-                    if block_size not in blockhashes[block_hash]:
-                        blockhashes[block_hash][block_size] = set()
-                    blockhashes[block_hash][block_size].add(function_id)
-                    output["block_bytes"] += block_size
-                    num_functions_hashed += 1
-            function_id += 1
+        # function ids are simply assigned in order of functions, no matter if we hash serially or in parallel
+        functions = [(function_id, function) for function_id, function in enumerate(smda_report.getFunctions())]
+        if self.num_processes > 1 and len(functions) >= MIN_FUNCTIONS_FOR_POOL:
+            hashed = self._hashFunctionsParallel(functions, image_lower, image_upper, min_block_size)
+        else:
+            # use the raw instruction lists, as SmdaFunction.getBlocks() would calculate SMDA's own PicBlockHash for every block
+            instruction_functions = [(function_id, [block for _, block in sorted(function.blocks.items())]) for function_id, function in functions]
+            escape_cache = self.escape_cache
+            if escape_cache is None and self.escape_cache_size:
+                escape_cache = EscapedInstructionCache(self.escape_cache_size)
+            hashed = self._hashFunctions(instruction_functions, image_lower, image_upper, min_block_size, escape_cache=escape_cache)
+        self.escape_cache_stats = hashed["escape_cache_stats"]
+        if self.escape_cache_stats is not None:
+            LOG.debug("escape cache: %d hits, %d misses.", self.escape_cache_stats["hits"], self.escape_cache_stats["misses"])
+        blockhashes = hashed["blockhashes"]
+        output["block_bytes"] = hashed["block_bytes"]
+        num_functions = len(functions)
+        num_functions_hashed = hashed["num_functions_hashed"]
+        num_blocks = hashed["num_blocks"]
+        num_all_blocks = hashed["num_all_blocks"]
         num_hashes = 0
         for blockhash, by_size in blockhashes.items():
             for size, offsets in by_size.items():
@@ -172,17 +299,21 @@ class BlockHasher(object):
         output["num_blocks"] = num_blocks
         output["num_all_blocks"] = num_all_blocks
         output["num_hashes"] = num_hashes
+        # function ids index into this list
+        output["function_offsets"] = [function.offset for _, function in functions]
         output["blockhashes"] = blockhashes
+        if self.with_minhash:
+            output["minhash"] = computeSignature([(blockhash, size) for blockhash, by_size in blockhashes.items() for size in by_size], getPermutations())
         return output
 
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print(f"usage: {sys.argv[0]} <target_binary_path>")
+        print(f"usage: {sys.argv[0]} <target_binary_path> <optional:num_processes>")
         sys.exit(1)
     if os.path.isfile(sys.argv[1]):
         INPUT_FILENAME = os.path.basename(sys.argv[1])
-        hasher = BlockHasher()
+        hasher = BlockHasher(num_processes=int(sys.argv[2]) if len(sys.argv) > 2 else 1)
         blockhash_report = hasher.processFile(sys.argv[1])
         with open(INPUT_FILENAME + ".blocks", "w") as fout:
             json.dump(blockhash_report, fout, indent=1, sort_keys=True)
@@ -1,24 +1,38 @@
 import os
 import sys
 import json
-import math
+import uuid
 import logging
 import datetime
 from collections import defaultdict, Counter
 
 try:
-    # optionally use tqdm to render progress (should not be a package requirement)
-    import tqdm
-except:
-    tqdm = None
+    import numpy as np
+except ImportError:
+    np = None
 
-from .blockhasher import BlockHasher
+from .blockhasher import BlockHasher, DEFAULT_HASH_ALGORITHM, DEFAULT_HASH_SIZE
+from .blockreport import readBlockReport
+from .aggregates import aggregateEntries
+from .compactdb import CompactDb
+from .numpymatcher import NumpyMatcher
+from .samplematcher import SampleMatcher, DEFAULT_TOP_K
+from .functionindex import FunctionIndex, DEFAULT_MAX_POSTINGS
+from .functionindex import DEFAULT_TOP_K as DEFAULT_FUNCTION_TOP_K
+from .incrementaldb import OverlayDb, getDeltaPaths, getNextDeltaPath, removeDeltas
+from .dbbuilder import DbBuilder, getReportPaths
+from .shardeddb import ShardedDb
 
 # Only do basicConfig if no handlers have been configured
 if len(logging._handlerList) == 0:
     logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
 LOG = logging.getLogger(__name__)
 
+# how matched blocks are weighted: once per (hash, size) bucket, or per function of the input they occur in
+WEIGHTINGS = ["bucket", "occurrence"]
+# number of reports for which matchMany() resolves keys and computes scores together
+DEFAULT_BATCH_SIZE = 64
+
 
 class BlockHashMatcher(object):
 
@@ -28,52 +42,330 @@ class BlockHashMatcher(object):
         self.family_to_id = {}
         self.family_id_to_family = {}
         self.sample_id_to_sample = {}
+        # blockhashes of reports are only comparable to those of the DB if they were calculated with the same algorithm
+        self.hash_algorithm = DEFAULT_HASH_ALGORITHM
+        self.hash_size = DEFAULT_HASH_SIZE
+        # function addresses per sample ID, indexed by function ID; for a loaded DB only those of samples loaded on top of it
+        self.sample_function_offsets = {}
+        # identifies the base DB file that delta segments were written against
+        self.base_id = None
+        # BucketAggregates per (hash, size) for the dict representation, updated lazily for buckets changed by load()
+        self.bucket_aggregates = {}
+        self._dirty_buckets = set()
+        # (hash, size) buckets changed since the DB was loaded or saved, which saveDelta() writes
+        self._changed_buckets = set()
+        # samples loaded since the DB was loaded or saved, whose function addresses saveDelta() writes
+        self._added_sample_ids = set()
+        self._numpy_matcher = None
+        self._sample_matcher = None
+        self._function_index = None
+
+    @staticmethod
+    def _getNextId(id_mapping):
+        """ IDs are never reused, so that they remain stable when samples or families are removed """
+        return max(id_mapping) + 1 if id_mapping else 0
+
+    def _makeWritable(self):
+        if isinstance(self.blockhashes, ShardedDb):
+            raise ValueError("Sharded DBs are read-only, apply changes before splitting the DB into shards.")
+        if isinstance(self.blockhashes, CompactDb):
+            # keep the read-only compact DB and only copy the buckets we change into an overlay
+            self.blockhashes = OverlayDb(self.blockhashes)
+
+    def _getMutableBucket(self, int_hash, int_size):
+        """ return the entries of bucket (int_hash, int_size) for changing them, creating the bucket if necessary """
+        self._changed_buckets.add((int_hash, int_size))
+        self._makeWritable()
+        if isinstance(self.blockhashes, OverlayDb):
+            return self.blockhashes.getMutableBucket(int_hash, int_size)
+        self._dirty_buckets.add((int_hash, int_size))
+        return self.blockhashes.setdefault(int_hash, {}).setdefault(int_size, [])
+
+    def _setBucket(self, int_hash, int_size, entries):
+        """ replace the entries of bucket (int_hash, int_size), removing it if entries are empty """
+        self._makeWritable()
+        if isinstance(self.blockhashes, OverlayDb):
+            self.blockhashes.setBucket(int_hash, int_size, entries)
+            return
+        self._dirty_buckets.add((int_hash, int_size))
+        if entries:
+            self.blockhashes.setdefault(int_hash, {})[int_size] = entries
+        elif int_size in self.blockhashes.get(int_hash, {}):
+            del self.blockhashes[int_hash][int_size]
+            if not self.blockhashes[int_hash]:
+                del self.blockhashes[int_hash]
 
     def load(self, filepath):
         """ load a single blockhash report """
-        with open(filepath, "r") as fin:
-            blockhash_report = json.load(fin)
-            family = blockhash_report["family"]
-            if family not in self.family_to_id:
-                family_id = len(self.family_to_id)
-                self.family_to_id[family] = family_id
-                self.family_id_to_family[family_id] = family
-            family_id = self.family_to_id[family]
-            sample_id = len(self.sample_id_to_sample)
-            self.sample_id_to_sample[sample_id] = blockhash_report["filename"]
-            for blockhash, data in blockhash_report["blockhashes"].items():
-                int_hash = int(blockhash)
-                if int_hash not in self.blockhashes:
-                    self.blockhashes[int_hash] = {}
-                for size, fids in data.items():
-                    int_size = int(size)
-                    if int_size not in self.blockhashes[int_hash]:
-                        self.blockhashes[int_hash][int_size] = []
-                    for fid in fids:
-                        is_library = False if "is_library" not in blockhash_report else blockhash_report["is_library"]
-                        self.blockhashes[int_hash][int_size].append((family_id, sample_id, fid, is_library))
+        self._makeWritable()
+        self._numpy_matcher = None
+        self._sample_matcher = None
+        self._function_index = None
+        blockhash_report = readBlockReport(filepath)
+        if not self.sample_id_to_sample:
+            # an empty DB adopts the hash function of its first report
+            self.hash_algorithm = blockhash_report.get("hash_algorithm", DEFAULT_HASH_ALGORITHM)
+            self.hash_size = blockhash_report.get("hash_size", DEFAULT_HASH_SIZE)
+        self._checkHashFunction(blockhash_report)
+        family = blockhash_report["family"]
+        if family not in self.family_to_id:
+            family_id = self._getNextId(self.family_id_to_family)
+            self.family_to_id[family] = family_id
+            self.family_id_to_family[family_id] = family
+        family_id = self.family_to_id[family]
+        sample_id = self._getNextId(self.sample_id_to_sample)
+        self.sample_id_to_sample[sample_id] = blockhash_report["filename"]
+        if "function_offsets" in blockhash_report:
+            self.sample_function_offsets[sample_id] = blockhash_report["function_offsets"]
+        self._added_sample_ids.add(sample_id)
+        is_library = False if "is_library" not in blockhash_report else blockhash_report["is_library"]
+        for blockhash, data in blockhash_report["blockhashes"].items():
+            int_hash = int(blockhash)
+            for size, fids in data.items():
+                bucket = self._getMutableBucket(int_hash, int(size))
+                for fid in fids:
+                    bucket.append((family_id, sample_id, fid, is_library))
+
+    def removeSample(self, sample_id):
+        """ remove a sample and all of its blockhashes, all other IDs remain unchanged """
+        if sample_id not in self.sample_id_to_sample:
+            raise KeyError(f"Unknown sample ID: {sample_id}")
+        self._removeEntries(sample_ids=[sample_id])
+        del self.sample_id_to_sample[sample_id]
+        self.sample_function_offsets.pop(sample_id, None)
+
+    def removeFamily(self, family):
+        """ remove a family with all of its samples and their blockhashes, all other IDs remain unchanged """
+        if family not in self.family_to_id:
+            raise KeyError(f"Unknown family: {family}")
+        family_id = self.family_to_id[family]
+        for sample_id in self._removeEntries(family_ids=[family_id]):
+            self.sample_id_to_sample.pop(sample_id, None)
+            self.sample_function_offsets.pop(sample_id, None)
+        del self.family_to_id[family]
+        del self.family_id_to_family[family_id]
+
+    def _removeEntries(self, family_ids=(), sample_ids=()):
+        """ remove all entries of the given families or samples and return the IDs of the samples they belonged to """
+        family_ids = set(family_ids)
+        sample_ids = set(sample_ids)
+        self._numpy_matcher = None
+        self._sample_matcher = None
+        self._function_index = None
+        self._makeWritable()
+        if isinstance(self.blockhashes, OverlayDb):
+            buckets = self.blockhashes.findBuckets(family_ids=family_ids, sample_ids=sample_ids)
+        else:
+            buckets = [(int_hash, int_size) for int_hash, sizes in self.blockhashes.items() for int_size, entries in sizes.items() if any(entry[0] in family_ids or entry[1] in sample_ids for entry in entries)]
+        removed_sample_ids = set()
+        for int_hash, int_size in buckets:
+            remaining_entries = []
+            for entry in self._getMutableBucket(int_hash, int_size):
+                if entry[0] in family_ids or entry[1] in sample_ids:
+                    removed_sample_ids.add(entry[1])
+                else:
+                    remaining_entries.append(entry)
+            self._setBucket(int_hash, int_size, remaining_entries)
+        return removed_sample_ids
 
     def loadDb(self, filepath):
-        """ load a previously processed database of blockhashes """
-        with open(filepath, "r") as fin:
-            blockhash_db = json.load(fin)
+        """ load a previously processed database of blockhashes, either as JSON, memory-mapped compact DB or directory of shards """
+        self._numpy_matcher = None
+        self._sample_matcher = None
+        self._function_index = None
+        if ShardedDb.isShardedDb(filepath):
+            self.loadShardedDb(ShardedDb.open(filepath))
+            return
+        if CompactDb.isCompactDb(filepath):
+            compact_db = CompactDb.open(filepath)
+            self.db_timestamp = compact_db.metadata["timestamp"]
+            self.family_to_id = compact_db.metadata["family_to_id"]
+            self.family_id_to_family = {int(k): v for k, v in compact_db.metadata["family_id_to_family"].items()}
+            self.sample_id_to_sample = {int(k): v for k, v in compact_db.metadata["sample_id_to_sample"].items()}
+            self.base_id = compact_db.metadata.get("base_id", None)
+            self.hash_algorithm = compact_db.metadata.get("hash_algorithm", DEFAULT_HASH_ALGORITHM)
+            self.hash_size = compact_db.metadata.get("hash_size", DEFAULT_HASH_SIZE)
+        else:
+            with open(filepath, "r") as fin:
+                blockhash_db = json.load(fin)
             self.db_timestamp = blockhash_db["timestamp"]
             self.family_to_id = blockhash_db["family_to_id"]
             self.family_id_to_family = {int(k): v for k, v in blockhash_db["family_id_to_family"].items()}
             self.sample_id_to_sample = {int(k): v for k, v in blockhash_db["sample_id_to_sample"].items()}
-            self.blockhashes = {int(k): {int(ki): vi for ki, vi in v.items()} for k, v in blockhash_db["blockhashes"].items()}
+            self.base_id = blockhash_db.get("base_id", None)
+            self.hash_algorithm = blockhash_db.get("hash_algorithm", DEFAULT_HASH_ALGORITHM)
+            self.hash_size = blockhash_db.get("hash_size", DEFAULT_HASH_SIZE)
+            # nested dicts and lists of entries take 10-20x the memory of the raw data, so we keep the DB as in-memory CompactDb
+            sample_function_offsets = {int(k): v for k, v in blockhash_db.get("sample_function_offsets", {}).items()}
+            compact_db = CompactDb.fromJsonBlockhashes(blockhash_db.pop("blockhashes"), metadata={"hash_size": self.hash_size}, sample_function_offsets=sample_function_offsets)
+        self.sample_function_offsets = {}
+        self.blockhashes = compact_db
+        self.bucket_aggregates = {}
+        self._dirty_buckets = set()
+        self._applyDeltas(filepath)
+        self._changed_buckets = set()
+        self._added_sample_ids = set()
+        self.updateAggregates()
+
+    def loadShardedDb(self, sharded_db):
+        """ use a ShardedDb, e.g. with shards in worker processes via ShardedDb.open(path, use_processes=True) or remote via ShardedDb.connect(urls) """
+        self._numpy_matcher = None
+        self._sample_matcher = None
+        self._function_index = None
+        self.db_timestamp = sharded_db.metadata["timestamp"]
+        self.family_to_id = sharded_db.metadata["family_to_id"]
+        self.family_id_to_family = {int(k): v for k, v in sharded_db.metadata["family_id_to_family"].items()}
+        self.sample_id_to_sample = {int(k): v for k, v in sharded_db.metadata["sample_id_to_sample"].items()}
+        self.sample_function_offsets = {}
+        self.base_id = sharded_db.metadata["base_id"]
+        self.hash_algorithm = sharded_db.metadata.get("hash_algorithm", DEFAULT_HASH_ALGORITHM)
+        self.hash_size = sharded_db.metadata.get("hash_size", DEFAULT_HASH_SIZE)
+        self.blockhashes = sharded_db
+        self.bucket_aggregates = {}
+        self._dirty_buckets = set()
+        self._changed_buckets = set()
+        self._added_sample_ids = set()
+
+    def _applyDeltas(self, filepath):
+        """ apply all delta segments written for the DB at filepath on top of it """
+        for delta_path in getDeltaPaths(filepath):
+            with open(delta_path, "r") as fin:
+                delta = json.load(fin)
+            if delta["base_id"] != self.base_id:
+                LOG.warning("Ignoring delta segment %s, which was written for another version of the DB.", delta_path)
+                continue
+            self.db_timestamp = delta["timestamp"]
+            self.hash_algorithm = delta.get("hash_algorithm", self.hash_algorithm)
+            self.hash_size = delta.get("hash_size", self.hash_size)
+            self.family_to_id = delta["family_to_id"]
+            self.family_id_to_family = {int(k): v for k, v in delta["family_id_to_family"].items()}
+            self.sample_id_to_sample = {int(k): v for k, v in delta["sample_id_to_sample"].items()}
+            self.sample_function_offsets.update({int(k): v for k, v in delta.get("sample_function_offsets", {}).items()})
+            for blockhash, sizes in delta["blockhashes"].items():
+                for size, entries in sizes.items():
+                    self._setBucket(int(blockhash), int(size), entries)
+
+    def updateAggregates(self):
+        """ (re)compute the BucketAggregates for all buckets that changed since the last update """
+        if not isinstance(self.blockhashes, dict):
+            # aggregates are stored in the compact DB or computed by its overlay
+            return
+        for int_hash, int_size in self._dirty_buckets:
+            entries = self.blockhashes.get(int_hash, {}).get(int_size, None)
+            if entries is None:
+                self.bucket_aggregates.pop((int_hash, int_size), None)
+            else:
+                self.bucket_aggregates[(int_hash, int_size)] = aggregateEntries(entries)
+        self._dirty_buckets = set()
+
+    def _lookupAggregate(self, int_hash, int_size):
+        """ return a tuple (is_hash_known, BucketAggregate or None) for key (int_hash, int_size) """
+        if not isinstance(self.blockhashes, dict):
+            return self.blockhashes.lookupAggregate(int_hash, int_size)
+        if int_hash not in self.blockhashes:
+            return False, None
+        return True, self.bucket_aggregates.get((int_hash, int_size), None)
+
+    def _lookupAggregates(self, keys):
+        """ return a tuple (is_hash_known, BucketAggregate or None) for each (int_hash, int_size) in keys """
+        if isinstance(self.blockhashes, ShardedDb):
+            # one round trip per shard instead of one per key
+            return self.blockhashes.lookupAggregates(keys)
+        return [self._lookupAggregate(int_hash, int_size) for int_hash, int_size in keys]
 
     def saveDb(self, filepath):
-        """ save the current database of blockhashes """
-        with open(filepath, "w") as fout:
+        """ save the current database of blockhashes, which replaces the DB at filepath along with its delta segments """
+        self.updateAggregates()
+        base_id = uuid.uuid4().hex
+        # write to a new file, as the DB we replace may still be memory-mapped
+        with open(filepath + ".tmp", "w") as fout:
             json_db = {
                 "timestamp": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "base_id": base_id,
+                "hash_algorithm": self.hash_algorithm,
+                "hash_size": self.hash_size,
                 "family_to_id": self.family_to_id,
                 "family_id_to_family": self.family_id_to_family,
                 "sample_id_to_sample": self.sample_id_to_sample,
-                "blockhashes": self.blockhashes,
+                "sample_function_offsets": self.getAllFunctionOffsets(),
+                "blockhashes": self.blockhashes if isinstance(self.blockhashes, dict) else self.blockhashes.toBlockhashes(),
             }
             json.dump(json_db, fout)
+        self._replaceBase(filepath, base_id)
+
+    def saveCompactDb(self, filepath):
+        """ save the current database of blockhashes in the compact, memory-mappable format, see saveDb() """
+        base_id = uuid.uuid4().hex
+        metadata = {
+            "timestamp": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "base_id": base_id,
+            "hash_algorithm": self.hash_algorithm,
+            "hash_size": self.hash_size,
+            "family_to_id": self.family_to_id,
+            "family_id_to_family": self.family_id_to_family,
+            "sample_id_to_sample": self.sample_id_to_sample,
+        }
+        compact_db = CompactDb.fromBlockhashes(self.blockhashes, metadata=metadata, sample_function_offsets=self.getAllFunctionOffsets())
+        compact_db.write(filepath + ".tmp")
+        self._replaceBase(filepath, base_id)
+
+    def _replaceBase(self, filepath, base_id):
+        """ the new base contains all changes, so remaining deltas would be ignored anyway by their base_id """
+        os.replace(filepath + ".tmp", filepath)
+        removeDeltas(filepath)
+        self.base_id = base_id
+        self._changed_buckets = set()
+        self._added_sample_ids = set()
+
+    def saveDelta(self, filepath):
+        """ write the buckets changed since loading or saving the DB at filepath as its next delta segment and return its path """
+        blockhashes = {}
+        for int_hash, int_size in sorted(self._changed_buckets):
+            blockhashes.setdefault(int_hash, {})[int_size] = self.blockhashes.get(int_hash, {}).get(int_size, [])
+        timestamp = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        delta = {
+            "timestamp": timestamp,
+            "base_id": self.base_id,
+            "hash_algorithm": self.hash_algorithm,
+            "hash_size": self.hash_size,
+            "family_to_id": self.family_to_id,
+            "family_id_to_family": self.family_id_to_family,
+            "sample_id_to_sample": self.sample_id_to_sample,
+            "sample_function_offsets": {sample_id: self.sample_function_offsets[sample_id] for sample_id in sorted(self._added_sample_ids) if sample_id in self.sample_function_offsets},
+            "blockhashes": blockhashes,
+        }
+        delta_path = getNextDeltaPath(filepath)
+        with open(delta_path + ".tmp", "w") as fout:
+            json.dump(delta, fout)
+        os.replace(delta_path + ".tmp", delta_path)
+        self.db_timestamp = timestamp
+        self._changed_buckets = set()
+        self._added_sample_ids = set()
+        return delta_path
+
+    def compactDb(self, filepath):
+        """ merge all delta segments into the DB at filepath, as loaded into this matcher, keeping its format """
+        if CompactDb.isCompactDb(filepath):
+            self.saveCompactDb(filepath)
+        else:
+            self.saveDb(filepath)
+
+    def getFunctionOffsets(self, sample_id):
+        """ return the function addresses of a sample, indexed by function ID, or None if they are not known """
+        if sample_id not in self.sample_id_to_sample:
+            return None
+        if sample_id in self.sample_function_offsets:
+            return self.sample_function_offsets[sample_id]
+        base = self.blockhashes.base if isinstance(self.blockhashes, OverlayDb) else self.blockhashes
+        return base.getFunctionOffsets(sample_id) if isinstance(base, CompactDb) else None
+
+    def getAllFunctionOffsets(self):
+        all_function_offsets = {}
+        for sample_id in self.sample_id_to_sample:
+            function_offsets = self.getFunctionOffsets(sample_id)
+            if function_offsets is not None:
+                all_function_offsets[sample_id] = function_offsets
+        return all_function_offsets
 
     def getDbStats(self):
         """ return statistics for currently loaded DB """
@@ -111,23 +403,237 @@ class BlockHashMatcher(object):
             "hash_size_counts": dict(hash_size_counts)
         }
 
-    def match(self, blockhash_report):
-        """ match a blockhash report against the database """
-        match_report = {
-            "num_families": len(self.family_to_id),
+    def match(self, blockhash_report, engine="python", weighting="bucket"):
+        """
+        match a blockhash report against the database, using either the "python" or the vectorized "numpy" engine.
+        weighting "bucket" scores each matched (hash, size) once, "occurrence" weights it by the number of functions it occurs in.
+        """
+        if weighting not in WEIGHTINGS:
+            raise ValueError(f"Unknown weighting: {weighting}")
+        self._checkHashFunction(blockhash_report)
+        self.updateAggregates()
+        if engine == "numpy":
+            scores = self._getNumpyMatcher().score(blockhash_report, weighting=weighting)
+        elif engine == "python":
+            scores = self._scoreBlockhashes(blockhash_report, weighting=weighting)
+        else:
+            raise ValueError(f"Unknown matching engine: {engine}")
+        return self._buildMatchReport(blockhash_report, scores)
+
+    def findSimilarSamples(self, blockhash_report, max_candidates=None):
+        """ return samples likely similar to a blockhash report via the MinHash LSH index, with their estimated Jaccard similarity """
+        self._checkHashFunction(blockhash_report)
+        sample_matcher = self._getSampleMatcher()
+        minhash_index = sample_matcher.getMinHashIndex()
+        signature = blockhash_report.get("minhash", None)
+        if signature is None or len(signature) != len(minhash_index.permutations):
+            signature = minhash_index.computeSignature(self._getReportKeys(blockhash_report)[0])
+        return [{
+            "sample_id": sample_id,
+            "sample": self.sample_id_to_sample[sample_id],
+            "family": self.family_id_to_family[sample_matcher.sample_family_ids[sample_id]],
+            "estimated_jaccard": estimated_jaccard,
+        } for sample_id, estimated_jaccard in minhash_index.query(signature, max_candidates=max_candidates)]
+
+    def matchSamples(self, blockhash_report, top_k=DEFAULT_TOP_K, ranking="bytes", use_lsh=False):
+        """
+        return the top_k samples of the database closest to a blockhash report, ranked by the bytes of blocks they share ("bytes")
+        or by the shared bytes relative to the bytes of both, the input and the sample ("jaccard").
+        With use_lsh, only the candidates of findSimilarSamples() are scored, which is approximate but independent of the size of the DB.
+        """
+        self._checkHashFunction(blockhash_report)
+        keys, _ = self._getReportKeys(blockhash_report)
+        sample_matcher = self._getSampleMatcher()
+        candidate_ids = [candidate["sample_id"] for candidate in self.findSimilarSamples(blockhash_report)] if use_lsh else None
+        input_bytes = sum(int_size for _, int_size in keys)
+        sample_report = {
             "num_samples": len(self.sample_id_to_sample),
-            "num_blockhashes": len(self.blockhashes),
-            "bitness": blockhash_report['bitness'],
-            "sha256": blockhash_report['sha256'],
-            "input_filename": blockhash_report['filename'],
-            "input_block_bytes": blockhash_report['block_bytes'],
-            "input_block_hashes": len(blockhash_report['blockhashes']),
-            "unmatched_score": 0,
-            "unmatched_hashes": 0,
-            "family_matches": []
+            "sha256": blockhash_report["sha256"],
+            "input_filename": blockhash_report["filename"],
+            "input_key_bytes": input_bytes,
+            "ranking": ranking,
+            "num_candidates": len(candidate_ids) if use_lsh else None,
+            "sample_matches": []
         }
-        LOG.debug(f"Using {len(self.family_to_id)} families, {len(self.sample_id_to_sample)} samples with {len(self.blockhashes)} hashes for matching.")
-        sample_matches = defaultdict(int)
+        for index, (sample_id, matched_bytes) in enumerate(sample_matcher.rank(keys, top_k=top_k, ranking=ranking, candidate_ids=candidate_ids), start=1):
+            sample_bytes = sample_matcher.sample_bytes[sample_id]
+            sample_report["sample_matches"].append({
+                "index": index,
+                "sample_id": sample_id,
+                "sample": self.sample_id_to_sample[sample_id],
+                "family": self.family_id_to_family[sample_matcher.sample_family_ids[sample_id]],
+                "matched_bytes": matched_bytes,
+                "sample_bytes": sample_bytes,
+                "input_perc": 100 * matched_bytes / input_bytes,
+                "sample_perc": 100 * matched_bytes / sample_bytes,
+                "jaccard": matched_bytes / (input_bytes + sample_bytes - matched_bytes),
+            })
+        return sample_report
+
+    def matchFunctions(self, blockhash_report, top_k=DEFAULT_FUNCTION_TOP_K, max_postings=DEFAULT_MAX_POSTINGS):
+        """
+        return the top_k known functions for each function of a blockhash report, ranked by the bytes of blocks they share
+        relative to the bytes of both functions. Blocks found in more than max_postings known functions are not matched.
+        """
+        self._checkHashFunction(blockhash_report)
+        function_index = self._getFunctionIndex()
+        input_function_offsets = blockhash_report.get("function_offsets", None)
+        sample_function_offsets = {}
+        function_report = {
+            "sha256": blockhash_report["sha256"],
+            "input_filename": blockhash_report["filename"],
+            "num_functions": len(function_index),
+            "function_matches": []
+        }
+        for fid, (block_bytes, matches) in sorted(function_index.match(blockhash_report, top_k=top_k, max_postings=max_postings).items()):
+            function_match = {
+                "fid": fid,
+                "function_offset": input_function_offsets[fid] if input_function_offsets is not None else None,
+                "block_bytes": block_bytes,
+                "matches": []
+            }
+            for function_id, matched_bytes, jaccard in matches:
+                sample_id = int(function_index.function_sample_ids[function_id])
+                function_fid = int(function_index.function_fids[function_id])
+                if sample_id not in sample_function_offsets:
+                    sample_function_offsets[sample_id] = self.getFunctionOffsets(sample_id)
+                function_match["matches"].append({
+                    "sample_id": sample_id,
+                    "sample": self.sample_id_to_sample[sample_id],
+                    "family": self.family_id_to_family[int(function_index.function_family_ids[function_id])],
+                    "fid": function_fid,
+                    "function_offset": sample_function_offsets[sample_id][function_fid] if sample_function_offsets[sample_id] is not None else None,
+                    "matched_bytes": matched_bytes,
+                    "function_bytes": int(function_index.function_bytes[function_id]),
+                    "jaccard": jaccard,
+                })
+            function_report["function_matches"].append(function_match)
+        return function_report
+
+    def matchLeavingOut(self, blockhash_report, sample_ids, weighting="bucket"):
+        """
+        match a blockhash report as if the given samples were removed from the database, e.g. the samples it was loaded as.
+        Only the buckets of the report are aggregated again without their entries, scores are identical to removing the samples.
+        """
+        if weighting not in WEIGHTINGS:
+            raise ValueError(f"Unknown weighting: {weighting}")
+        if isinstance(self.blockhashes, ShardedDb):
+            raise ValueError("Leaving out samples requires the entries of the DB, which are not available for sharded DBs.")
+        self._checkHashFunction(blockhash_report)
+        self.updateAggregates()
+        sample_ids = set(sample_ids)
+        keys, occurrences = self._getReportKeys(blockhash_report)
+        lookups = [self._lookupAggregateLeavingOut(int_hash, int_size, sample_ids) for int_hash, int_size in keys]
+        return self._buildMatchReport(blockhash_report, self._accumulateScores(keys, occurrences, lookups, weighting=weighting))
+
+    def _lookupAggregateLeavingOut(self, int_hash, int_size, sample_ids):
+        """ like _lookupAggregate(), but without the entries of sample_ids """
+        sizes = self.blockhashes.get(int_hash, None)
+        if not sizes:
+            return False, None
+        entries = sizes.get(int_size, [])
+        remaining_entries = [entry for entry in entries if entry[1] not in sample_ids]
+        if remaining_entries:
+            if len(remaining_entries) == len(entries):
+                return self._lookupAggregate(int_hash, int_size)
+            return True, aggregateEntries(remaining_entries)
+        return any(entry[1] not in sample_ids for entries in sizes.values() for entry in entries), None
+
+    def matchMany(self, blockhash_reports, engine="python", weighting="bucket", batch_size=DEFAULT_BATCH_SIZE):
+        """
+        match an iterable of blockhash reports, yielding their match reports in order as soon as their batch is scored.
+        Within a batch of batch_size reports, each distinct (hash, size) is resolved against the DB only once.
+        The match reports are identical to those of match().
+        """
+        if weighting not in WEIGHTINGS:
+            raise ValueError(f"Unknown weighting: {weighting}")
+        if engine not in ["python", "numpy"]:
+            raise ValueError(f"Unknown matching engine: {engine}")
+        self.updateAggregates()
+        batch = []
+        for blockhash_report in blockhash_reports:
+            batch.append(blockhash_report)
+            if len(batch) >= batch_size:
+                yield from self._matchBatch(batch, engine, weighting)
+                batch = []
+        if batch:
+            yield from self._matchBatch(batch, engine, weighting)
+
+    def _matchBatch(self, blockhash_reports, engine, weighting):
+        for blockhash_report in blockhash_reports:
+            self._checkHashFunction(blockhash_report)
+        if engine == "numpy":
+            all_scores = self._getNumpyMatcher().scoreMany(blockhash_reports, weighting=weighting)
+            for blockhash_report, scores in zip(blockhash_reports, all_scores):
+                yield self._buildMatchReport(blockhash_report, scores)
+            return
+        report_keys = [self._getReportKeys(blockhash_report) for blockhash_report in blockhash_reports]
+        distinct_keys = list(dict.fromkeys(key for keys, _ in report_keys for key in keys))
+        resolved = dict(zip(distinct_keys, self._lookupAggregates(distinct_keys)))
+        for blockhash_report, (keys, occurrences) in zip(blockhash_reports, report_keys):
+            scores = self._accumulateScores(keys, occurrences, [resolved[key] for key in keys], weighting=weighting)
+            yield self._buildMatchReport(blockhash_report, scores)
+
+    def _getCompactDb(self):
+        """ the DB in its array representation, which we build once if it was loaded as dict or has uncompacted changes """
+        if isinstance(self.blockhashes, CompactDb):
+            return self.blockhashes
+        for view in [self._numpy_matcher, self._sample_matcher, self._function_index]:
+            if view is not None:
+                return view.compact_db
+        return CompactDb.fromBlockhashes(self.blockhashes, metadata={"hash_size": self.hash_size})
+
+    def _getNumpyMatcher(self):
+        if isinstance(self.blockhashes, ShardedDb):
+            raise ValueError("The numpy engine is not available for sharded DBs.")
+        if self._numpy_matcher is None:
+            self._numpy_matcher = NumpyMatcher(self._getCompactDb())
+        return self._numpy_matcher
+
+    def _getSampleMatcher(self):
+        if isinstance(self.blockhashes, ShardedDb):
+            raise ValueError("Sample matching is not available for sharded DBs.")
+        if self._sample_matcher is None:
+            self._sample_matcher = SampleMatcher(self._getCompactDb())
+        return self._sample_matcher
+
+    def _getFunctionIndex(self):
+        if isinstance(self.blockhashes, ShardedDb):
+            raise ValueError("Function matching is not available for sharded DBs.")
+        if self._function_index is None:
+            self._function_index = FunctionIndex(self._getCompactDb())
+        return self._function_index
+
+    def _checkHashFunction(self, blockhash_report):
+        """ raise if the blockhashes of a report are not comparable to those of the DB """
+        # reports from before the hash function was selectable were all hashed with 32 bit sha256
+        hash_algorithm = blockhash_report.get("hash_algorithm", DEFAULT_HASH_ALGORITHM)
+        if hash_algorithm != self.hash_algorithm:
+            raise ValueError(f"{blockhash_report['filename']} was hashed with {hash_algorithm}, but the DB uses {self.hash_algorithm}.")
+        hash_size = blockhash_report.get("hash_size", DEFAULT_HASH_SIZE)
+        if hash_size != self.hash_size:
+            raise ValueError(f"{blockhash_report['filename']} has {8 * hash_size} bit hashes, but the DB uses {8 * self.hash_size} bit hashes.")
+
+    @staticmethod
+    def _getReportKeys(blockhash_report):
+        """ return the (hash, size) keys of a report in report order and the number of functions each of them occurs in """
+        keys = []
+        occurrences = []
+        for blockhash, data in blockhash_report["blockhashes"].items():
+            int_hash = int(blockhash)
+            for size, fids in data.items():
+                if fids:
+                    keys.append((int_hash, int(size)))
+                    occurrences.append(len(fids))
+        return keys, occurrences
+
+    def _scoreBlockhashes(self, blockhash_report, weighting="bucket"):
+        """ accumulate per family scores for all blockhashes of a report, looking up each (hash, size) bucket exactly once """
+        keys, occurrences = self._getReportKeys(blockhash_report)
+        return self._accumulateScores(keys, occurrences, self._lookupAggregates(keys), weighting=weighting)
+
+    def _accumulateScores(self, keys, occurrences, lookups, weighting="bucket"):
+        """ accumulate per family scores from the (is_hash_known, BucketAggregate) lookups for the keys of a report """
         # bytes
         family_bytes = defaultdict(int)
         non_library_bytes = defaultdict(int)
@@ -140,44 +646,69 @@ class BlockHashMatcher(object):
         unique_family_blocks = defaultdict(int)
         unmatched_score = 0
         unmatched_blocks = 0
-        for blockhash, data in blockhash_report["blockhashes"].items():
-            int_hash = int(blockhash)
-            for size, fids in data.items():
-                int_size = int(size)
-                family_ids = set()
-                sample_ids = set()
-                for fid in fids:
-                    if int_hash in self.blockhashes:
-                        if int_size in self.blockhashes[int_hash]:
-                            families = set([entry[0] for entry in self.blockhashes[int_hash][int_size]])
-                            has_library = any([entry[3] for entry in self.blockhashes[int_hash][int_size]])
-                            family_adjustment_value = 1 if len(families) < 3 else 1 + int(math.log(len(families), 2))
-                            for entry in self.blockhashes[int_hash][int_size]:
-                                family_id, sample_id, fid, is_library = entry
-                                if family_id not in family_ids:
-                                    family_ids.add(family_id)
-                                    family_bytes[family_id] += int_size
-                                    family_blocks[family_id] += 1
-                                    if not has_library:
-                                        non_library_bytes[family_id] += int_size
-                                        non_library_blocks[family_id] += 1
-                                        adj_family_bytes[family_id] += int_size / family_adjustment_value
-                                        adj_family_blocks[family_id] += 1 / family_adjustment_value
-                                        if len(families) == 1:
-                                            unique_family_bytes[family_id] += int_size
-                                            unique_family_blocks[family_id] += 1
-                                    else:
-                                        # TODO we could collect the function names of functions we potentially recognize here.
-                                        pass
-                                # TODO make use of sample matches in the output
-                                if sample_id not in sample_ids:
-                                    sample_ids.add(sample_id)
-                                    sample_matches[sample_id] += int_size
-                        else:
-                            unmatched_score += int_size
-                    else:
-                        unmatched_score += int_size
-                        unmatched_blocks += 1
+        # scores are accumulated in report order, which keeps float sums and the order of first matched families stable
+        for (int_hash, int_size), num_occurrences, (is_hash_known, aggregate) in zip(keys, occurrences, lookups):
+            weight = num_occurrences if weighting == "occurrence" else 1
+            if aggregate is None:
+                # unmatched blocks are always accounted per function they occur in
+                unmatched_score += int_size * num_occurrences
+                if not is_hash_known:
+                    unmatched_blocks += num_occurrences
+                continue
+            weighted_size = int_size * weight
+            for family_id in aggregate.families:
+                family_bytes[family_id] += weighted_size
+                family_blocks[family_id] += weight
+                if not aggregate.has_library:
+                    non_library_bytes[family_id] += weighted_size
+                    non_library_blocks[family_id] += weight
+                    adj_family_bytes[family_id] += weighted_size / aggregate.adjustment_value
+                    adj_family_blocks[family_id] += weight / aggregate.adjustment_value
+                    if aggregate.is_unique:
+                        unique_family_bytes[family_id] += weighted_size
+                        unique_family_blocks[family_id] += weight
+                else:
+                    # TODO we could collect the function names of functions we potentially recognize here.
+                    pass
+        return {
+            "family_bytes": family_bytes,
+            "family_blocks": family_blocks,
+            "non_library_bytes": non_library_bytes,
+            "non_library_blocks": non_library_blocks,
+            "adj_family_bytes": adj_family_bytes,
+            "adj_family_blocks": adj_family_blocks,
+            "unique_family_bytes": unique_family_bytes,
+            "unique_family_blocks": unique_family_blocks,
+            "unmatched_score": unmatched_score,
+            "unmatched_blocks": unmatched_blocks,
+        }
+
+    def _buildMatchReport(self, blockhash_report, scores):
+        """ turn accumulated per family scores into a match report, families with equal scores keep the order in which they were first matched """
+        match_report = {
+            "num_families": len(self.family_to_id),
+            "num_samples": len(self.sample_id_to_sample),
+            "num_blockhashes": len(self.blockhashes),
+            "bitness": blockhash_report['bitness'],
+            "sha256": blockhash_report['sha256'],
+            "input_filename": blockhash_report['filename'],
+            "input_block_bytes": blockhash_report['block_bytes'],
+            "input_block_hashes": len(blockhash_report['blockhashes']),
+            "unmatched_score": 0,
+            "unmatched_hashes": 0,
+            "family_matches": []
+        }
+        LOG.debug(f"Using {len(self.family_to_id)} families, {len(self.sample_id_to_sample)} samples with {len(self.blockhashes)} hashes for matching.")
+        family_bytes = scores["family_bytes"]
+        family_blocks = scores["family_blocks"]
+        non_library_bytes = scores["non_library_bytes"]
+        non_library_blocks = scores["non_library_blocks"]
+        adj_family_bytes = scores["adj_family_bytes"]
+        adj_family_blocks = scores["adj_family_blocks"]
+        unique_family_bytes = scores["unique_family_bytes"]
+        unique_family_blocks = scores["unique_family_blocks"]
+        unmatched_score = scores["unmatched_score"]
+        unmatched_blocks = scores["unmatched_blocks"]
         match_report["unmatched_score"] = unmatched_score
         match_report["unmatched_blocks"] = unmatched_blocks
         LOG.debug(f"Input: {blockhash_report['filename']} ({blockhash_report['family']}/{blockhash_report['version']}) - {blockhash_report['block_bytes']:,d} bytes.")
@@ -187,9 +718,9 @@ class BlockHashMatcher(object):
         LOG.debug("*" * 93)
         LOG.debug(f"{'#':>2}: {'id':>5} | {'family':>30} | {'bytescore':>9} | {'%':>6} | {'nolib%':>6} | {'adj%':>6} | {'uniq%':>6}")
         for family_id, direct_bytes in sorted(family_bytes.items(), key=lambda x: x[1], reverse=True):
-            nonlib_bytes = non_library_bytes[family_id]
-            adj_bytes = adj_family_bytes[family_id]
-            unique_bytes = unique_family_bytes[family_id]
+            nonlib_bytes = non_library_bytes.get(family_id, 0)
+            adj_bytes = adj_family_bytes.get(family_id, 0)
+            unique_bytes = unique_family_bytes.get(family_id, 0)
             family_result = {
                 "index": index,
                 "family": self.family_id_to_family[family_id],
@@ -197,13 +728,13 @@ class BlockHashMatcher(object):
                 "direct_blocks": family_blocks[family_id],
                 "direct_perc": 100 * direct_bytes / blockhash_report['block_bytes'],
                 "nonlib_bytes": int(nonlib_bytes),
-                "nonlib_blocks": non_library_blocks[family_id],
+                "nonlib_blocks": non_library_blocks.get(family_id, 0),
                 "nonlib_perc": 100 * nonlib_bytes / blockhash_report['block_bytes'],
                 "freq_bytes": int(adj_bytes),
-                "freq_blocks": adj_family_blocks[family_id],
+                "freq_blocks": adj_family_blocks.get(family_id, 0),
                 "freq_perc": 100 * adj_bytes / blockhash_report['block_bytes'],
                 "uniq_bytes": int(unique_bytes),
-                "uniq_blocks": unique_family_blocks[family_id],
+                "uniq_blocks": unique_family_blocks.get(family_id, 0),
                 "uniq_perc": 100 * unique_bytes / blockhash_report['block_bytes']
             }
             match_report["family_matches"].append(family_result)
@@ -228,20 +759,19 @@ if __name__ == "__main__":
             matcher.loadDb("db/picblocksdb.json")
         else:
             print("No cached DB found, aggregating blockhash reports...")
-            dir_iter = tqdm.tqdm(os.listdir(blocks_path)) if tqdm is not None else os.listdir(blocks_path)
-            for filename in dir_iter:
-                if filename.endswith(".blocks"):
-                    matcher.load(blocks_path + os.sep + filename)
-            print("saving DB...")
-            matcher.saveDb("db/picblocksdb.json")
+            DbBuilder().build(getReportPaths(blocks_path), "db/picblocksdb.json")
+            matcher.loadDb("db/picblocksdb.json")
         blockhash_report = hasher.processFile(target)
         print(f"#> hashed input file: {blockhash_report['num_hashes']} hashes covering {blockhash_report['block_bytes']} bytes.")
         matcher.match(blockhash_report)
+        for sample_match in matcher.matchSamples(blockhash_report)["sample_matches"]:
+            print(f"#> closest sample {sample_match['index']:>2}: {sample_match['sample']} ({sample_match['family']}) - {sample_match['matched_bytes']} bytes, jaccard {sample_match['jaccard']:.3f}")
+        # the function index is optional, like the numpy engine
+        if np is not None:
+            function_matches = [function_match for function_match in matcher.matchFunctions(blockhash_report, top_k=1)["function_matches"] if function_match["matches"]]
+            print(f"#> {len(function_matches)} input functions match known functions.")
+        else:
+            print("#> numpy is not installed, skipping function matches.")
     else:
         print("Aggregating blockhash reports to create a new DB...")
-        dir_iter = tqdm.tqdm(os.listdir(blocks_path)) if tqdm is not None else os.listdir(blocks_path)
-        for filename in dir_iter:
-            if filename.endswith(".blocks"):
-                matcher.load(blocks_path + os.sep + filename)
-        print("saving DB...")
-        matcher.saveDb("db/picblocksdb.json")
+        DbBuilder().build(getReportPaths(blocks_path), "db/picblocksdb.json")
@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import lzma
+import zlib
+import struct
+import logging
+import argparse
+from collections import namedtuple
+
+# Only do basicConfig if no handlers have been configured
+if len(logging._handlerList) == 0:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
+
+MAGIC = b"PICBLKRP"
+FORMAT_VERSION = 1
+# magic, format version, hash size in bytes, compression, length of the JSON metadata that follows
+HEADER_FORMAT = "<8sBBBxI"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# index of the compression in the header
+COMPRESSIONS = ["none", "zlib", "lzma"]
+DEFAULT_COMPRESSION = "zlib"
+# records are (hash, size, fid), one per function a block occurs in
+RECORD_FORMATS = {4: struct.Struct("<III"), 8: struct.Struct("<QII")}
+# bytes read from file and records packed per write, which bounds the memory used for streaming
+CHUNK_SIZE = 2 ** 20
+RECORDS_PER_CHUNK = 2 ** 14
+# a binary block report embedded in a larger file, e.g. a report archive, which readBlockReport() accepts in place of a path
+BlockReportLocation = namedtuple("BlockReportLocation", ["filepath", "offset", "length"])
+
+
+def isBinaryBlockReport(filepath):
+    with open(filepath, "rb") as fin:
+        return fin.read(len(MAGIC)) == MAGIC
+
+
+def _createCompressor(compression):
+    if compression == "zlib":
+        return zlib.compressobj()
+    if compression == "lzma":
+        return lzma.LZMACompressor()
+    return None
+
+
+def _createDecompressor(compression):
+    if compression == "zlib":
+        return zlib.decompressobj()
+    if compression == "lzma":
+        return lzma.LZMADecompressor()
+    return None
+
+
+class BlockReportWriter(object):
+    """
+    Streaming writer of binary block reports: a header with all fields of the report but its blockhashes as JSON metadata,
+    followed by packed (hash, size, fid) records, optionally compressed. Records of the same hash have to be written consecutively.
+    """
+
+    def __init__(self, fout, metadata, compression=DEFAULT_COMPRESSION):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression: {compression}")
+        self.hash_size = metadata.get("hash_size", 4)
+        self._record_format = RECORD_FORMATS[self.hash_size]
+        self._compressor = _createCompressor(compression)
+        self._records = []
+        encoded_metadata = json.dumps(metadata, sort_keys=True).encode("utf-8")
+        self._fout = fout
+        self._fout.write(struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, self.hash_size, COMPRESSIONS.index(compression), len(encoded_metadata)))
+        self._fout.write(encoded_metadata)
+
+    def write(self, blockhash, size, fids):
+        for fid in fids:
+            self._records.append((blockhash, size, fid))
+        if len(self._records) >= RECORDS_PER_CHUNK:
+            self._flush()
+
+    def _flush(self):
+        packed = b"".join(self._record_format.pack(*record) for record in self._records)
+        self._records = []
+        self._fout.write(self._compressor.compress(packed) if self._compressor is not None else packed)
+
+    def finish(self):
+        """ write all pending records, the file itself remains open """
+        self._flush()
+        if self._compressor is not None:
+            self._fout.write(self._compressor.flush())
+
+
+class PackedBlockhashes(object):
+    """
+    The blockhashes of a binary block report, which are streamed from file whenever they are iterated.
+    items() yields (hash, {size: [fids]}) like the "blockhashes" dict of a JSON report, but with int keys and one hash at a time,
+    so that BlockHashMatcher.load() and match() can consume the report without building its nested dict.
+    """
+
+    def __init__(self, filepath, data_start, hash_size, compression, data_end=None):
+        self.filepath = filepath
+        self.data_start = data_start
+        self.data_end = data_end
+        self.hash_size = hash_size
+        self.compression = compression
+        self._num_hashes = None
+
+    def _iterateChunks(self, fin):
+        fin.seek(self.data_start)
+        if self.data_end is None:
+            yield from iter(lambda: fin.read(CHUNK_SIZE), b"")
+            return
+        remaining = self.data_end - self.data_start
+        while remaining > 0:
+            chunk = fin.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    def iterateRecords(self):
+        """ yield all (hash, size, fid) records in file order """
+        record_format = RECORD_FORMATS[self.hash_size]
+        decompressor = _createDecompressor(self.compression)
+        remainder = b""
+        with open(self.filepath, "rb") as fin:
+            for chunk in self._iterateChunks(fin):
+                data = remainder + (decompressor.decompress(chunk) if decompressor is not None else chunk)
+                usable = len(data) - len(data) % record_format.size
+                yield from record_format.iter_unpack(data[:usable])
+                remainder = data[usable:]
+        if remainder:
+            raise ValueError(f"{self.filepath} ends with a truncated record.")
+
+    def items(self):
+        current_hash = None
+        sizes = {}
+        for blockhash, size, fid in self.iterateRecords():
+            if blockhash != current_hash:
+                if sizes:
+                    yield current_hash, sizes
+                current_hash = blockhash
+                sizes = {}
+            sizes.setdefault(size, []).append(fid)
+        if sizes:
+            yield current_hash, sizes
+
+    def __iter__(self):
+        return (blockhash for blockhash, _ in self.items())
+
+    def __len__(self):
+        if self._num_hashes is None:
+            self._num_hashes = sum(1 for _ in self.items())
+        return self._num_hashes
+
+    def toDict(self):
+        """ return the blockhashes as nested dict with int keys like BlockHasher, which json.dump() sorts numerically """
+        return dict(self.items())
+
+
+def readBinaryBlockReport(filepath, offset=0, length=None):
+    """ return the report (at offset within filepath) with its blockhashes as PackedBlockhashes, only the header is read """
+    with open(filepath, "rb") as fin:
+        fin.seek(offset)
+        magic, format_version, hash_size, compression_index, metadata_length = struct.unpack(HEADER_FORMAT, fin.read(HEADER_SIZE))
+        if magic != MAGIC:
+            raise ValueError(f"{filepath} is not a binary block report.")
+        if format_version != FORMAT_VERSION:
+            raise ValueError(f"{filepath} uses unsupported format version {format_version}.")
+        blockhash_report = json.loads(fin.read(metadata_length).decode("utf-8"))
+    data_end = offset + length if length is not None else None
+    blockhash_report["blockhashes"] = PackedBlockhashes(filepath, offset + HEADER_SIZE + metadata_length, hash_size, COMPRESSIONS[compression_index], data_end=data_end)
+    return blockhash_report
+
+
+def readBlockReport(report_path):
+    """ read a block report in either format from a path or a BlockReportLocation, binary reports are streamed upon iteration of their blockhashes """
+    if isinstance(report_path, BlockReportLocation):
+        return readBinaryBlockReport(report_path.filepath, offset=report_path.offset, length=report_path.length)
+    if isBinaryBlockReport(report_path):
+        return readBinaryBlockReport(report_path)
+    with open(report_path, "r") as fin:
+        return json.load(fin)
+
+
+def packBlockReport(blockhash_report, fout, compression=DEFAULT_COMPRESSION):
+    """ write a report in binary format to a file opened for binary writing, at its current position """
+    metadata = {key: value for key, value in blockhash_report.items() if key != "blockhashes"}
+    writer = BlockReportWriter(fout, metadata, compression=compression)
+    for blockhash, sizes in blockhash_report["blockhashes"].items():
+        for size, fids in sizes.items():
+            writer.write(int(blockhash), int(size), fids)
+    writer.finish()
+
+
+def writeBinaryBlockReport(blockhash_report, filepath, compression=DEFAULT_COMPRESSION):
+    with open(filepath, "wb") as fout:
+        packBlockReport(blockhash_report, fout, compression=compression)
+
+
+def writeJsonBlockReport(blockhash_report, filepath):
+    if isinstance(blockhash_report["blockhashes"], PackedBlockhashes):
+        blockhash_report = dict(blockhash_report, blockhashes=blockhash_report["blockhashes"].toDict())
+    with open(filepath, "w") as fout:
+        json.dump(blockhash_report, fout, indent=1, sort_keys=True)
+
+
+def convertBlockReport(input_filepath, output_filepath, compression=DEFAULT_COMPRESSION):
+    """ convert a JSON block report into a binary one and vice versa, return True if the output is binary """
+    blockhash_report = readBlockReport(input_filepath)
+    if isinstance(blockhash_report["blockhashes"], PackedBlockhashes):
+        writeJsonBlockReport(blockhash_report, output_filepath + ".tmp")
+        is_binary = False
+    else:
+        writeBinaryBlockReport(blockhash_report, output_filepath + ".tmp", compression=compression)
+        is_binary = True
+    os.replace(output_filepath + ".tmp", output_filepath)
+    return is_binary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert JSON block reports into binary block reports and vice versa, depending on the format of each input.")
+    parser.add_argument("input_path", help="block report or directory of block reports (*.blocks) to convert.")
+    parser.add_argument("output_path", help="output block report or directory, may be the same as the input to convert in place.")
+    parser.add_argument("-c", "--compression", choices=COMPRESSIONS, default=DEFAULT_COMPRESSION, help=f"compression of binary reports (default: {DEFAULT_COMPRESSION}).")
+    args = parser.parse_args()
+    if os.path.isdir(args.input_path):
+        os.makedirs(args.output_path, exist_ok=True)
+        conversions = [(os.path.join(args.input_path, filename), os.path.join(args.output_path, filename)) for filename in sorted(os.listdir(args.input_path)) if filename.endswith(".blocks")]
+    else:
+        conversions = [(args.input_path, args.output_path)]
+    input_bytes = 0
+    output_bytes = 0
+    for input_filepath, output_filepath in conversions:
+        input_bytes += os.path.getsize(input_filepath)
+        is_binary = convertBlockReport(input_filepath, output_filepath, compression=args.compression)
+        output_bytes += os.path.getsize(output_filepath)
+        LOG.info("converted %s to %s report %s", input_filepath, "binary" if is_binary else "JSON", output_filepath)
+    print(f"converted {len(conversions)} block reports from {input_bytes} to {output_bytes} bytes")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
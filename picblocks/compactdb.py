@@ -0,0 +1,340 @@
+import sys
+import json
+import mmap
+import struct
+import bisect
+import logging
+from array import array
+
+try:
+    # numpy is optional and only speeds up scanning the entry columns
+    import numpy as np
+except ImportError:
+    np = None
+
+from .aggregates import BucketAggregate, aggregateEntries
+
+# Only do basicConfig if no handlers have been configured
+if len(logging._handlerList) == 0:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
+
+MAGIC = b"PICBLKDB"
+FORMAT_VERSION = 2
+# magic, format version, length of the JSON metadata that follows
+HEADER_FORMAT = "<8sII"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+SECTION_ALIGNMENT = 8
+# bits in the bucket_flags column
+FLAG_HAS_LIBRARY = 1
+FLAG_IS_UNIQUE = 2
+# all columns, in the order they are written to file
+COLUMN_NAMES = [
+    "hashes", "sizes", "offsets", "family_ids", "sample_ids", "fids", "is_library",
+    "bucket_family_offsets", "bucket_families", "bucket_flags", "bucket_adjustments"
+]
+# typecodes of all columns but hashes, which are stored as "I" or "Q" depending on their largest value
+COLUMN_TYPECODES = {
+    "sizes": "I", "offsets": "Q", "family_ids": "I", "sample_ids": "I", "fids": "I", "is_library": "B",
+    "bucket_family_offsets": "Q", "bucket_families": "I", "bucket_flags": "B", "bucket_adjustments": "B"
+}
+# optional columns with the function addresses of samples, indexed by sample ID via an offsets table and then by function ID
+FUNCTION_COLUMN_NAMES = ["function_address_offsets", "function_addresses"]
+
+
+def _align(offset, alignment=SECTION_ALIGNMENT):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _getTypecode(compact_db, name):
+    column = getattr(compact_db, name)
+    return column.format if isinstance(column, memoryview) else column.typecode
+
+
+def _buildFunctionColumns(sample_function_offsets):
+    columns = {name: array("Q") for name in FUNCTION_COLUMN_NAMES}
+    if sample_function_offsets:
+        columns["function_address_offsets"].append(0)
+        for sample_id in range(max(sample_function_offsets) + 1):
+            columns["function_addresses"].extend(sample_function_offsets.get(sample_id, []))
+            columns["function_address_offsets"].append(len(columns["function_addresses"]))
+    return columns
+
+
+class CompactDb(object):
+    """
+    Read-only representation of the blockhash DB as sorted, fixed-width arrays.
+    Keys (hash, size) are stored sorted in two parallel columns, with an offsets table pointing into
+    parallel entry columns (family_id, sample_id, fid, is_library).
+    Per key, the BucketAggregate is stored as well: its distinct families (again via an offsets table),
+    library/unique flags and the family adjustment value.
+    When opened from a file, all columns are memoryviews into a shared read-only mmap.
+    For compatibility, it can be used like the nested {hash: {size: [entries]}} dict of BlockHashMatcher.
+    """
+
+    def __init__(self, metadata, columns, mapped=None):
+        self.metadata = metadata
+        self._mapped = mapped
+        for name in COLUMN_NAMES:
+            setattr(self, name, columns[name])
+        for name in FUNCTION_COLUMN_NAMES:
+            setattr(self, name, columns.get(name, array("Q")))
+        self.num_hashes = metadata["num_hashes"]
+
+    @staticmethod
+    def isCompactDb(filepath):
+        with open(filepath, "rb") as fin:
+            return fin.read(len(MAGIC)) == MAGIC
+
+    @classmethod
+    def open(cls, filepath):
+        """ memory-map a compact DB file, only the metadata header is parsed """
+        if sys.byteorder != "little":
+            raise ValueError("CompactDb files can only be mapped on little-endian hosts.")
+        with open(filepath, "rb") as fin:
+            mapped = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, format_version, metadata_length = struct.unpack_from(HEADER_FORMAT, mapped, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{filepath} is not a compact picblocks DB.")
+        if format_version != FORMAT_VERSION:
+            raise ValueError(f"{filepath} uses unsupported format version {format_version}.")
+        metadata = json.loads(mapped[HEADER_SIZE:HEADER_SIZE + metadata_length].decode("utf-8"))
+        data_start = _align(HEADER_SIZE + metadata_length)
+        view = memoryview(mapped)
+        columns = {}
+        for name, section in metadata["sections"].items():
+            start = data_start + section["offset"]
+            end = start + section["length"] * array(section["typecode"]).itemsize
+            columns[name] = view[start:end].cast(section["typecode"])
+        return cls(metadata, columns, mapped=mapped)
+
+    @classmethod
+    def fromBlockhashes(cls, blockhashes, metadata=None, sample_function_offsets=None):
+        """ build an in-memory CompactDb from the nested {hash: {size: [entries]}} dict and optionally {sample_id: [function addresses]} """
+        sorted_hashes = sorted(blockhashes)
+        return cls._fromSortedBuckets(((blockhash, blockhashes[blockhash]) for blockhash in sorted_hashes), sorted_hashes[-1] if sorted_hashes else 0, metadata, sample_function_offsets)
+
+    @classmethod
+    def fromJsonBlockhashes(cls, json_blockhashes, metadata=None, sample_function_offsets=None):
+        """
+        like fromBlockhashes(), but for the blockhashes of a parsed JSON DB with string keys and entries as lists,
+        which are removed from json_blockhashes while they are converted, so that their memory is released early.
+        """
+        sorted_hashes = sorted((int(blockhash), blockhash) for blockhash in json_blockhashes)
+        buckets = ((int_hash, {int(size): entries for size, entries in json_blockhashes.pop(blockhash).items()}) for int_hash, blockhash in sorted_hashes)
+        return cls._fromSortedBuckets(buckets, sorted_hashes[-1][0] if sorted_hashes else 0, metadata, sample_function_offsets)
+
+    @classmethod
+    def _fromSortedBuckets(cls, buckets, max_hash, metadata, sample_function_offsets):
+        """ build an in-memory CompactDb from (hash, {size: [entries]}) in ascending order of hashes """
+        # DBs of 64 bit hashes always store them as such, so that their column has the same type as the hashes of any report
+        hash_typecode = "Q" if max_hash > 0xFFFFFFFF or (metadata is not None and metadata.get("hash_size", 4) == 8) else "I"
+        columns = {name: array(hash_typecode if name == "hashes" else COLUMN_TYPECODES[name]) for name in COLUMN_NAMES}
+        columns["offsets"].append(0)
+        columns["bucket_family_offsets"].append(0)
+        num_hashes = 0
+        for blockhash, sizes in buckets:
+            num_hashes += 1
+            for size in sorted(sizes):
+                entries = sizes[size]
+                columns["hashes"].append(blockhash)
+                columns["sizes"].append(size)
+                for family_id, sample_id, fid, is_library in entries:
+                    columns["family_ids"].append(family_id)
+                    columns["sample_ids"].append(sample_id)
+                    columns["fids"].append(fid)
+                    columns["is_library"].append(1 if is_library else 0)
+                columns["offsets"].append(len(columns["fids"]))
+                aggregate = aggregateEntries(entries)
+                columns["bucket_families"].extend(aggregate.families)
+                columns["bucket_family_offsets"].append(len(columns["bucket_families"]))
+                columns["bucket_flags"].append((FLAG_HAS_LIBRARY if aggregate.has_library else 0) | (FLAG_IS_UNIQUE if aggregate.is_unique else 0))
+                columns["bucket_adjustments"].append(aggregate.adjustment_value)
+        columns.update(_buildFunctionColumns(sample_function_offsets))
+        metadata = dict(metadata) if metadata is not None else {}
+        metadata["num_hashes"] = num_hashes
+        metadata["num_keys"] = len(columns["sizes"])
+        metadata["num_entries"] = len(columns["fids"])
+        return cls(metadata, columns)
+
+    @classmethod
+    def concatenate(cls, compact_dbs, metadata=None, sample_function_offsets=None):
+        """ merge DBs with disjoint, ascending hash ranges (e.g. hash-prefix shards in order) into one in-memory CompactDb """
+        hash_typecode = "Q" if any(compact_db.hashes.itemsize == 8 for compact_db in compact_dbs) or (metadata is not None and metadata.get("hash_size", 4) == 8) else "I"
+        columns = {name: array(hash_typecode if name == "hashes" else COLUMN_TYPECODES[name]) for name in COLUMN_NAMES}
+        columns["offsets"].append(0)
+        columns["bucket_family_offsets"].append(0)
+        for compact_db in compact_dbs:
+            num_entries = len(columns["fids"])
+            num_bucket_families = len(columns["bucket_families"])
+            for name in COLUMN_NAMES:
+                column = getattr(compact_db, name)
+                if name == "offsets":
+                    columns[name].extend(offset + num_entries for offset in column[1:])
+                elif name == "bucket_family_offsets":
+                    columns[name].extend(offset + num_bucket_families for offset in column[1:])
+                elif name == "hashes" and _getTypecode(compact_db, name) != hash_typecode:
+                    columns[name].extend(column)
+                else:
+                    columns[name].frombytes(column.tobytes())
+        columns.update(_buildFunctionColumns(sample_function_offsets))
+        metadata = dict(metadata) if metadata is not None else {}
+        metadata["num_hashes"] = sum(compact_db.num_hashes for compact_db in compact_dbs)
+        metadata["num_keys"] = len(columns["sizes"])
+        metadata["num_entries"] = len(columns["fids"])
+        return cls(metadata, columns)
+
+    def write(self, filepath):
+        """ serialize this DB into a compact DB file """
+        metadata = dict(self.metadata)
+        metadata["format_version"] = FORMAT_VERSION
+        metadata["sections"] = {}
+        columns = [(name, getattr(self, name)) for name in COLUMN_NAMES]
+        if len(self.function_address_offsets):
+            columns.extend((name, getattr(self, name)) for name in FUNCTION_COLUMN_NAMES)
+        offset = 0
+        for name, column in columns:
+            metadata["sections"][name] = {"offset": offset, "typecode": _getTypecode(self, name), "length": len(column)}
+            offset = _align(offset + len(column) * column.itemsize)
+        encoded_metadata = json.dumps(metadata, sort_keys=True).encode("utf-8")
+        with open(filepath, "wb") as fout:
+            fout.write(struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, len(encoded_metadata)))
+            fout.write(encoded_metadata)
+            fout.write(b"\x00" * (_align(fout.tell()) - fout.tell()))
+            data_start = fout.tell()
+            for name, column in columns:
+                fout.write(column.tobytes())
+                padding = data_start + _align(fout.tell() - data_start) - fout.tell()
+                fout.write(b"\x00" * padding)
+
+    def close(self):
+        if self._mapped is not None:
+            for name in COLUMN_NAMES + FUNCTION_COLUMN_NAMES:
+                column = getattr(self, name)
+                if isinstance(column, memoryview):
+                    column.release()
+            self._mapped.close()
+            self._mapped = None
+
+    def findKey(self, blockhash, size):
+        """ return the index of key (blockhash, size) or -1 if it is not in the DB """
+        index = bisect.bisect_left(self.hashes, blockhash)
+        while index < len(self.hashes) and self.hashes[index] == blockhash:
+            if self.sizes[index] == size:
+                return index
+            index += 1
+        return -1
+
+    def lookupAggregate(self, blockhash, size):
+        """ return a tuple (is_hash_known, BucketAggregate or None) for key (blockhash, size) """
+        index = bisect.bisect_left(self.hashes, blockhash)
+        is_hash_known = index < len(self.hashes) and self.hashes[index] == blockhash
+        while index < len(self.hashes) and self.hashes[index] == blockhash:
+            if self.sizes[index] == size:
+                return True, self.getAggregate(index)
+            index += 1
+        return is_hash_known, None
+
+    def getAggregate(self, key_index):
+        """ return the precomputed BucketAggregate for the key at key_index """
+        families = tuple(self.bucket_families[self.bucket_family_offsets[key_index]:self.bucket_family_offsets[key_index + 1]])
+        flags = self.bucket_flags[key_index]
+        return BucketAggregate(families, flags & FLAG_HAS_LIBRARY != 0, self.bucket_adjustments[key_index], flags & FLAG_IS_UNIQUE != 0)
+
+    def getEntries(self, key_index):
+        """ return the entries for the key at key_index as list of (family_id, sample_id, fid, is_library) tuples """
+        start = self.offsets[key_index]
+        end = self.offsets[key_index + 1]
+        return [(self.family_ids[i], self.sample_ids[i], self.fids[i], self.is_library[i] == 1) for i in range(start, end)]
+
+    def getFunctionOffsets(self, sample_id):
+        """ return the function addresses of a sample, indexed by function ID, or None if they were not stored """
+        if sample_id + 1 >= len(self.function_address_offsets):
+            return None
+        start = self.function_address_offsets[sample_id]
+        end = self.function_address_offsets[sample_id + 1]
+        return list(self.function_addresses[start:end]) if end > start else None
+
+    def findKeysWithEntries(self, family_ids=(), sample_ids=()):
+        """ return the sorted indices of all keys with at least one entry of the given families or samples """
+        family_ids = set(family_ids)
+        sample_ids = set(sample_ids)
+        if np is not None:
+            is_hit = np.isin(np.asarray(self.family_ids), list(family_ids)) | np.isin(np.asarray(self.sample_ids), list(sample_ids))
+            entry_indices = np.nonzero(is_hit)[0]
+            key_indices = np.searchsorted(np.asarray(self.offsets), entry_indices, side="right") - 1
+            return sorted(set(key_indices.tolist()))
+        key_indices = []
+        for key_index in range(len(self.sizes)):
+            for entry_index in range(self.offsets[key_index], self.offsets[key_index + 1]):
+                if self.family_ids[entry_index] in family_ids or self.sample_ids[entry_index] in sample_ids:
+                    key_indices.append(key_index)
+                    break
+        return key_indices
+
+    def _getSizes(self, key_index):
+        sizes = {}
+        blockhash = self.hashes[key_index]
+        while key_index < len(self.hashes) and self.hashes[key_index] == blockhash:
+            sizes[self.sizes[key_index]] = self.getEntries(key_index)
+            key_index += 1
+        return sizes
+
+    # dict compatibility, so that BlockHashMatcher can use this as drop-in for self.blockhashes
+
+    def __len__(self):
+        return self.num_hashes
+
+    def __contains__(self, blockhash):
+        index = bisect.bisect_left(self.hashes, blockhash)
+        return index < len(self.hashes) and self.hashes[index] == blockhash
+
+    def __getitem__(self, blockhash):
+        index = bisect.bisect_left(self.hashes, blockhash)
+        if index < len(self.hashes) and self.hashes[index] == blockhash:
+            return self._getSizes(index)
+        raise KeyError(blockhash)
+
+    def get(self, blockhash, default=None):
+        try:
+            return self[blockhash]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        previous = None
+        for blockhash in self.hashes:
+            if blockhash != previous:
+                previous = blockhash
+                yield blockhash
+
+    def items(self):
+        key_index = 0
+        while key_index < len(self.hashes):
+            sizes = self._getSizes(key_index)
+            yield self.hashes[key_index], sizes
+            key_index += len(sizes)
+
+    def toBlockhashes(self):
+        """ convert back into the nested {hash: {size: [entries]}} dict """
+        return {blockhash: sizes for blockhash, sizes in self.items()}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(f"usage: {sys.argv[0]} <input_db_path> <output_db_path>")
+        print("converts a JSON DB into a compact DB and vice versa, based on the format of the input DB.")
+        sys.exit(1)
+    from .blockhashmatcher import BlockHashMatcher
+    matcher = BlockHashMatcher()
+    matcher.loadDb(sys.argv[1])
+    if CompactDb.isCompactDb(sys.argv[1]):
+        print("converting compact DB to JSON DB...")
+        matcher.saveDb(sys.argv[2])
+    else:
+        print("converting JSON DB to compact DB...")
+        matcher.saveCompactDb(sys.argv[2])
@@ -0,0 +1,210 @@
+import os
+import sys
+import uuid
+import pickle
+import shutil
+import logging
+import argparse
+import datetime
+import tempfile
+from multiprocessing import Pool, cpu_count
+
+from .compactdb import CompactDb
+from .blockhasher import DEFAULT_HASH_ALGORITHM, DEFAULT_HASH_SIZE
+from .blockreport import readBlockReport
+from .reportarchive import ReportArchive, isReportArchive, getLooseReportPaths
+from .incrementaldb import removeDeltas
+
+# Only do basicConfig if no handlers have been configured
+if len(logging._handlerList) == 0:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
+
+DEFAULT_SHARD_BITS = 4
+# number of reports a map task parses before writing out its partitions, which bounds the memory per worker
+REPORTS_PER_TASK = 16
+
+
+def getShardIndex(blockhash, shard_bits, hash_bits=8 * DEFAULT_HASH_SIZE):
+    """ shards partition the hash space by the top bits of the blockhash, so their concatenation in order is sorted again """
+    return blockhash >> (hash_bits - shard_bits)
+
+
+def getShardFilename(shard_index):
+    return f"shard-{shard_index:04d}.pbdb"
+
+
+def _getPartitionPath(work_path, task_index, shard_index):
+    return os.path.join(work_path, f"task-{task_index:06d}.shard-{shard_index:04d}.pickle")
+
+
+def _mapReports(task):
+    """ parse a contiguous range of reports and partition their (hash, size, sample_id, fid, is_library) rows by shard """
+    task_index, first_sample_id, report_paths, work_path, shard_bits = task
+    partitions = [[] for _ in range(2 ** shard_bits)]
+    samples = []
+    for sample_id, report_path in enumerate(report_paths, start=first_sample_id):
+        blockhash_report = readBlockReport(report_path)
+        hash_function = (blockhash_report.get("hash_algorithm", DEFAULT_HASH_ALGORITHM), blockhash_report.get("hash_size", DEFAULT_HASH_SIZE))
+        samples.append((blockhash_report["filename"], blockhash_report["family"], blockhash_report.get("function_offsets"), hash_function))
+        is_library = False if "is_library" not in blockhash_report else blockhash_report["is_library"]
+        for blockhash, data in blockhash_report["blockhashes"].items():
+            int_hash = int(blockhash)
+            partition = partitions[getShardIndex(int_hash, shard_bits, hash_bits=8 * hash_function[1])]
+            for size, fids in data.items():
+                int_size = int(size)
+                for fid in fids:
+                    partition.append((int_hash, int_size, sample_id, fid, is_library))
+    for shard_index, partition in enumerate(partitions):
+        with open(_getPartitionPath(work_path, task_index, shard_index), "wb") as fout:
+            pickle.dump(partition, fout, protocol=pickle.HIGHEST_PROTOCOL)
+    return samples
+
+
+def _reduceShard(task):
+    """ aggregate the partitions of all map tasks for one shard and write it as compact DB """
+    shard_index, num_map_tasks, work_path, shard_path, sample_family_ids, metadata = task
+    blockhashes = {}
+    # map tasks cover ascending ranges of sample ids, so reading them in order yields the same entry order as BlockHashMatcher.load()
+    for task_index in range(num_map_tasks):
+        partition_path = _getPartitionPath(work_path, task_index, shard_index)
+        with open(partition_path, "rb") as fin:
+            partition = pickle.load(fin)
+        for int_hash, int_size, sample_id, fid, is_library in partition:
+            if int_hash not in blockhashes:
+                blockhashes[int_hash] = {}
+            if int_size not in blockhashes[int_hash]:
+                blockhashes[int_hash][int_size] = []
+            blockhashes[int_hash][int_size].append((sample_family_ids[sample_id], sample_id, fid, is_library))
+        os.remove(partition_path)
+    compact_db = CompactDb.fromBlockhashes(blockhashes, metadata=metadata)
+    compact_db.write(shard_path)
+    return compact_db.metadata["num_entries"]
+
+
+class DbBuilder(object):
+    """
+    Map-reduce style aggregation of block reports into a DB.
+    Map tasks parse contiguous ranges of reports in parallel and partition their rows by hash prefix into 2 ** shard_bits shards,
+    which are then reduced independently into compact DB files and finally concatenated.
+    Sample IDs are assigned by position in the list of reports and family IDs by first occurrence, exactly as BlockHashMatcher.load() does.
+    """
+
+    def __init__(self, num_processes=None, shard_bits=DEFAULT_SHARD_BITS, reports_per_task=REPORTS_PER_TASK, work_path=None):
+        self.num_processes = num_processes if num_processes else cpu_count()
+        self.shard_bits = shard_bits
+        self.reports_per_task = reports_per_task
+        self.work_path = work_path
+
+    def buildShards(self, report_paths, shards_path):
+        """ aggregate the reports into one compact DB file per shard in shards_path and return the common metadata """
+        metadata, _ = self._buildShards(report_paths, shards_path)
+        return metadata
+
+    def _buildShards(self, report_paths, shards_path):
+        """ return the common metadata and the function addresses {sample_id: [offsets]} of reports that have them """
+        os.makedirs(shards_path, exist_ok=True)
+        work_path = tempfile.mkdtemp(prefix="picblocks-build-", dir=self.work_path)
+        try:
+            map_tasks = []
+            for task_index, first_sample_id in enumerate(range(0, len(report_paths), self.reports_per_task)):
+                map_tasks.append((task_index, first_sample_id, report_paths[first_sample_id:first_sample_id + self.reports_per_task], work_path, self.shard_bits))
+            LOG.info("parsing %d reports in %d tasks using %d processes.", len(report_paths), len(map_tasks), self.num_processes)
+            with Pool(self.num_processes) as pool:
+                family_to_id = {}
+                family_id_to_family = {}
+                sample_id_to_sample = {}
+                sample_family_ids = []
+                sample_function_offsets = {}
+                hash_functions = set()
+                for samples in pool.imap(_mapReports, map_tasks):
+                    for filename, family, function_offsets, hash_function in samples:
+                        hash_functions.add(hash_function)
+                        if family not in family_to_id:
+                            family_to_id[family] = len(family_to_id)
+                            family_id_to_family[family_to_id[family]] = family
+                        if function_offsets is not None:
+                            sample_function_offsets[len(sample_id_to_sample)] = function_offsets
+                        sample_id_to_sample[len(sample_id_to_sample)] = filename
+                        sample_family_ids.append(family_to_id[family])
+                if len(hash_functions) > 1:
+                    raise ValueError(f"Reports were hashed with different hash functions: {', '.join(f'{8 * hash_size} bit {hash_algorithm}' for hash_algorithm, hash_size in sorted(hash_functions))}")
+                hash_algorithm, hash_size = hash_functions.pop() if hash_functions else (DEFAULT_HASH_ALGORITHM, DEFAULT_HASH_SIZE)
+                metadata = {
+                    "timestamp": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    "base_id": uuid.uuid4().hex,
+                    "hash_algorithm": hash_algorithm,
+                    "hash_size": hash_size,
+                    "family_to_id": family_to_id,
+                    "family_id_to_family": family_id_to_family,
+                    "sample_id_to_sample": sample_id_to_sample,
+                    "shard_bits": self.shard_bits,
+                }
+                reduce_tasks = []
+                for shard_index in range(2 ** self.shard_bits):
+                    shard_metadata = dict(metadata, shard_index=shard_index)
+                    reduce_tasks.append((shard_index, len(map_tasks), work_path, os.path.join(shards_path, getShardFilename(shard_index)), sample_family_ids, shard_metadata))
+                LOG.info("aggregating %d shards.", len(reduce_tasks))
+                num_entries = sum(pool.imap_unordered(_reduceShard, reduce_tasks))
+            LOG.info("aggregated %d entries.", num_entries)
+        finally:
+            shutil.rmtree(work_path, ignore_errors=True)
+        return metadata, sample_function_offsets
+
+    def build(self, report_paths, db_filepath):
+        """ aggregate the reports into a single DB, as compact DB if db_filepath ends with .pbdb or as JSON DB otherwise """
+        shards_path = tempfile.mkdtemp(prefix="picblocks-shards-", dir=self.work_path)
+        try:
+            metadata, sample_function_offsets = self._buildShards(report_paths, shards_path)
+            metadata.pop("shard_bits")
+            shard_dbs = [CompactDb.open(os.path.join(shards_path, getShardFilename(shard_index))) for shard_index in range(2 ** self.shard_bits)]
+            compact_db = CompactDb.concatenate(shard_dbs, metadata=metadata, sample_function_offsets=sample_function_offsets)
+            for shard_db in shard_dbs:
+                shard_db.close()
+        finally:
+            shutil.rmtree(shards_path, ignore_errors=True)
+        if db_filepath.endswith(".pbdb"):
+            compact_db.write(db_filepath + ".tmp")
+            os.replace(db_filepath + ".tmp", db_filepath)
+            removeDeltas(db_filepath)
+        else:
+            from .blockhashmatcher import BlockHashMatcher
+            matcher = BlockHashMatcher()
+            matcher.hash_algorithm = metadata["hash_algorithm"]
+            matcher.hash_size = metadata["hash_size"]
+            matcher.family_to_id = metadata["family_to_id"]
+            matcher.family_id_to_family = metadata["family_id_to_family"]
+            matcher.sample_id_to_sample = metadata["sample_id_to_sample"]
+            matcher.sample_function_offsets = sample_function_offsets
+            matcher.blockhashes = compact_db
+            matcher.saveDb(db_filepath)
+        return metadata
+
+
+def getReportPaths(block_reports_path):
+    """ return the paths of the block reports in a directory or, for a report archive, the locations of its reports """
+    if os.path.isfile(block_reports_path) and isReportArchive(block_reports_path):
+        return ReportArchive(block_reports_path).getReportLocations()
+    return getLooseReportPaths(block_reports_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregate block reports into a DB using multiple processes.")
+    parser.add_argument("block_reports_path", help="directory containing the block reports.")
+    parser.add_argument("db_path", help="DB to write, as compact DB if it ends with .pbdb or as JSON DB otherwise.")
+    parser.add_argument("-p", "--processes", type=int, default=None, help="number of worker processes (default: number of CPUs).")
+    parser.add_argument("-s", "--shard-bits", type=int, default=DEFAULT_SHARD_BITS, help=f"partition hashes into 2^n shards by their top n bits (default: {DEFAULT_SHARD_BITS}).")
+    parser.add_argument("--shards-only", action="store_true", help="write the shards as separate compact DBs into db_path instead of merging them.")
+    args = parser.parse_args()
+    builder = DbBuilder(num_processes=args.processes, shard_bits=args.shard_bits)
+    report_paths = getReportPaths(args.block_reports_path)
+    if args.shards_only:
+        builder.buildShards(report_paths, args.db_path)
+    else:
+        builder.build(report_paths, args.db_path)
+    print(f"aggregated {len(report_paths)} reports into {args.db_path}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
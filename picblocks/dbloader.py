@@ -0,0 +1,155 @@
+import os
+import time
+import logging
+import threading
+import traceback
+
+from .incrementaldb import getDeltaPaths
+
+# Only do basicConfig if no handlers have been configured
+if len(logging._handlerList) == 0:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
+
+DEFAULT_POLL_INTERVAL = 30
+STATUS_LOADING = "loading"
+STATUS_READY = "ready"
+STATUS_FAILED = "failed"
+PHASE_WAITING = "waiting"
+PHASE_IMPORTING = "importing"
+PHASE_LOADING = "loading"
+PHASE_ACTIVATING = "activating"
+
+
+def getDbVersion(filepath):
+    """ return a signature of the DB at filepath (including its delta segments or shards), which changes whenever one of its files is replaced """
+    if filepath is None:
+        return None
+    if os.path.isdir(filepath):
+        filepaths = [os.path.join(filepath, filename) for filename in sorted(os.listdir(filepath))]
+    else:
+        filepaths = [filepath] + getDeltaPaths(filepath)
+    version = []
+    for path in filepaths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        version.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(version)
+
+
+class DbLoader(object):
+    """
+    Loads the DB into a BlockHashMatcher in a background thread, so that a service can answer requests (e.g. health checks) right away.
+    The first of db_paths that exists is loaded, or an empty DB if none does. Every poll_interval seconds, the loader checks whether
+    a (newer) DB appeared and then loads it into a new BlockHashMatcher while the previous one keeps serving.
+    Once loaded, on_load(matcher) is called from the loader thread to activate it, and afterwards matcher refers to it.
+    A DB that fails to load is logged and retried only once its files change again, the previous DB remains active meanwhile.
+    """
+
+    def __init__(self, db_paths, on_load=None, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.db_paths = db_paths
+        self.on_load = on_load
+        self.poll_interval = poll_interval
+        self.matcher = None
+        self.db_path = None
+        self.db_version = None
+        self.status = STATUS_LOADING
+        self.phase = PHASE_WAITING
+        self.loading_path = None
+        self.phase_started = time.time()
+        self.started = time.time()
+        self.num_loads = 0
+        self.error = None
+        self._has_failed = False
+        self._failed_version = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="db-loader", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+
+    def isReady(self):
+        return self.matcher is not None
+
+    def _findDbPath(self):
+        for db_path in self.db_paths:
+            if os.path.exists(db_path):
+                return db_path
+        return None
+
+    def _setPhase(self, phase):
+        self.phase = phase
+        self.phase_started = time.time()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            db_path = self._findDbPath()
+            db_version = getDbVersion(db_path)
+            is_new = self.matcher is None or db_version != self.db_version
+            if is_new and not (self._has_failed and db_version == self._failed_version):
+                self._load(db_path, db_version)
+            if not self.poll_interval:
+                break
+            self._stop_event.wait(self.poll_interval)
+
+    def _load(self, db_path, db_version):
+        start = time.time()
+        self.loading_path = db_path
+        try:
+            self._setPhase(PHASE_IMPORTING)
+            # imported here, as SMDA and its dependencies alone take seconds to import
+            from .blockhashmatcher import BlockHashMatcher
+            self._setPhase(PHASE_LOADING)
+            LOG.info("Loading DB %s", db_path)
+            matcher = BlockHashMatcher()
+            if db_path is not None:
+                matcher.loadDb(db_path)
+            self._setPhase(PHASE_ACTIVATING)
+            if self.on_load is not None:
+                self.on_load(matcher)
+        except Exception:
+            self.error = traceback.format_exc()
+            self._has_failed = True
+            self._failed_version = db_version
+            if self.matcher is None:
+                self.status = STATUS_FAILED
+            self.loading_path = None
+            self._setPhase(PHASE_WAITING)
+            LOG.error("Loading DB %s failed:\n%s", db_path, self.error)
+            return
+        self.matcher = matcher
+        self.db_path = db_path
+        self.db_version = db_version
+        self.num_loads += 1
+        self.error = None
+        self._has_failed = False
+        self.status = STATUS_READY
+        self.loading_path = None
+        self._setPhase(PHASE_WAITING)
+        LOG.info("Loaded DB %s (%5.2fs)", db_path, time.time() - start)
+
+    def getStatus(self):
+        now = time.time()
+        status = {
+            "status": self.status,
+            "phase": self.phase,
+            "phase_duration": now - self.phase_started,
+            "uptime": now - self.started,
+            "db_path": self.db_path,
+            "db_timestamp": self.matcher.db_timestamp if self.matcher is not None else None,
+            "num_loads": self.num_loads,
+        }
+        if self.loading_path is not None:
+            status["loading_path"] = self.loading_path
+            status["loading_size"] = os.path.getsize(self.loading_path) if os.path.isfile(self.loading_path) else None
+        if self.error is not None:
+            status["error"] = self.error.strip().split("\n")[-1]
+        return status
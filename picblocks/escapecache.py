@@ -0,0 +1,76 @@
+import re
+import functools
+
+from smda.intel.IntelInstructionEscaper import IntelInstructionEscaper
+
+
+DEFAULT_CACHE_SIZE = 2 ** 18
+# IntelInstructionEscaper.escapeBinary returns early for these, before looking at any immediates
+JUMP_CALL_MNEMONICS = set([
+    "call", "lcall", "jmp", "ljmp", "loop", "loopne", "loope",
+    "je", "jne", "js", "jns", "jp", "jnp", "jo", "jno", "jl", "jle", "jg",
+    "jge", "jb", "jbe", "ja", "jae", "jcxz", "jecxz", "jrcxz"
+])
+IMMEDIATE_PATTERN = re.compile(r"0x[0-9a-fA-F]{1,8}")
+
+
+class EscapedInstructionCache(object):
+    """
+    Bounded LRU cache for IntelInstructionEscaper.escapeBinary as used for blockhashes.
+    The escaped binary only depends on the instruction's bytes, mnemonic and operands, and - for immediates -
+    whether they fall into the image [lower_addr, upper_addr), so it can be shared across blocks and reports.
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        # the instruction currently looked up, only used on cache misses, as the result is fully determined by the key
+        self._instruction = None
+        self._lower_addr = None
+        self._upper_addr = None
+        self._escape = functools.lru_cache(maxsize=maxsize)(self._escapeUncached)
+
+    def _escapeUncached(self, ins_bytes, mnemonic, operands, immediate_flags):
+        return self._instruction.getEscapedBinary(IntelInstructionEscaper, escape_intraprocedural_jumps=True, lower_addr=self._lower_addr, upper_addr=self._upper_addr)
+
+    @staticmethod
+    def _getImmediateFlags(operands, lower_addr, upper_addr):
+        """ replicate the address check of escapeBinary, to capture the only dependency of the escaped result on the image """
+        return tuple(lower_addr > 0x00100000 and lower_addr <= int(immediate_match.group()[2:], 16) < upper_addr for immediate_match in IMMEDIATE_PATTERN.finditer(operands))
+
+    def escapeInstructions(self, instructions, lower_addr, upper_addr):
+        """ return the escaped binary for each of the instructions """
+        self._lower_addr = lower_addr
+        self._upper_addr = upper_addr
+        escape = self._escape
+        has_image = lower_addr is not None and upper_addr is not None
+        escaped_binary_seq = []
+        for instruction in instructions:
+            operands = instruction.operands
+            immediate_flags = None
+            if has_image and "0x" in operands and instruction.mnemonic not in JUMP_CALL_MNEMONICS and (operands.startswith("0x") or ", 0x" in operands):
+                immediate_flags = self._getImmediateFlags(operands, lower_addr, upper_addr)
+            self._instruction = instruction
+            escaped_binary_seq.append(escape(instruction.bytes, instruction.mnemonic, operands, immediate_flags))
+        return escaped_binary_seq
+
+    @property
+    def hits(self):
+        return self._escape.cache_info().hits
+
+    @property
+    def misses(self):
+        return self._escape.cache_info().misses
+
+    def getStats(self):
+        cache_info = self._escape.cache_info()
+        lookups = cache_info.hits + cache_info.misses
+        return {
+            "hits": cache_info.hits,
+            "misses": cache_info.misses,
+            "hit_rate": cache_info.hits / lookups if lookups else 0,
+            "size": cache_info.currsize,
+            "maxsize": self.maxsize,
+        }
+
+    def clear(self):
+        self._escape.cache_clear()
@@ -0,0 +1,167 @@
+import gc
+import sys
+import json
+import logging
+import argparse
+import datetime
+import multiprocessing
+
+from .dbbuilder import getReportPaths
+from .blockreport import readBlockReport
+from .blockhashmatcher import BlockHashMatcher, WEIGHTINGS
+
+# Only do basicConfig if no handlers have been configured
+if len(logging._handlerList) == 0:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
+
+DEFAULT_THRESHOLDS = [30, 50, 70, 90]
+# number of reports a worker matches per task
+REPORTS_PER_TASK = 16
+
+# the evaluator of the parent process, inherited by the forked workers
+_EVALUATOR = None
+
+
+def _formatThreshold(threshold):
+    return f"{threshold:g}"
+
+
+def _evaluateReports(report_paths):
+    return [_EVALUATOR.evaluateReport(report_path) for report_path in report_paths]
+
+
+class LeaveOneOutEvaluator(object):
+    """
+    Estimates detection rates of a DB by matching each of its block reports against the DB without that sample.
+    Instead of rebuilding the DB per sample, only the buckets of the held out sample are aggregated again without its entries,
+    see BlockHashMatcher.matchLeavingOut(). A family counts as detected when its nonlib_perc reaches a threshold.
+    Reports are matched in parallel by worker processes, which are forked after the DB is loaded and thus share it.
+    """
+
+    def __init__(self, matcher, num_processes=None, thresholds=None, weighting="bucket", reports_per_task=REPORTS_PER_TASK):
+        self.matcher = matcher
+        self.num_processes = num_processes if num_processes else multiprocessing.cpu_count()
+        self.thresholds = sorted(thresholds if thresholds else DEFAULT_THRESHOLDS)
+        self.weighting = weighting
+        self.reports_per_task = reports_per_task
+        self.filename_to_sample_ids = {}
+        for sample_id, filename in matcher.sample_id_to_sample.items():
+            self.filename_to_sample_ids.setdefault(filename, []).append(sample_id)
+
+    def evaluateReport(self, report_path):
+        """ match a single report leaving out all samples of the DB with its filename and return the families it was detected as """
+        blockhash_report = readBlockReport(report_path)
+        sample_ids = self.filename_to_sample_ids.get(blockhash_report["filename"], [])
+        match_report = self.matcher.matchLeavingOut(blockhash_report, sample_ids, weighting=self.weighting)
+        return {
+            "filename": blockhash_report["filename"],
+            "family": blockhash_report["family"],
+            "in_db": len(sample_ids) > 0,
+            "detections": [[family_match["family"], family_match["nonlib_perc"]] for family_match in match_report["family_matches"] if family_match["nonlib_perc"] >= self.thresholds[0]],
+        }
+
+    def evaluate(self, report_paths):
+        """ evaluate all reports and return per-family precision and recall as well as confusion matrices for each threshold """
+        global _EVALUATOR
+        _EVALUATOR = self
+        tasks = [report_paths[index:index + self.reports_per_task] for index in range(0, len(report_paths), self.reports_per_task)]
+        LOG.info("evaluating %d reports in %d tasks using %d processes.", len(report_paths), len(tasks), self.num_processes)
+        samples = []
+        if self.num_processes == 1:
+            for task in tasks:
+                samples.extend(_evaluateReports(task))
+        else:
+            # avoid touching the pages of a dict DB in the workers, see JobQueue
+            gc.freeze()
+            with multiprocessing.get_context("fork").Pool(self.num_processes) as pool:
+                for task_samples in pool.imap(_evaluateReports, tasks):
+                    samples.extend(task_samples)
+            gc.unfreeze()
+        num_not_in_db = sum(1 for sample in samples if not sample["in_db"])
+        if num_not_in_db:
+            LOG.warning("%d reports are not part of the DB and were matched against it in full.", num_not_in_db)
+        return {
+            "timestamp": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "db_timestamp": self.matcher.db_timestamp,
+            "weighting": self.weighting,
+            "num_samples": len(samples),
+            "num_not_in_db": num_not_in_db,
+            "thresholds": {_formatThreshold(threshold): self.computeMetrics(samples, threshold) for threshold in self.thresholds},
+            "samples": samples,
+        }
+
+    @staticmethod
+    def computeMetrics(samples, threshold):
+        """ detection metrics for the evaluated samples, where families with a nonlib_perc of at least threshold are detected """
+        family_verified_frequency = {}
+        family_verified_vs_detected = {}
+        false_positives = {}
+        num_undetected = 0
+        for sample in samples:
+            verified_family = sample["family"]
+            family_verified_frequency[verified_family] = family_verified_frequency.get(verified_family, 0) + 1
+            detections = family_verified_vs_detected.setdefault(verified_family, {})
+            detected_families = [family for family, nonlib_perc in sample["detections"] if nonlib_perc >= threshold]
+            if not detected_families:
+                num_undetected += 1
+            for family in detected_families:
+                detections[family] = detections.get(family, 0) + 1
+                if family != verified_family:
+                    false_positives[family] = false_positives.get(family, 0) + 1
+        families = {}
+        for family in sorted(set(family_verified_frequency).union(false_positives)):
+            num_samples = family_verified_frequency.get(family, 0)
+            true_positives = family_verified_vs_detected.get(family, {}).get(family, 0)
+            num_false_positives = false_positives.get(family, 0)
+            families[family] = {
+                "num_samples": num_samples,
+                "true_positives": true_positives,
+                "false_positives": num_false_positives,
+                "false_negatives": num_samples - true_positives,
+                "precision": true_positives / (true_positives + num_false_positives) if true_positives + num_false_positives else None,
+                "recall": true_positives / num_samples if num_samples else None,
+            }
+        total_true_positives = sum(family["true_positives"] for family in families.values())
+        total_false_positives = sum(family["false_positives"] for family in families.values())
+        precisions = [family["precision"] for family in families.values() if family["precision"] is not None]
+        recalls = [family["recall"] for family in families.values() if family["recall"] is not None]
+        return {
+            "threshold": threshold,
+            "num_undetected": num_undetected,
+            "precision": total_true_positives / (total_true_positives + total_false_positives) if total_true_positives + total_false_positives else None,
+            "recall": total_true_positives / len(samples) if samples else None,
+            "macro_precision": sum(precisions) / len(precisions) if precisions else None,
+            "macro_recall": sum(recalls) / len(recalls) if recalls else None,
+            "families": families,
+            # same layout as the statistics shown by the stats web UI
+            "family_verified_frequency": family_verified_frequency,
+            "family_verified_vs_detected": family_verified_vs_detected,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate detection rates of a DB by matching its block reports leave-one-out.")
+    parser.add_argument("db_path", help="JSON or compact DB to evaluate.")
+    parser.add_argument("block_reports_path", help="directory containing the block reports the DB was built from.")
+    parser.add_argument("-o", "--output", default="evaluation.json", help="file to write the evaluation to (default: evaluation.json).")
+    parser.add_argument("-t", "--thresholds", type=float, nargs="+", default=DEFAULT_THRESHOLDS, help=f"nonlib_perc thresholds for detections (default: {' '.join(str(threshold) for threshold in DEFAULT_THRESHOLDS)}).")
+    parser.add_argument("-p", "--processes", type=int, default=None, help="number of worker processes (default: number of CPUs).")
+    parser.add_argument("-w", "--weighting", default="bucket", choices=WEIGHTINGS, help="weighting used for matching (default: bucket).")
+    args = parser.parse_args()
+    matcher = BlockHashMatcher()
+    matcher.loadDb(args.db_path)
+    evaluator = LeaveOneOutEvaluator(matcher, num_processes=args.processes, thresholds=args.thresholds, weighting=args.weighting)
+    evaluation = evaluator.evaluate(getReportPaths(args.block_reports_path))
+    with open(args.output, "w") as fout:
+        json.dump(evaluation, fout, indent=1)
+    for threshold, metrics in evaluation["thresholds"].items():
+        precision = "-" if metrics["precision"] is None else f"{metrics['precision']:.3f}"
+        recall = "-" if metrics["recall"] is None else f"{metrics['recall']:.3f}"
+        print(f"nonlib_perc >= {threshold:>5}: precision {precision}, recall {recall}, {metrics['num_undetected']} of {evaluation['num_samples']} samples undetected")
+    print(f"wrote {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
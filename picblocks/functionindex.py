@@ -0,0 +1,103 @@
+import logging
+
+try:
+    # numpy is required for the function index, as it is built from the entry columns of the DB
+    import numpy as np
+except ImportError:
+    np = None
+
+# Only do basicConfig if no handlers have been configured
+if len(logging._handlerList) == 0:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
+
+DEFAULT_TOP_K = 3
+# blocks shared by more known functions than this (e.g. prologues, thunks, library code) are skipped like stop words,
+# as they hardly discriminate functions but would pair each input function with all of their functions
+DEFAULT_MAX_POSTINGS = 1000
+
+
+class FunctionIndex(object):
+    """
+    Function-level view on the entry columns of a CompactDb.
+    The entries of a key already are the inverted index from blocks to the functions containing them, so functions only have
+    to be numbered: each distinct (sample_id, fid) of the entries gets a function ID, stored as parallel arrays
+    (function_sample_ids, function_fids, function_family_ids, function_bytes) plus the function ID of every entry, instead of dicts per function.
+    Input functions are then scored against all known functions sharing at least one of their blocks by weighted Jaccard similarity,
+    i.e. the bytes of shared (hash, size) keys relative to the bytes of the keys of both functions.
+    """
+
+    def __init__(self, compact_db):
+        if np is None:
+            raise ImportError("The function index requires numpy to be installed.")
+        self.compact_db = compact_db
+        self.offsets = np.asarray(compact_db.offsets).astype(np.int64)
+        sizes = np.asarray(compact_db.sizes).astype(np.int64)
+        key_indices = np.repeat(np.arange(len(self.offsets) - 1, dtype=np.int64), np.diff(self.offsets))
+        function_keys = (np.asarray(compact_db.sample_ids).astype(np.uint64) << np.uint64(32)) | np.asarray(compact_db.fids).astype(np.uint64)
+        function_keys, first_entries, entry_function_ids = np.unique(function_keys, return_index=True, return_inverse=True)
+        self.entry_function_ids = entry_function_ids.astype(np.uint32).ravel()
+        self.function_family_ids = np.asarray(compact_db.family_ids)[first_entries]
+        self.function_sample_ids = (function_keys >> np.uint64(32)).astype(np.uint32)
+        self.function_fids = (function_keys & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+        # a function has at most one entry per key, so these are the bytes of its distinct keys
+        self.function_bytes = np.bincount(self.entry_function_ids, weights=sizes[key_indices], minlength=len(function_keys)).astype(np.int64)
+        LOG.info("indexed %d functions.", len(function_keys))
+
+    def __len__(self):
+        return len(self.function_fids)
+
+    def match(self, blockhash_report, top_k=DEFAULT_TOP_K, max_postings=DEFAULT_MAX_POSTINGS):
+        """
+        return {input fid: (input bytes, [(function_id, matched_bytes, jaccard)])} with the top_k known functions per input function,
+        best first, ties by function ID. Keys with more than max_postings entries do not count as matched, but still as bytes of both functions.
+        """
+        input_bytes = {}
+        pair_fids = []
+        pair_sizes = []
+        pair_starts = []
+        pair_lengths = []
+        for blockhash, data in blockhash_report["blockhashes"].items():
+            int_hash = int(blockhash)
+            for size, fids in data.items():
+                int_size = int(size)
+                for fid in fids:
+                    input_bytes[fid] = input_bytes.get(fid, 0) + int_size
+                key_index = self.compact_db.findKey(int_hash, int_size) if fids else -1
+                if key_index < 0:
+                    continue
+                start = int(self.offsets[key_index])
+                length = int(self.offsets[key_index + 1]) - start
+                if length > max_postings:
+                    continue
+                for fid in fids:
+                    pair_fids.append(fid)
+                    pair_sizes.append(int_size)
+                    pair_starts.append(start)
+                    pair_lengths.append(length)
+        function_matches = {fid: (num_bytes, []) for fid, num_bytes in input_bytes.items()}
+        if not pair_fids or top_k <= 0:
+            return function_matches
+        # expand each (input fid, key) into one row per known function with that key
+        pair_lengths = np.array(pair_lengths, dtype=np.int64)
+        row_pairs = np.repeat(np.arange(len(pair_lengths), dtype=np.int64), pair_lengths)
+        row_offsets = np.arange(len(row_pairs), dtype=np.int64) - np.repeat(np.cumsum(pair_lengths) - pair_lengths, pair_lengths)
+        row_entries = np.repeat(np.array(pair_starts, dtype=np.int64), pair_lengths) + row_offsets
+        row_fids = np.array(pair_fids, dtype=np.int64)[row_pairs]
+        row_sizes = np.array(pair_sizes, dtype=np.int64)[row_pairs]
+        row_codes = row_fids * len(self) + self.entry_function_ids[row_entries].astype(np.int64)
+        codes, inverse = np.unique(row_codes, return_inverse=True)
+        matched_bytes = np.bincount(inverse.ravel(), weights=row_sizes).astype(np.int64)
+        code_fids = codes // len(self)
+        code_function_ids = codes % len(self)
+        code_input_bytes = np.array([input_bytes[fid] for fid in code_fids.tolist()], dtype=np.int64)
+        jaccard = matched_bytes / (code_input_bytes + self.function_bytes[code_function_ids] - matched_bytes)
+        # best first within each input function, codes are already sorted by input fid and function ID
+        order = np.lexsort((code_function_ids, -jaccard, code_fids))
+        sorted_fids = code_fids[order]
+        group_starts = np.concatenate([[0], np.nonzero(np.diff(sorted_fids))[0] + 1])
+        ranks = np.arange(len(order)) - np.repeat(group_starts, np.diff(np.concatenate([group_starts, [len(order)]])))
+        for index in order[ranks < top_k].tolist():
+            function_matches[int(code_fids[index])][1].append((int(code_function_ids[index]), int(matched_bytes[index]), float(jaccard[index])))
+        return function_matches
@@ -0,0 +1,200 @@
+import os
+import re
+import sys
+import logging
+import argparse
+
+from .aggregates import aggregateEntries
+from .reportarchive import isReportArchive
+
+# Only do basicConfig if no handlers have been configured
+if len(logging._handlerList) == 0:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
+
+# delta segments of a DB are stored next to it as <db_path>.delta.<sequence number>.json
+DELTA_PATTERN = re.compile(r"\.delta\.(\d+)\.json$")
+
+
+def getDeltaPaths(db_filepath):
+    """ return the paths of all delta segments of the DB at db_filepath, in the order they have to be applied """
+    db_dir = os.path.dirname(db_filepath) or "."
+    db_filename = os.path.basename(db_filepath)
+    deltas = []
+    if os.path.isdir(db_dir):
+        for filename in os.listdir(db_dir):
+            if filename.startswith(db_filename):
+                delta_match = DELTA_PATTERN.match(filename[len(db_filename):])
+                if delta_match:
+                    deltas.append((int(delta_match.group(1)), os.path.join(db_dir, filename)))
+    return [delta_path for _, delta_path in sorted(deltas)]
+
+
+def getNextDeltaPath(db_filepath):
+    delta_paths = getDeltaPaths(db_filepath)
+    sequence_number = int(DELTA_PATTERN.search(delta_paths[-1]).group(1)) + 1 if delta_paths else 0
+    return f"{db_filepath}.delta.{sequence_number:06d}.json"
+
+
+def removeDeltas(db_filepath):
+    for delta_path in getDeltaPaths(db_filepath):
+        os.remove(delta_path)
+
+
+class OverlayDb(object):
+    """
+    A read-only CompactDb with an in-memory overlay of changed (hash, size) buckets, which replace the respective buckets of the base.
+    Removed buckets are kept as empty lists in the overlay, so that they mask the base.
+    Like CompactDb, it can be used like the nested {hash: {size: [entries]}} dict of BlockHashMatcher,
+    but buckets can only be changed via getMutableBucket() and setBucket().
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.overlay = {}
+        self._aggregates = {}
+        self._num_hashes = None
+
+    def getMutableBucket(self, blockhash, size):
+        """ return the list of entries for (blockhash, size) in the overlay, copied from the base upon first change """
+        sizes = self.overlay.setdefault(blockhash, {})
+        if size not in sizes:
+            key_index = self.base.findKey(blockhash, size)
+            sizes[size] = self.base.getEntries(key_index) if key_index >= 0 else []
+        self._aggregates.pop((blockhash, size), None)
+        self._num_hashes = None
+        return sizes[size]
+
+    def setBucket(self, blockhash, size, entries):
+        self.overlay.setdefault(blockhash, {})[size] = entries
+        self._aggregates.pop((blockhash, size), None)
+        self._num_hashes = None
+
+    def findBuckets(self, family_ids=(), sample_ids=()):
+        """ return all (hash, size) with at least one entry of the given families or samples """
+        buckets = set()
+        for key_index in self.base.findKeysWithEntries(family_ids=family_ids, sample_ids=sample_ids):
+            blockhash = self.base.hashes[key_index]
+            size = self.base.sizes[key_index]
+            if size not in self.overlay.get(blockhash, {}):
+                buckets.add((blockhash, size))
+        for blockhash, sizes in self.overlay.items():
+            for size, entries in sizes.items():
+                if any(entry[0] in family_ids or entry[1] in sample_ids for entry in entries):
+                    buckets.add((blockhash, size))
+        return sorted(buckets)
+
+    def lookupAggregate(self, blockhash, size):
+        """ return a tuple (is_hash_known, BucketAggregate or None) for key (blockhash, size) """
+        if blockhash not in self.overlay:
+            return self.base.lookupAggregate(blockhash, size)
+        if size in self.overlay[blockhash]:
+            entries = self.overlay[blockhash][size]
+            if not entries:
+                return blockhash in self, None
+            if (blockhash, size) not in self._aggregates:
+                self._aggregates[(blockhash, size)] = aggregateEntries(entries)
+            return True, self._aggregates[(blockhash, size)]
+        is_hash_known, aggregate = self.base.lookupAggregate(blockhash, size)
+        return aggregate is not None or blockhash in self, aggregate
+
+    def toBlockhashes(self):
+        """ convert into the nested {hash: {size: [entries]}} dict """
+        return {blockhash: sizes for blockhash, sizes in self.items()}
+
+    # dict compatibility, so that BlockHashMatcher can use this as drop-in for self.blockhashes
+
+    def __len__(self):
+        if self._num_hashes is None:
+            num_hashes = len(self.base)
+            for blockhash in self.overlay:
+                if blockhash in self.base and not self.get(blockhash):
+                    num_hashes -= 1
+                elif blockhash not in self.base and self.get(blockhash):
+                    num_hashes += 1
+            self._num_hashes = num_hashes
+        return self._num_hashes
+
+    def __contains__(self, blockhash):
+        return bool(self.get(blockhash))
+
+    def __getitem__(self, blockhash):
+        sizes = self.base.get(blockhash, {})
+        if blockhash in self.overlay:
+            sizes.update(self.overlay[blockhash])
+            sizes = {size: entries for size, entries in sizes.items() if entries}
+        if not sizes:
+            raise KeyError(blockhash)
+        return sizes
+
+    def get(self, blockhash, default=None):
+        try:
+            return self[blockhash]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        for blockhash in self.base.keys():
+            if blockhash not in self.overlay or blockhash in self:
+                yield blockhash
+        for blockhash in self.overlay:
+            if blockhash not in self.base and blockhash in self:
+                yield blockhash
+
+    def items(self):
+        for blockhash in self.keys():
+            yield blockhash, self[blockhash]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Incrementally update a picblocks DB by writing delta segments next to it, or compact them into the DB.")
+    parser.add_argument("db_path", help="path of the JSON or compact DB.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    add_parser = subparsers.add_parser("add", help="add block reports.")
+    add_parser.add_argument("report_paths", nargs="+", help="block reports, directories containing them or report archives.")
+    remove_sample_parser = subparsers.add_parser("remove-sample", help="remove samples by their ID.")
+    remove_sample_parser.add_argument("sample_ids", nargs="+", type=int)
+    remove_family_parser = subparsers.add_parser("remove-family", help="remove families and all of their samples.")
+    remove_family_parser.add_argument("families", nargs="+")
+    subparsers.add_parser("compact", help="merge all delta segments into the DB.")
+    args = parser.parse_args()
+    from .blockhashmatcher import BlockHashMatcher
+    matcher = BlockHashMatcher()
+    if os.path.exists(args.db_path):
+        matcher.loadDb(args.db_path)
+    if args.command == "compact":
+        matcher.compactDb(args.db_path)
+        print(f"compacted {args.db_path}")
+        return
+    if args.command == "add":
+        from .dbbuilder import getReportPaths
+        for report_path in args.report_paths:
+            if os.path.isdir(report_path) or isReportArchive(report_path):
+                for contained_path in getReportPaths(report_path):
+                    matcher.load(contained_path)
+            else:
+                matcher.load(report_path)
+    elif args.command == "remove-sample":
+        for sample_id in args.sample_ids:
+            matcher.removeSample(sample_id)
+    elif args.command == "remove-family":
+        for family in args.families:
+            matcher.removeFamily(family)
+    if not os.path.exists(args.db_path):
+        # there is no base to put deltas next to yet
+        if args.db_path.endswith(".pbdb"):
+            matcher.saveCompactDb(args.db_path)
+        else:
+            matcher.saveDb(args.db_path)
+        print(f"wrote new DB {args.db_path}")
+    else:
+        delta_path = matcher.saveDelta(args.db_path)
+        print(f"wrote {delta_path}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,335 @@
+import gc
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import threading
+import traceback
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .blockreport import readBlockReport
+
+# Only do basicConfig if no handlers have been configured
+if len(logging._handlerList) == 0:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_QUEUED = 16
+DEFAULT_MAX_FINISHED = 1000
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+JOB_ID_PATTERN = re.compile("^[0-9a-f]{32}$")
+# every how many submissions a process prunes the shared job store
+STORE_PRUNE_INTERVAL = 64
+
+# the matcher of the parent process, inherited by the forked workers
+_MATCHER = None
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobFailedError(Exception):
+    pass
+
+
+def matchBuffer(binary, filename, bitness=None, baseaddress=None):
+    """ disassemble, hash and match a binary against the DB shared with the parent process, returning both reports """
+    # imported here to keep importing the job queue fast, workers inherit the module from the parent, which imported it along with the DB
+    from .blockhasher import BlockHasher
+    blockhash_report = BlockHasher(hash_algorithm=_MATCHER.hash_algorithm, hash_size=_MATCHER.hash_size).processBuffer(binary, filename, bitness=bitness, baseaddress=baseaddress)
+    return {"blockhash_report": blockhash_report, "match_report": _MATCHER.match(blockhash_report)}
+
+
+def matchReport(blockhash_report):
+    """ match an already hashed binary, see matchBuffer() """
+    return {"match_report": _MATCHER.match(blockhash_report)}
+
+
+def matchReportFile(filepath):
+    """ match an uploaded block report in either format, see matchBuffer(), the file is removed afterwards """
+    try:
+        # binary reports are streamed from the file while matching
+        return {"match_report": _MATCHER.match(readBlockReport(filepath))}
+    finally:
+        os.remove(filepath)
+
+
+def matchSmdaFile(filepath):
+    """ hash and match an uploaded SmdaReport, serialized as JSON, skipping disassembly, see matchBuffer(), the file is removed afterwards """
+    from smda.common.SmdaReport import SmdaReport
+    from .blockhasher import BlockHasher
+    try:
+        with open(filepath, "r") as fin:
+            smda_report = SmdaReport.fromDict(json.load(fin))
+    finally:
+        os.remove(filepath)
+    blockhash_report = BlockHasher(hash_algorithm=_MATCHER.hash_algorithm, hash_size=_MATCHER.hash_size).processSmda(smda_report)
+    return {"blockhash_report": blockhash_report, "match_report": _MATCHER.match(blockhash_report)}
+
+
+def matchBatch(submissions):
+    """
+    match several submissions together via BlockHashMatcher.matchMany(), each a dict with either a "match_report", which is passed on,
+    a "blockhash_report" or a "binary" with "filename", "bitness" and "baseaddress" to hash first.
+    """
+    from .blockhasher import BlockHasher
+    hashed_reports = []
+    for submission in submissions:
+        if "binary" in submission:
+            hashed_reports.append(BlockHasher(hash_algorithm=_MATCHER.hash_algorithm, hash_size=_MATCHER.hash_size).processBuffer(submission["binary"], submission["filename"], bitness=submission["bitness"], baseaddress=submission["baseaddress"]))
+        else:
+            hashed_reports.append(None)
+    to_match = [hashed_report if hashed_report is not None else submission.get("blockhash_report", None) for submission, hashed_report in zip(submissions, hashed_reports)]
+    match_reports = iter(_MATCHER.matchMany(blockhash_report for blockhash_report in to_match if blockhash_report is not None))
+    return {
+        "blockhash_reports": hashed_reports,
+        "match_reports": [next(match_reports) if blockhash_report is not None else submission["match_report"] for submission, blockhash_report in zip(submissions, to_match)],
+    }
+
+
+def _runJob(function, args):
+    try:
+        return function(*args)
+    except Exception:
+        # exceptions may not be picklable, so we only pass on their traceback
+        raise JobFailedError(traceback.format_exc())
+
+
+class Job(object):
+
+    def __init__(self, job_id, future):
+        self.job_id = job_id
+        self.future = future
+        self.submitted = time.time()
+        self.finished = None
+        future.add_done_callback(self._setFinished)
+
+    def _setFinished(self, future):
+        self.finished = time.time()
+
+    @property
+    def status(self):
+        if not self.future.done():
+            return STATUS_RUNNING if self.future.running() else STATUS_QUEUED
+        return STATUS_FAILED if self.future.exception() is not None else STATUS_DONE
+
+    def toDict(self):
+        job_dict = {
+            "job_id": self.job_id,
+            "status": self.status,
+            "submitted": self.submitted,
+            "finished": self.finished,
+        }
+        if job_dict["status"] == STATUS_FAILED:
+            job_dict["error"] = str(self.future.exception()).strip().split("\n")[-1]
+        return job_dict
+
+    def getResult(self):
+        return self.future.result()
+
+
+class StoredJob(object):
+    """ a job of another process sharing the same store_path, as far as it is known from its stored state """
+
+    def __init__(self, job_dict, result):
+        self.job_id = job_dict["job_id"]
+        self.status = job_dict["status"]
+        self._job_dict = job_dict
+        self._result = result
+
+    def toDict(self):
+        return dict(self._job_dict)
+
+    def getResult(self):
+        if self.status != STATUS_DONE:
+            raise JobFailedError(self._job_dict.get("error", f"job is {self.status}"))
+        return self._result
+
+
+class JobQueue(object):
+    """
+    Runs CPU-bound jobs like disassembling, hashing and matching in a pool of worker processes, so that they neither block
+    the threads of the web server nor compete for its GIL.
+    Workers are forked once the DB is loaded and share it with the parent process: a memory-mapped compact DB is shared via
+    the page cache, a dict DB via copy-on-write pages, for which we freeze the garbage collector to avoid touching them.
+    At most max_queued jobs wait for a worker, finished jobs are kept for polling until max_finished newer ones finished.
+    Without use_processes, jobs run in threads of this process instead, e.g. within the workers of a PreforkServer.
+    With a store_path, the state and result of every job are also written to this directory, so that processes sharing it
+    can poll each other's jobs via getJob().
+    """
+
+    def __init__(self, matcher, num_processes=None, max_queued=DEFAULT_MAX_QUEUED, max_finished=DEFAULT_MAX_FINISHED, use_processes=True, store_path=None):
+        global _MATCHER
+        _MATCHER = matcher
+        self.matcher = matcher
+        self.num_processes = num_processes if num_processes else max(1, multiprocessing.cpu_count() - 1)
+        self.max_queued = max_queued
+        self.max_finished = max_finished
+        self.use_processes = use_processes
+        self.store_path = store_path
+        self._num_evictions = 0
+        self._num_unfinished = 0
+        if store_path is not None:
+            os.makedirs(store_path, exist_ok=True)
+        self.jobs = OrderedDict()
+        self._lock = threading.Lock()
+        gc.freeze()
+        self._executor = self._startWorkers()
+
+    def _startWorkers(self):
+        if not self.use_processes:
+            return ThreadPoolExecutor(max_workers=self.num_processes, thread_name_prefix="job")
+        executor = ProcessPoolExecutor(max_workers=self.num_processes, mp_context=multiprocessing.get_context("fork"))
+        # with fork, all workers are started upon the first submission, which we want to happen now and not in a request thread
+        executor.submit(int).result()
+        LOG.info("started %d job workers.", self.num_processes)
+        return executor
+
+    def replaceMatcher(self, matcher):
+        """
+        fork new workers sharing matcher, e.g. a newly loaded DB, for all jobs submitted from now on.
+        Jobs submitted before are still completed by the previous workers, which exit afterwards.
+        """
+        global _MATCHER
+        with self._lock:
+            _MATCHER = matcher
+            self.matcher = matcher
+            gc.freeze()
+            previous_executor = self._executor
+            self._executor = self._startWorkers()
+        previous_executor.shutdown(wait=False)
+
+    def getNumPending(self):
+        return sum(1 for job in self.jobs.values() if not job.future.done())
+
+    def submit(self, function, *args, callback=None):
+        """
+        enqueue function(*args), which has to be a module-level function, and return the ID of the new job.
+        callback is called with the result in this process, once the job finished successfully.
+        """
+        with self._lock:
+            if self.getNumPending() >= self.num_processes + self.max_queued:
+                raise QueueFullError(f"Job queue is full ({self.max_queued} queued jobs).")
+            self._evictFinished()
+            job_id = uuid.uuid4().hex
+            try:
+                future = self._executor.submit(_runJob, function, args)
+            except BrokenProcessPool:
+                # a worker died abruptly, e.g. while disassembling a malformed binary, which fails all of its pending jobs
+                LOG.warning("job workers died, restarting them.")
+                self._executor = self._startWorkers()
+                future = self._executor.submit(_runJob, function, args)
+            job = Job(job_id, future)
+            self.jobs[job_id] = job
+            self._num_unfinished += 1
+        if self.store_path is not None:
+            self._storeJob(job)
+            future.add_done_callback(lambda done_future: self._storeJob(job))
+        if callback is not None:
+            future.add_done_callback(lambda done_future: callback(done_future.result()) if done_future.exception() is None else None)
+        # callbacks are called in order, so this one runs once the result is stored and passed on
+        future.add_done_callback(self._finishJob)
+        return job_id
+
+    def _finishJob(self, future):
+        with self._lock:
+            self._num_unfinished -= 1
+
+    def hasUnfinishedJobs(self):
+        """ return whether jobs are pending or their results are still being stored or passed to callbacks """
+        return self._num_unfinished > 0
+
+    def addResult(self, result):
+        """ add an already finished job, e.g. for a cached result, so that it can be polled like any other job """
+        future = Future()
+        future.set_result(result)
+        with self._lock:
+            self._evictFinished()
+            job_id = uuid.uuid4().hex
+            job = Job(job_id, future)
+            self.jobs[job_id] = job
+        if self.store_path is not None:
+            self._storeJob(job)
+        return job_id
+
+    def _evictFinished(self):
+        finished_job_ids = [job_id for job_id, job in self.jobs.items() if job.future.done()]
+        for job_id in finished_job_ids[:max(0, len(finished_job_ids) - self.max_finished)]:
+            del self.jobs[job_id]
+        if self.store_path is not None:
+            self._num_evictions += 1
+            if self._num_evictions % STORE_PRUNE_INTERVAL == 0:
+                self._pruneStore()
+
+    def _pruneStore(self):
+        """ remove all but the max_finished most recently stored jobs of all processes, including those of processes that exited meanwhile """
+        stored_jobs = []
+        for filename in os.listdir(self.store_path):
+            try:
+                stored_jobs.append((os.path.getmtime(os.path.join(self.store_path, filename)), filename))
+            except FileNotFoundError:
+                continue
+        for _, filename in sorted(stored_jobs, reverse=True)[self.max_finished:]:
+            try:
+                os.remove(os.path.join(self.store_path, filename))
+            except FileNotFoundError:
+                pass
+
+    def _getStoreFilepath(self, job_id):
+        return os.path.join(self.store_path, job_id + ".json")
+
+    def _storeJob(self, job):
+        """ write the state of a job and, once done, its result atomically, so that readers never see a partial file """
+        job_dict = job.toDict()
+        stored_job = {"job": job_dict, "result": job.getResult() if job_dict["status"] == STATUS_DONE else None}
+        store_filepath = self._getStoreFilepath(job.job_id)
+        try:
+            with open(store_filepath + ".tmp", "w") as fout:
+                json.dump(stored_job, fout)
+            os.replace(store_filepath + ".tmp", store_filepath)
+        except (OSError, TypeError, ValueError):
+            LOG.error("storing job %s failed:\n%s", job.job_id, traceback.format_exc())
+
+    def _loadStoredJob(self, job_id):
+        if not JOB_ID_PATTERN.match(job_id):
+            return None
+        try:
+            with open(self._getStoreFilepath(job_id), "r") as fin:
+                stored_job = json.load(fin)
+        except (OSError, ValueError):
+            return None
+        return StoredJob(stored_job["job"], stored_job["result"])
+
+    def getJob(self, job_id):
+        """ return the Job (or StoredJob of another process) for job_id or None if it is unknown or was already evicted """
+        job = self.jobs.get(job_id, None)
+        if job is None and self.store_path is not None:
+            job = self._loadStoredJob(job_id)
+        return job
+
+    def waitForResult(self, job_id, timeout=None):
+        """ block until the job finished and return its result, raising JobFailedError if it failed """
+        try:
+            return self.jobs[job_id].future.result(timeout=timeout)
+        except BrokenProcessPool:
+            raise JobFailedError("job worker died")
+
+    def getStats(self):
+        statuses = [job.status for job in list(self.jobs.values())]
+        stats = {status: statuses.count(status) for status in [STATUS_QUEUED, STATUS_RUNNING, STATUS_DONE, STATUS_FAILED]}
+        stats["num_processes"] = self.num_processes
+        stats["max_queued"] = self.max_queued
+        return stats
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,83 @@
+import os
+import sys
+import json
+import logging
+import argparse
+
+from .blockhasher import HASH_ALGORITHMS, DEFAULT_HASH_ALGORITHM, HASH_SIZES
+from .batchhasher import BatchHasher, hashFile, calculateFileSha256, DEFAULT_TIMEOUT
+from .dbbuilder import DbBuilder, getReportPaths
+from .blockreport import readBlockReport
+
+# Only do basicConfig if no handlers have been configured
+if len(logging._handlerList) == 0:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
+
+def rehashFile(work_item):
+    """ hash a binary again with the hash function of the work item, keeping the labels of its previous block report """
+    blockhash_report = hashFile(work_item)
+    blockhash_report["filename"] = work_item["filename"]
+    blockhash_report["is_library"] = work_item["is_library"]
+    return blockhash_report
+
+
+def indexBinaries(binaries_path):
+    """ return {sha256: filepath} for all files below binaries_path """
+    binaries = {}
+    for root, subdirs, files in os.walk(binaries_path):
+        subdirs.sort()
+        for filename in sorted(files):
+            filepath = os.path.join(root, filename)
+            binaries.setdefault(calculateFileSha256(filepath), filepath)
+    return binaries
+
+
+def getMigrationWorkItems(report_paths, binaries, hash_algorithm, hash_size):
+    """
+    yield a work item for each block report whose binary is found in {sha256: filepath}, as blockhashes can not be converted
+    into another hash function but only be calculated again from the binary. Reports without binary are logged and skipped.
+    """
+    for report_path in report_paths:
+        blockhash_report = readBlockReport(report_path)
+        if blockhash_report["sha256"] not in binaries:
+            LOG.warning("No binary found for %s (%s), it will be missing from the migrated reports.", report_path, blockhash_report["sha256"])
+            continue
+        yield {
+            "filepath": binaries[blockhash_report["sha256"]],
+            "sha256": blockhash_report["sha256"],
+            "filename": blockhash_report["filename"],
+            "family": blockhash_report["family"],
+            "version": blockhash_report["version"],
+            "is_library": blockhash_report.get("is_library", False),
+            "hash_algorithm": hash_algorithm,
+            "hash_size": hash_size,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate block reports (and optionally their DB) to another hash function, e.g. 64 bit blockhashes, by hashing their binaries again.")
+    parser.add_argument("block_reports_path", help="directory containing the existing block reports.")
+    parser.add_argument("binaries_path", help="directory tree containing the binaries of the block reports, which are found by sha256.")
+    parser.add_argument("output_path", help="directory to write the migrated block reports to.")
+    parser.add_argument("-s", "--hash-size", type=int, choices=HASH_SIZES, default=8, help="bytes per blockhash (default: 8).")
+    parser.add_argument("-a", "--hash-algorithm", choices=HASH_ALGORITHMS, default=DEFAULT_HASH_ALGORITHM, help=f"digest to take blockhashes from (default: {DEFAULT_HASH_ALGORITHM}).")
+    parser.add_argument("-p", "--processes", type=int, default=None, help="number of worker processes (default: number of CPUs - 1).")
+    parser.add_argument("-t", "--timeout", type=int, default=DEFAULT_TIMEOUT, help=f"seconds after which a worker hashing a single sample is killed (default: {DEFAULT_TIMEOUT}).")
+    parser.add_argument("--db", default=None, help="also build a DB from the migrated block reports, as compact DB if it ends with .pbdb or as JSON DB otherwise.")
+    args = parser.parse_args()
+    LOG.info("indexing binaries below %s", args.binaries_path)
+    binaries = indexBinaries(args.binaries_path)
+    work_items = getMigrationWorkItems(getReportPaths(args.block_reports_path), binaries, args.hash_algorithm, args.hash_size)
+    # the journal makes an interrupted migration resumable, just as for picblocks-hash
+    batch_hasher = BatchHasher(args.output_path, num_processes=args.processes, timeout=args.timeout, work_function=rehashFile)
+    stats = batch_hasher.run(work_items)
+    print(json.dumps(stats, indent=1, sort_keys=True))
+    if args.db is not None:
+        DbBuilder(num_processes=args.processes).build(getReportPaths(args.output_path), args.db)
+        print(f"built {args.db} from the migrated block reports")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
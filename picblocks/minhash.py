@@ -0,0 +1,114 @@
+import random
+import logging
+from collections import defaultdict
+
+try:
+    # numpy is optional and only speeds up computing signatures
+    import numpy as np
+except ImportError:
+    np = None
+
+# Only do basicConfig if no handlers have been configured
+if len(logging._handlerList) == 0:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
+
+# permutations are emulated by universal hash functions (a * x + b) % MINHASH_PRIME, which fit into 64 bit integers
+MINHASH_PRIME = 2 ** 31 - 1
+MINHASH_SEED = 0x5EED
+# spreads the hash over the prime field before the size is added
+KEY_MULTIPLIER = 1000003
+DEFAULT_NUM_PERMUTATIONS = 64
+# 16 bands of 4 rows make samples with a Jaccard similarity of about 0.5 and more likely candidates
+DEFAULT_NUM_BANDS = 16
+
+
+def getPermutations(num_permutations=DEFAULT_NUM_PERMUTATIONS, seed=MINHASH_SEED):
+    """ return the (a, b) parameters of the hash functions, which only depend on the seed """
+    rng = random.Random(seed)
+    return [(rng.randrange(1, MINHASH_PRIME), rng.randrange(0, MINHASH_PRIME)) for _ in range(num_permutations)]
+
+
+def getKeyValue(int_hash, int_size):
+    """ map a (hash, size) key into the prime field """
+    return (int_hash % MINHASH_PRIME * KEY_MULTIPLIER + int_size) % MINHASH_PRIME
+
+
+def computeSignature(keys, permutations):
+    """ return the MinHash signature of a set of (hash, size) keys as list of ints """
+    values = [getKeyValue(int_hash, int_size) for int_hash, int_size in keys]
+    if not values:
+        return [MINHASH_PRIME] * len(permutations)
+    if np is not None:
+        values = np.array(values, dtype=np.uint64)
+        return [int(((np.uint64(a) * values + np.uint64(b)) % np.uint64(MINHASH_PRIME)).min()) for a, b in permutations]
+    return [min((a * value + b) % MINHASH_PRIME for value in values) for a, b in permutations]
+
+
+class MinHashIndex(object):
+    """
+    Banded LSH index over the MinHash signatures of samples, each the signature of its set of (hash, size) keys.
+    Samples sharing all rows of at least one band with a query signature become candidates, so that a query only touches
+    one bucket per band instead of every DB entry of its blockhashes. Candidates are then re-scored exactly by the caller.
+    """
+
+    def __init__(self, num_permutations=DEFAULT_NUM_PERMUTATIONS, num_bands=DEFAULT_NUM_BANDS):
+        if num_permutations % num_bands:
+            raise ValueError("The number of permutations has to be a multiple of the number of bands.")
+        self.permutations = getPermutations(num_permutations)
+        self.num_bands = num_bands
+        self.num_rows = num_permutations // num_bands
+        self.signatures = {}
+        self.bands = [defaultdict(list) for _ in range(num_bands)]
+
+    @classmethod
+    def fromCompactDb(cls, compact_db, num_permutations=DEFAULT_NUM_PERMUTATIONS, num_bands=DEFAULT_NUM_BANDS):
+        """ index the signatures of all samples, computed from the keys they have entries for """
+        index = cls(num_permutations=num_permutations, num_bands=num_bands)
+        if np is not None and len(compact_db.sample_ids):
+            offsets = np.asarray(compact_db.offsets).astype(np.int64)
+            key_indices = np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+            sample_ids = np.asarray(compact_db.sample_ids).astype(np.int64)
+            hashes = np.asarray(compact_db.hashes).astype(np.uint64)
+            sizes = np.asarray(compact_db.sizes).astype(np.uint64)
+            key_values = (hashes % np.uint64(MINHASH_PRIME) * np.uint64(KEY_MULTIPLIER) + sizes) % np.uint64(MINHASH_PRIME)
+            # group the key values by sample, their order within a sample does not matter for the minimum
+            order = np.argsort(sample_ids, kind="stable")
+            values = key_values[key_indices[order]]
+            sorted_sample_ids = sample_ids[order]
+            starts = np.concatenate([[0], np.nonzero(np.diff(sorted_sample_ids))[0] + 1])
+            minimums = [np.minimum.reduceat((np.uint64(a) * values + np.uint64(b)) % np.uint64(MINHASH_PRIME), starts) for a, b in index.permutations]
+            for position, sample_id in enumerate(sorted_sample_ids[starts].tolist()):
+                index.add(sample_id, [int(column[position]) for column in minimums])
+            return index
+        sample_keys = defaultdict(set)
+        for key_index in range(len(compact_db.sizes)):
+            for entry_index in range(compact_db.offsets[key_index], compact_db.offsets[key_index + 1]):
+                sample_keys[compact_db.sample_ids[entry_index]].add((compact_db.hashes[key_index], compact_db.sizes[key_index]))
+        for sample_id in sorted(sample_keys):
+            index.add(sample_id, computeSignature(sample_keys[sample_id], index.permutations))
+        return index
+
+    def computeSignature(self, keys):
+        return computeSignature(keys, self.permutations)
+
+    def _getBandKeys(self, signature):
+        return [tuple(signature[band * self.num_rows:(band + 1) * self.num_rows]) for band in range(self.num_bands)]
+
+    def add(self, sample_id, signature):
+        self.signatures[sample_id] = signature
+        for band, band_key in enumerate(self._getBandKeys(signature)):
+            self.bands[band][band_key].append(sample_id)
+
+    def query(self, signature, max_candidates=None):
+        """ return candidate (sample_id, estimated Jaccard similarity), most similar first, ties by sample ID """
+        candidates = set()
+        for band, band_key in enumerate(self._getBandKeys(signature)):
+            candidates.update(self.bands[band].get(band_key, ()))
+        estimates = []
+        for sample_id in candidates:
+            num_equal = sum(1 for value, other in zip(signature, self.signatures[sample_id]) if value == other)
+            estimates.append((sample_id, num_equal / len(signature)))
+        estimates.sort(key=lambda estimate: (-estimate[1], estimate[0]))
+        return estimates[:max_candidates] if max_candidates is not None else estimates
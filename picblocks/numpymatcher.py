@@ -0,0 +1,154 @@
+import logging
+
+try:
+    # numpy is optional and only needed for the vectorized matching engine
+    import numpy as np
+except ImportError:
+    np = None
+
+from .compactdb import FLAG_HAS_LIBRARY, FLAG_IS_UNIQUE
+
+# Only do basicConfig if no handlers have been configured
+if len(logging._handlerList) == 0:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
+
+class NumpyMatcher(object):
+    """
+    Vectorized matching engine operating on the column arrays of a CompactDb.
+    It computes exactly the same per family scores as BlockHashMatcher._scoreBlockhashes, including the order
+    of float accumulation and the order in which families are first matched, so that match reports are identical.
+    """
+
+    def __init__(self, compact_db):
+        if np is None:
+            raise ImportError("The numpy matching engine requires numpy to be installed.")
+        self.compact_db = compact_db
+        # zero-copy views on the (possibly memory-mapped) columns
+        self.hashes = np.asarray(compact_db.hashes)
+        self.sizes = np.asarray(compact_db.sizes)
+        self.bucket_family_offsets = np.asarray(compact_db.bucket_family_offsets).astype(np.int64)
+        self.bucket_families = np.asarray(compact_db.bucket_families)
+        self.bucket_flags = np.asarray(compact_db.bucket_flags)
+        self.bucket_adjustments = np.asarray(compact_db.bucket_adjustments)
+
+    def _reportToArrays(self, blockhash_report):
+        """ flatten the blockhashes of a report into (hash, size, number of fids) arrays, in report order """
+        hashes = []
+        sizes = []
+        counts = []
+        for blockhash, data in blockhash_report["blockhashes"].items():
+            int_hash = int(blockhash)
+            for size, fids in data.items():
+                if not fids:
+                    continue
+                hashes.append(int_hash)
+                sizes.append(int(size))
+                counts.append(len(fids))
+        return np.array(hashes, dtype=self.hashes.dtype), np.array(sizes, dtype=np.int64), np.array(counts, dtype=np.int64)
+
+    def findKeys(self, query_hashes, query_sizes):
+        """ return the key index for each (hash, size) query or -1, plus a mask for queries whose hash is in the DB """
+        lower = np.searchsorted(self.hashes, query_hashes, side="left")
+        upper = np.searchsorted(self.hashes, query_hashes, side="right")
+        key_indices = np.full(len(query_hashes), -1, dtype=np.int64)
+        # keys are sorted by (hash, size) and there are only a handful of sizes per hash, so probe them step-wise
+        max_sizes_per_hash = int((upper - lower).max()) if len(query_hashes) else 0
+        for step in range(max_sizes_per_hash):
+            candidates = lower + step
+            open_queries = np.nonzero((candidates < upper) & (key_indices < 0))[0]
+            is_hit = self.sizes[candidates[open_queries]] == query_sizes[open_queries]
+            key_indices[open_queries[is_hit]] = candidates[open_queries[is_hit]]
+        return key_indices, upper > lower
+
+    def score(self, blockhash_report, weighting="bucket"):
+        """ accumulate per family scores for all blockhashes of a report, see BlockHashMatcher._scoreBlockhashes """
+        return self.scoreMany([blockhash_report], weighting=weighting)[0]
+
+    def scoreMany(self, blockhash_reports, weighting="bucket"):
+        """ score several reports together, resolving each distinct (hash, size) once and accumulating into per (report, family) bins """
+        report_arrays = [self._reportToArrays(blockhash_report) for blockhash_report in blockhash_reports]
+        num_reports = len(report_arrays)
+        query_reports = np.repeat(np.arange(num_reports), [len(arrays[0]) for arrays in report_arrays])
+        query_hashes = np.concatenate([arrays[0] for arrays in report_arrays])
+        query_sizes = np.concatenate([arrays[1] for arrays in report_arrays])
+        query_counts = np.concatenate([arrays[2] for arrays in report_arrays])
+        if num_reports == 1:
+            # the keys of a single report are distinct already
+            key_indices, is_hash_known = self.findKeys(query_hashes, query_sizes)
+        else:
+            # resolve each distinct (hash, size) only once, by sorting the queries and marking the first of each run of equal keys
+            order = np.lexsort((query_sizes, query_hashes))
+            sorted_hashes = query_hashes[order]
+            sorted_sizes = query_sizes[order]
+            is_distinct = np.ones(len(order), dtype=bool)
+            is_distinct[1:] = (sorted_hashes[1:] != sorted_hashes[:-1]) | (sorted_sizes[1:] != sorted_sizes[:-1])
+            inverse = np.empty(len(order), dtype=np.int64)
+            inverse[order] = np.cumsum(is_distinct) - 1
+            distinct_key_indices, distinct_is_hash_known = self.findKeys(sorted_hashes[is_distinct], sorted_sizes[is_distinct])
+            key_indices = distinct_key_indices[inverse]
+            is_hash_known = distinct_is_hash_known[inverse]
+        is_matched = key_indices >= 0
+        # the python engine accounts unmatched blocks once per function they occur in
+        unmatched_scores = np.bincount(query_reports[~is_matched], weights=(query_sizes * query_counts)[~is_matched], minlength=num_reports)
+        unmatched_blocks = np.bincount(query_reports[~is_hash_known], weights=query_counts[~is_hash_known], minlength=num_reports)
+        matched_reports = query_reports[is_matched]
+        matched_keys = key_indices[is_matched]
+        matched_sizes = query_sizes[is_matched]
+        matched_weights = query_counts[is_matched] if weighting == "occurrence" else np.ones(len(matched_keys), dtype=np.int64)
+        # expand the precomputed distinct families of the matched buckets, keeping report order and in-bucket order
+        starts = self.bucket_family_offsets[matched_keys]
+        lengths = self.bucket_family_offsets[matched_keys + 1] - starts
+        pair_buckets = np.repeat(np.arange(len(matched_keys)), lengths)
+        pair_indices = np.arange(int(lengths.sum())) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+        pair_families = self.bucket_families[pair_indices].astype(np.int64)
+        num_families = int(pair_families.max()) + 1 if len(pair_families) else 1
+        # one bin per (report, family), pairs are ordered by report, so each bin is accumulated in the same order as for a single report
+        pair_bins = matched_reports[pair_buckets] * num_families + pair_families
+        pair_keys = matched_keys[pair_buckets]
+        pair_weights = matched_weights[pair_buckets].astype(np.float64)
+        pair_sizes = (matched_sizes * matched_weights)[pair_buckets].astype(np.float64)
+        pair_is_nonlib = (self.bucket_flags[pair_keys] & FLAG_HAS_LIBRARY) == 0
+        pair_is_unique = pair_is_nonlib & ((self.bucket_flags[pair_keys] & FLAG_IS_UNIQUE) != 0)
+        pair_adjustments = self.bucket_adjustments[pair_keys].astype(np.float64)
+        num_bins = num_reports * num_families
+        # bincount accumulates sequentially in pair order, i.e. in the same order as the python engine
+        family_bytes = np.bincount(pair_bins, weights=pair_sizes, minlength=num_bins)
+        family_blocks = np.bincount(pair_bins, weights=pair_weights, minlength=num_bins)
+        non_library_bytes = np.bincount(pair_bins[pair_is_nonlib], weights=pair_sizes[pair_is_nonlib], minlength=num_bins)
+        non_library_blocks = np.bincount(pair_bins[pair_is_nonlib], weights=pair_weights[pair_is_nonlib], minlength=num_bins)
+        adj_family_bytes = np.bincount(pair_bins[pair_is_nonlib], weights=pair_sizes[pair_is_nonlib] / pair_adjustments[pair_is_nonlib], minlength=num_bins)
+        adj_family_blocks = np.bincount(pair_bins[pair_is_nonlib], weights=pair_weights[pair_is_nonlib] / pair_adjustments[pair_is_nonlib], minlength=num_bins)
+        unique_family_bytes = np.bincount(pair_bins[pair_is_unique], weights=pair_sizes[pair_is_unique], minlength=num_bins)
+        unique_family_blocks = np.bincount(pair_bins[pair_is_unique], weights=pair_weights[pair_is_unique], minlength=num_bins)
+        all_scores = []
+        for report_index in range(num_reports):
+            all_scores.append({
+                "family_bytes": {},
+                "family_blocks": {},
+                "non_library_bytes": {},
+                "non_library_blocks": {},
+                "adj_family_bytes": {},
+                "adj_family_blocks": {},
+                "unique_family_bytes": {},
+                "unique_family_blocks": {},
+                "unmatched_score": int(unmatched_scores[report_index]),
+                "unmatched_blocks": int(unmatched_blocks[report_index]),
+            })
+        # families in order of their first match per report, only where the python engine would have touched the respective score
+        matched_bins, first_matches = np.unique(pair_bins, return_index=True)
+        for pair_bin in matched_bins[np.argsort(first_matches)].tolist():
+            scores = all_scores[pair_bin // num_families]
+            family_id = pair_bin % num_families
+            scores["family_bytes"][family_id] = int(family_bytes[pair_bin])
+            scores["family_blocks"][family_id] = int(family_blocks[pair_bin])
+            if non_library_blocks[pair_bin]:
+                scores["non_library_bytes"][family_id] = int(non_library_bytes[pair_bin])
+                scores["non_library_blocks"][family_id] = int(non_library_blocks[pair_bin])
+                scores["adj_family_bytes"][family_id] = float(adj_family_bytes[pair_bin])
+                scores["adj_family_blocks"][family_id] = float(adj_family_blocks[pair_bin])
+            if unique_family_blocks[pair_bin]:
+                scores["unique_family_bytes"][family_id] = int(unique_family_bytes[pair_bin])
+                scores["unique_family_blocks"][family_id] = int(unique_family_blocks[pair_bin])
+        return all_scores
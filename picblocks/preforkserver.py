@@ -0,0 +1,249 @@
+import gc
+import os
+import sys
+import time
+import random
+import signal
+import socket
+import logging
+import threading
+import traceback
+
+# Only do basicConfig if no handlers have been configured
+if len(logging._handlerList) == 0:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
+
+DEFAULT_THREADS = 4
+DEFAULT_GRACEFUL_TIMEOUT = 120
+# seconds between checks of the parent for exited workers and their memory
+MONITOR_INTERVAL = 0.5
+DRAIN_INTERVAL = 0.05
+
+
+def getPrivateMemory(pid="self"):
+    """
+    return the bytes of memory private to a process or None if unknown, which excludes pages still shared with its parent,
+    e.g. those of a DB loaded before forking, but includes whatever the process leaked or copied since.
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as fin:
+            return sum(int(line.split()[1]) * 1024 for line in fin if line.startswith(("Private_Clean:", "Private_Dirty:")))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class _RequestTrackingIterable(object):
+    """ calls on_close once the server closes the response, i.e. after it was passed on completely """
+
+    def __init__(self, iterable, on_close):
+        self._iterable = iterable
+        self._on_close = on_close
+
+    def __iter__(self):
+        return iter(self._iterable)
+
+    def close(self):
+        try:
+            if hasattr(self._iterable, "close"):
+                self._iterable.close()
+        finally:
+            self._on_close()
+
+
+class PreforkServer(object):
+    """
+    Serves a WSGI app with waitress from num_workers forked processes, which accept connections on one listening socket bound
+    by the parent, so that requests are no longer confined to the GIL of a single process. Whatever the parent loaded before
+    (e.g. the DB) is shared with the workers via copy-on-write pages, for which we freeze the garbage collector before forking.
+    Each worker exits gracefully after max_requests requests (plus up to 10% jitter, so that they don't all exit at once),
+    or once its private memory exceeds max_memory_mb, e.g. due to leaks of SMDA on malformed binaries: it stops accepting
+    connections, finishes its pending requests (and whatever is_busy() reports) within graceful_timeout seconds and exits.
+    The parent replaces every exited worker, also those that crashed or were killed, and recycles all of them upon recycleWorkers()
+    or SIGHUP, e.g. to let them share a newly loaded DB. after_fork() is called in every new worker before it serves.
+    """
+
+    def __init__(self, app, host="127.0.0.1", port=9001, num_workers=None, threads=DEFAULT_THREADS, max_requests=None, max_memory_mb=None, graceful_timeout=DEFAULT_GRACEFUL_TIMEOUT, after_fork=None, is_busy=None):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.num_workers = num_workers if num_workers else os.cpu_count()
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_memory = max_memory_mb * 1024 * 1024 if max_memory_mb else None
+        self.graceful_timeout = graceful_timeout
+        self.after_fork = after_fork
+        self.is_busy = is_busy
+        self.socket = None
+        # pid to the time it was asked to exit, None for active workers
+        self.workers = {}
+        self._is_stopping = False
+        self._is_recycle_requested = False
+        # state within a worker
+        self._server = None
+        self._num_requests = 0
+        self._num_active_requests = 0
+        self._worker_lock = threading.Lock()
+        self._is_draining = False
+
+    def recycleWorkers(self):
+        """ replace all workers gracefully, safe to call from any thread of the parent """
+        self._is_recycle_requested = True
+
+    def _handleStop(self, signum, frame):
+        self._is_stopping = True
+
+    def _handleRecycle(self, signum, frame):
+        self._is_recycle_requested = True
+
+    def run(self):
+        """ bind the socket and keep num_workers workers serving until SIGTERM or SIGINT """
+        self.socket = socket.create_server((self.host, self.port), backlog=1024)
+        signal.signal(signal.SIGTERM, self._handleStop)
+        signal.signal(signal.SIGINT, self._handleStop)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self._handleRecycle)
+        LOG.info("Serving on http://%s:%d with %d workers", self.host, self.port, self.num_workers)
+        try:
+            while not self._is_stopping:
+                self._monitorWorkers()
+                time.sleep(MONITOR_INTERVAL)
+        finally:
+            self._stopWorkers()
+            self.socket.close()
+
+    def _getActiveWorkers(self):
+        return [pid for pid, retired in self.workers.items() if retired is None]
+
+    def _retireWorker(self, pid):
+        if self.workers.get(pid, 0) is None:
+            self.workers[pid] = time.time()
+            self._signalWorker(pid, signal.SIGTERM)
+
+    def _signalWorker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _monitorWorkers(self):
+        self._reapWorkers()
+        if self._is_recycle_requested:
+            self._is_recycle_requested = False
+            LOG.info("recycling all workers.")
+            for pid in self._getActiveWorkers():
+                self._retireWorker(pid)
+        # replacements are forked before retired workers finished, so that capacity is kept
+        while len(self._getActiveWorkers()) < self.num_workers:
+            self._spawnWorker()
+        now = time.time()
+        for pid, retired in list(self.workers.items()):
+            if retired is None:
+                if self.max_memory is not None:
+                    private_memory = getPrivateMemory(pid)
+                    if private_memory is not None and private_memory > self.max_memory:
+                        LOG.warning("worker %d exceeded its memory limit with %d MB, recycling it.", pid, private_memory // 2 ** 20)
+                        self._retireWorker(pid)
+            elif now - retired > self.graceful_timeout:
+                LOG.warning("worker %d did not exit within %ds, killing it.", pid, self.graceful_timeout)
+                self._signalWorker(pid, signal.SIGKILL)
+
+    def _reapWorkers(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid not in self.workers:
+                continue
+            retired = self.workers.pop(pid)
+            exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            if retired is None and exit_code != 0:
+                LOG.warning("worker %d died with exit code %d.", pid, exit_code)
+
+    def _stopWorkers(self):
+        for pid in self._getActiveWorkers():
+            self._retireWorker(pid)
+        deadline = time.time() + self.graceful_timeout
+        while self.workers and time.time() < deadline:
+            self._reapWorkers()
+            time.sleep(DRAIN_INTERVAL)
+        for pid in list(self.workers):
+            self._signalWorker(pid, signal.SIGKILL)
+        while self.workers:
+            pid, _ = os.waitpid(-1, 0)
+            self.workers.pop(pid, None)
+
+    def _spawnWorker(self):
+        # keep the garbage collector from touching (and thus copying) the pages shared with the workers
+        gc.freeze()
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                self._runWorker()
+            except BaseException:
+                LOG.error("worker %d failed:\n%s", os.getpid(), traceback.format_exc())
+                exit_code = 1
+            finally:
+                logging.shutdown()
+                os._exit(exit_code)
+        self.workers[pid] = None
+
+    def _runWorker(self):
+        # the parent coordinates shutdown and recycling, Ctrl+C or a hangup of the terminal also reach the workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: self._drain())
+        if self.max_requests:
+            self.max_requests += random.randint(0, self.max_requests // 10)
+        if self.after_fork is not None:
+            self.after_fork()
+        # waitress is only needed for serving, picblocks itself does not depend on it
+        from waitress.server import create_server
+        self._server = create_server(self._trackRequests, sockets=[self.socket], threads=self.threads)
+        self._server.run()
+
+    def _trackRequests(self, environ, start_response):
+        """ WSGI middleware counting requests, to drain the worker once max_requests are served """
+        with self._worker_lock:
+            self._num_active_requests += 1
+        try:
+            return _RequestTrackingIterable(self.app(environ, start_response), self._finishRequest)
+        except BaseException:
+            self._finishRequest()
+            raise
+
+    def _finishRequest(self):
+        with self._worker_lock:
+            self._num_active_requests -= 1
+            self._num_requests += 1
+            if self.max_requests and self._num_requests >= self.max_requests:
+                self._drain()
+
+    def _drain(self):
+        """ stop accepting connections and exit once all pending requests and jobs are done """
+        if self._is_draining or self._server is None:
+            return
+        self._is_draining = True
+        self._server.accepting = False
+        # wake up the loop, so that it stops polling the listening socket right away
+        self._server.pull_trigger()
+        threading.Thread(target=self._exitWhenDone, daemon=True).start()
+
+    def _isDone(self):
+        if self._num_active_requests > 0 or (self.is_busy is not None and self.is_busy()):
+            return False
+        return not any(channel.requests or channel.total_outbufs_len for channel in list(self._server.active_channels.values()))
+
+    def _exitWhenDone(self):
+        deadline = time.time() + self.graceful_timeout
+        while not self._isDone() and time.time() < deadline:
+            time.sleep(DRAIN_INTERVAL)
+        logging.shutdown()
+        sys.stdout.flush()
+        os._exit(0)
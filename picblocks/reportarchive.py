@@ -0,0 +1,260 @@
+import os
+import sys
+import json
+import struct
+import logging
+import argparse
+from collections import namedtuple
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .blockreport import BlockReportLocation, readBlockReport, readBinaryBlockReport, packBlockReport, writeJsonBlockReport, COMPRESSIONS, DEFAULT_COMPRESSION
+
+# Only do basicConfig if no handlers have been configured
+if len(logging._handlerList) == 0:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
+
+ARCHIVE_MAGIC = b"PICBLKAR"
+ARCHIVE_VERSION = 1
+ARCHIVE_HEADER_FORMAT = "<8sB7x"
+ARCHIVE_HEADER_SIZE = struct.calcsize(ARCHIVE_HEADER_FORMAT)
+# every entry is a binary block report, preceded by its length, which is only set once the report is written completely
+ENTRY_MAGIC = b"PBRE"
+ENTRY_HEADER_FORMAT = "<4sQ"
+ENTRY_HEADER_SIZE = struct.calcsize(ENTRY_HEADER_FORMAT)
+INDEX_SUFFIX = ".idx"
+LOCK_SUFFIX = ".lock"
+REPORT_FORMATS = ["json", "binary"]
+# offset and length of the binary block report within the archive
+ArchiveEntry = namedtuple("ArchiveEntry", ["offset", "length", "sha256", "family", "filename"])
+
+
+def isReportArchive(filepath):
+    with open(filepath, "rb") as fin:
+        return fin.read(len(ARCHIVE_MAGIC)) == ARCHIVE_MAGIC
+
+
+def getLooseReportPaths(block_reports_path):
+    return [os.path.join(block_reports_path, filename) for filename in sorted(os.listdir(block_reports_path)) if filename.endswith(".blocks")]
+
+
+class ReportArchive(object):
+    """
+    Single append-only file of binary block reports, next to an index of JSON lines (<archive>.idx) with offset, length, sha256,
+    family and filename of each report, which allows random access by sha256 and sequential scans without touching the filesystem per report.
+    Any number of processes may append, serialized by an exclusive lock on <archive>.lock. Reports are written before they are indexed,
+    so that an interrupted append leaves at most an incomplete tail, which is recovered or cut off by the next writer.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.index_path = filepath + INDEX_SUFFIX
+        self.lock_path = filepath + LOCK_SUFFIX
+        self.entries = []
+        self.sha256_to_entry = {}
+        self.family_to_entries = {}
+        self._index_position = 0
+        self._end = ARCHIVE_HEADER_SIZE
+        self.refresh()
+
+    def refresh(self):
+        """ read the index lines appended since the last refresh, e.g. by other processes """
+        self._is_index_complete = True
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as fin:
+                fin.seek(self._index_position)
+                for line in fin:
+                    # a crash may have left an incomplete last line, whose report is then recovered from the archive
+                    try:
+                        entry = ArchiveEntry(**json.loads(line))
+                    except (ValueError, TypeError):
+                        entry = None
+                    if entry is None or not line.endswith(b"\n"):
+                        self._is_index_complete = False
+                        break
+                    self._index_position += len(line)
+                    self._addEntry(entry)
+        # another writer may just have created the archive
+        if os.path.exists(self.filepath) and os.path.getsize(self.filepath) > 0:
+            if not isReportArchive(self.filepath):
+                raise ValueError(f"{self.filepath} is not a report archive.")
+            for entry in self._scanTail():
+                self._is_index_complete = False
+                self._addEntry(entry)
+
+    def _addEntry(self, entry):
+        # entries are in archive order, so those before the end are known already, e.g. recovered from the tail before they were indexed
+        if entry.offset < self._end:
+            return
+        self.entries.append(entry)
+        self.sha256_to_entry[entry.sha256] = entry
+        self.family_to_entries.setdefault(entry.family, []).append(entry)
+        self._end = max(self._end, entry.offset + entry.length)
+
+    def _scanTail(self):
+        """ return the complete entries behind the last indexed one """
+        entries = []
+        archive_size = os.path.getsize(self.filepath)
+        header_offset = self._end
+        with open(self.filepath, "rb") as fin:
+            while header_offset + ENTRY_HEADER_SIZE <= archive_size:
+                fin.seek(header_offset)
+                magic, length = struct.unpack(ENTRY_HEADER_FORMAT, fin.read(ENTRY_HEADER_SIZE))
+                offset = header_offset + ENTRY_HEADER_SIZE
+                if magic != ENTRY_MAGIC or length == 0 or offset + length > archive_size:
+                    break
+                blockhash_report = readBinaryBlockReport(self.filepath, offset=offset, length=length)
+                entries.append(ArchiveEntry(offset, length, blockhash_report["sha256"], blockhash_report["family"], blockhash_report["filename"]))
+                header_offset = offset + length
+        return entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, sha256):
+        return sha256 in self.sha256_to_entry
+
+    def getEntries(self, family=None):
+        return list(self.entries) if family is None else list(self.family_to_entries.get(family, []))
+
+    def getLocation(self, entry):
+        return BlockReportLocation(self.filepath, entry.offset, entry.length)
+
+    def getReportLocations(self, family=None):
+        """ return the locations of all reports (of a family) in archive order, which readBlockReport() and DbBuilder accept like paths """
+        return [self.getLocation(entry) for entry in self.getEntries(family=family)]
+
+    def readReport(self, sha256):
+        """ random access to a single report, whose blockhashes are streamed from the archive """
+        if sha256 not in self.sha256_to_entry:
+            raise KeyError(sha256)
+        return readBlockReport(self.getLocation(self.sha256_to_entry[sha256]))
+
+    def iterateReports(self, family=None):
+        """ sequentially scan all reports (of a family) in archive order """
+        for location in self.getReportLocations(family=family):
+            yield readBlockReport(location)
+
+    def _rewriteIndex(self):
+        with open(self.index_path + ".tmp", "w") as fout:
+            for entry in self.entries:
+                fout.write(json.dumps(entry._asdict()) + "\n")
+        os.replace(self.index_path + ".tmp", self.index_path)
+        self._index_position = os.path.getsize(self.index_path)
+        self._is_index_complete = True
+
+    @contextmanager
+    def _lockWriter(self):
+        with open(self.lock_path, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def append(self, blockhash_report, compression=DEFAULT_COMPRESSION):
+        """ append a single report unless its sha256 is already archived, return True if it was appended """
+        return self.appendReports([blockhash_report], compression=compression) == 1
+
+    def appendReports(self, blockhash_reports, compression=DEFAULT_COMPRESSION):
+        """ append reports (which may be a lazy iterable) holding the writer lock, skipping those already archived, return how many were appended """
+        num_appended = 0
+        with self._lockWriter():
+            self.refresh()
+            # index reports recovered from the tail of an interrupted append
+            if not self._is_index_complete:
+                self._rewriteIndex()
+            descriptor = os.open(self.filepath, os.O_RDWR | os.O_CREAT, 0o666)
+            with os.fdopen(descriptor, "r+b") as fout, open(self.index_path, "ab") as index_out:
+                if os.path.getsize(self.filepath) < ARCHIVE_HEADER_SIZE:
+                    fout.write(struct.pack(ARCHIVE_HEADER_FORMAT, ARCHIVE_MAGIC, ARCHIVE_VERSION))
+                # cut off whatever incomplete entry follows the last complete one
+                fout.truncate(self._end)
+                for blockhash_report in blockhash_reports:
+                    if blockhash_report["sha256"] in self.sha256_to_entry:
+                        continue
+                    header_offset = self._end
+                    fout.seek(header_offset)
+                    fout.write(struct.pack(ENTRY_HEADER_FORMAT, ENTRY_MAGIC, 0))
+                    offset = fout.tell()
+                    packBlockReport(blockhash_report, fout, compression=compression)
+                    length = fout.tell() - offset
+                    fout.seek(header_offset)
+                    fout.write(struct.pack(ENTRY_HEADER_FORMAT, ENTRY_MAGIC, length))
+                    fout.flush()
+                    os.fsync(fout.fileno())
+                    entry = ArchiveEntry(offset, length, blockhash_report["sha256"], blockhash_report["family"], blockhash_report["filename"])
+                    encoded_entry = (json.dumps(entry._asdict()) + "\n").encode("utf-8")
+                    index_out.write(encoded_entry)
+                    index_out.flush()
+                    self._index_position += len(encoded_entry)
+                    self._addEntry(entry)
+                    num_appended += 1
+        return num_appended
+
+    def importDirectory(self, block_reports_path, compression=DEFAULT_COMPRESSION):
+        """ append all loose block reports (*.blocks) of a directory, return how many were appended """
+        return self.appendReports((readBlockReport(report_path) for report_path in getLooseReportPaths(block_reports_path)), compression=compression)
+
+    def exportDirectory(self, output_path, report_format="json", family=None):
+        """
+        write all reports (of a family) as loose block reports named after their filename, return how many were written.
+        Samples often share a filename (e.g. across families), those exported after the first one are named after their sha256 instead.
+        """
+        os.makedirs(output_path, exist_ok=True)
+        output_filenames = set()
+        with open(self.filepath, "rb") as fin:
+            for entry in self.getEntries(family=family):
+                output_filename = os.path.basename(entry.filename or "") + ".blocks"
+                if output_filename == ".blocks" or output_filename in output_filenames:
+                    output_filename = entry.sha256 + ".blocks"
+                output_filenames.add(output_filename)
+                output_filepath = os.path.join(output_path, output_filename)
+                if report_format == "binary":
+                    fin.seek(entry.offset)
+                    with open(output_filepath + ".tmp", "wb") as fout:
+                        fout.write(fin.read(entry.length))
+                else:
+                    writeJsonBlockReport(readBlockReport(self.getLocation(entry)), output_filepath + ".tmp")
+                os.replace(output_filepath + ".tmp", output_filepath)
+        return len(output_filenames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bundle block reports into a single append-only archive, or export them again.")
+    parser.add_argument("archive_path", help="path of the report archive, which is created upon the first import.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="append the block reports of directories, skipping samples already archived.")
+    import_parser.add_argument("block_reports_paths", nargs="+", help="directories containing block reports (*.blocks).")
+    import_parser.add_argument("-c", "--compression", choices=COMPRESSIONS, default=DEFAULT_COMPRESSION, help=f"compression of the archived reports (default: {DEFAULT_COMPRESSION}).")
+    export_parser = subparsers.add_parser("export", help="write the archived reports into a directory of block reports.")
+    export_parser.add_argument("output_path", help="directory to write the block reports to.")
+    export_parser.add_argument("--format", choices=REPORT_FORMATS, default="json", help="format of the exported block reports (default: json).")
+    export_parser.add_argument("-f", "--family", default=None, help="only export reports of this family.")
+    list_parser = subparsers.add_parser("list", help="print sha256, family and filename of the archived reports.")
+    list_parser.add_argument("-f", "--family", default=None, help="only list reports of this family.")
+    args = parser.parse_args()
+    archive = ReportArchive(args.archive_path)
+    if args.command == "import":
+        for block_reports_path in args.block_reports_paths:
+            num_appended = archive.importDirectory(block_reports_path, compression=args.compression)
+            LOG.info("appended %d reports from %s", num_appended, block_reports_path)
+        print(f"{args.archive_path} holds {len(archive)} reports in {os.path.getsize(args.archive_path)} bytes")
+    elif args.command == "export":
+        num_exported = archive.exportDirectory(args.output_path, report_format=args.format, family=args.family)
+        print(f"exported {num_exported} reports to {args.output_path}")
+    elif args.command == "list":
+        for entry in archive.getEntries(family=args.family):
+            print(f"{entry.sha256}\t{entry.family}\t{entry.filename}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
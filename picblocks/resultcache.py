@@ -0,0 +1,105 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+# Only do basicConfig if no handlers have been configured
+if len(logging._handlerList) == 0:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class ResultCache(object):
+    """
+    Thread-safe LRU cache for JSON-serializable results, e.g. blockhash or match reports.
+    Results are kept serialized, which makes the size-based eviction exact and ensures that callers always get a private copy.
+    With a store_path, results are also written to disk, so that they survive restarts; the store itself is not bounded.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, store_path=None):
+        self.max_bytes = max_bytes
+        self.store_path = store_path
+        if store_path is not None:
+            os.makedirs(store_path, exist_ok=True)
+        self.num_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _getKeyDigest(key):
+        """ keys are tuples of JSON-serializable values """
+        return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+    def _getStoreFilepath(self, key_digest):
+        return os.path.join(self.store_path, key_digest[:2], key_digest + ".json")
+
+    def _insert(self, key_digest, serialized):
+        if key_digest in self._entries:
+            self.num_bytes -= len(self._entries.pop(key_digest))
+        if len(serialized) > self.max_bytes:
+            return
+        self._entries[key_digest] = serialized
+        self.num_bytes += len(serialized)
+        while self.num_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.num_bytes -= len(evicted)
+
+    def get(self, key):
+        """ return a copy of the result cached for key or None """
+        key_digest = self._getKeyDigest(key)
+        with self._lock:
+            serialized = self._entries.get(key_digest, None)
+            if serialized is not None:
+                self._entries.move_to_end(key_digest)
+                self.hits += 1
+                return json.loads(serialized)
+        if self.store_path is not None and os.path.isfile(self._getStoreFilepath(key_digest)):
+            with open(self._getStoreFilepath(key_digest), "rb") as fin:
+                serialized = fin.read()
+            with self._lock:
+                self._insert(key_digest, serialized)
+                self.disk_hits += 1
+            return json.loads(serialized)
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, result):
+        key_digest = self._getKeyDigest(key)
+        serialized = json.dumps(result).encode("utf-8")
+        with self._lock:
+            self._insert(key_digest, serialized)
+        if self.store_path is not None:
+            store_filepath = self._getStoreFilepath(key_digest)
+            os.makedirs(os.path.dirname(store_filepath), exist_ok=True)
+            # write atomically, as other processes may read the store concurrently
+            temp_filepath = f"{store_filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_filepath, "wb") as fout:
+                fout.write(serialized)
+            os.replace(temp_filepath, store_filepath)
+
+    def getStats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0,
+                "size": len(self._entries),
+                "num_bytes": self.num_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self.num_bytes = 0
@@ -0,0 +1,128 @@
+import heapq
+import bisect
+import logging
+from fractions import Fraction
+
+from .minhash import MinHashIndex
+
+try:
+    # numpy is optional and only speeds up indexing the samples of the DB
+    import numpy as np
+except ImportError:
+    np = None
+
+# Only do basicConfig if no handlers have been configured
+if len(logging._handlerList) == 0:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
+
+# rank samples by the bytes of blocks they share with the input, or by their weighted Jaccard similarity with it
+RANKINGS = ["bytes", "jaccard"]
+DEFAULT_TOP_K = 10
+# number of buckets traversed between checks whether the top-k can still change
+CHECK_INTERVAL = 32
+# candidates are probed by binary search in posting lists at least this many times longer than the number of candidates
+BISECT_RATIO = 16
+
+
+class SampleMatcher(object):
+    """
+    Ranks the samples of a CompactDb by their overlap with the blocks of a report, using its entry columns as inverted index.
+    A block counts once per (hash, size) key, weighted by its size, so overlaps are normalized by the bytes of distinct keys
+    of the input and of each sample (sample_bytes), which are indexed once.
+    Buckets are traversed from the shortest to the longest posting list. Once even the remaining bytes could not lift an unseen
+    sample into the top-k, only the current candidates are followed and pruned, so that the long posting lists of common
+    library blocks are only probed by binary search: entries of a bucket are ordered by sample ID, as samples are only appended.
+    """
+
+    def __init__(self, compact_db):
+        self.compact_db = compact_db
+        self.sample_bytes, self.sample_family_ids = self._indexSamples()
+        self._minhash_index = None
+
+    def getMinHashIndex(self):
+        """ the LSH index over the MinHash signatures of all samples, built upon first use """
+        if self._minhash_index is None:
+            self._minhash_index = MinHashIndex.fromCompactDb(self.compact_db)
+            LOG.info("indexed MinHash signatures of %d samples.", len(self._minhash_index.signatures))
+        return self._minhash_index
+
+    def _indexSamples(self):
+        """ return the bytes of distinct keys and the family ID of each sample """
+        compact_db = self.compact_db
+        if np is not None and len(compact_db.sample_ids):
+            offsets = np.asarray(compact_db.offsets).astype(np.int64)
+            sample_ids = np.asarray(compact_db.sample_ids).astype(np.int64)
+            key_indices = np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+            # count each sample once per key, even if it has several functions with the block
+            is_first = np.ones(len(sample_ids), dtype=bool)
+            is_first[1:] = (key_indices[1:] != key_indices[:-1]) | (sample_ids[1:] != sample_ids[:-1])
+            per_sample = np.bincount(sample_ids[is_first], weights=np.asarray(compact_db.sizes)[key_indices[is_first]])
+            family_ids = np.zeros(len(per_sample), dtype=np.int64)
+            family_ids[sample_ids] = np.asarray(compact_db.family_ids)
+            known_sample_ids = np.unique(sample_ids).tolist()
+            return {sample_id: int(per_sample[sample_id]) for sample_id in known_sample_ids}, {sample_id: int(family_ids[sample_id]) for sample_id in known_sample_ids}
+        sample_bytes = {}
+        sample_family_ids = {}
+        for key_index in range(len(compact_db.sizes)):
+            size = compact_db.sizes[key_index]
+            previous = None
+            for entry_index in range(compact_db.offsets[key_index], compact_db.offsets[key_index + 1]):
+                sample_id = compact_db.sample_ids[entry_index]
+                if sample_id != previous:
+                    sample_bytes[sample_id] = sample_bytes.get(sample_id, 0) + size
+                    sample_family_ids[sample_id] = compact_db.family_ids[entry_index]
+                    previous = sample_id
+        return sample_bytes, sample_family_ids
+
+    def _score(self, ranking, input_bytes, sample_id, matched_bytes):
+        if ranking == "bytes":
+            return matched_bytes
+        # exact fractions, so that bounds never prune a sample that ties with the k-th one
+        return Fraction(matched_bytes, input_bytes + self.sample_bytes[sample_id] - matched_bytes)
+
+    def rank(self, keys, top_k=DEFAULT_TOP_K, ranking="bytes", candidate_ids=None):
+        """
+        return the top_k samples for the distinct (hash, size) keys of a report as (sample_id, matched_bytes), best first, ties by sample ID.
+        With candidate_ids, e.g. from the MinHashIndex, only these samples are scored.
+        """
+        if ranking not in RANKINGS:
+            raise ValueError(f"Unknown ranking: {ranking}")
+        input_bytes = sum(int_size for _, int_size in keys)
+        postings = []
+        for int_hash, int_size in keys:
+            key_index = self.compact_db.findKey(int_hash, int_size)
+            if key_index >= 0:
+                start = self.compact_db.offsets[key_index]
+                end = self.compact_db.offsets[key_index + 1]
+                postings.append((end - start, int_size, start, end))
+        # the sort is stable, so equally long posting lists keep report order
+        postings.sort(key=lambda posting: posting[0])
+        remaining_bytes = sum(posting[1] for posting in postings)
+        matched = {} if candidate_ids is None else dict.fromkeys(candidate_ids, 0)
+        is_accepting = candidate_ids is None
+        for index, (_, int_size, start, end) in enumerate(postings):
+            if index % CHECK_INTERVAL == 0 and len(matched) >= top_k > 0:
+                # current scores are lower bounds, as matched bytes only grow
+                kth_score = heapq.nlargest(top_k, (self._score(ranking, input_bytes, sample_id, matched_bytes) for sample_id, matched_bytes in matched.items()))[-1]
+                # an unseen sample can at most match all remaining bytes, which for jaccard is at most remaining_bytes / input_bytes
+                if is_accepting and (remaining_bytes if ranking == "bytes" else Fraction(remaining_bytes, input_bytes)) < kth_score:
+                    is_accepting = False
+                if not is_accepting:
+                    matched = {sample_id: matched_bytes for sample_id, matched_bytes in matched.items() if self._score(ranking, input_bytes, sample_id, min(matched_bytes + remaining_bytes, self.sample_bytes[sample_id])) >= kth_score}
+            sample_ids = self.compact_db.sample_ids[start:end]
+            if is_accepting:
+                for sample_id in set(sample_ids):
+                    matched[sample_id] = matched.get(sample_id, 0) + int_size
+            elif len(matched) * BISECT_RATIO < len(sample_ids):
+                for sample_id in matched:
+                    position = bisect.bisect_left(sample_ids, sample_id)
+                    if position < len(sample_ids) and sample_ids[position] == sample_id:
+                        matched[sample_id] += int_size
+            else:
+                for sample_id in matched.keys() & set(sample_ids):
+                    matched[sample_id] += int_size
+            remaining_bytes -= int_size
+        ranked = sorted((item for item in matched.items() if item[1] > 0), key=lambda item: (-self._score(ranking, input_bytes, item[0], item[1]), item[0]))
+        return ranked[:top_k]
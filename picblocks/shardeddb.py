@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import logging
+import argparse
+import threading
+import urllib.request
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+from .aggregates import BucketAggregate
+from .compactdb import CompactDb
+from .blockhasher import DEFAULT_HASH_SIZE
+from .dbbuilder import getShardIndex, getShardFilename
+
+# Only do basicConfig if no handlers have been configured
+if len(logging._handlerList) == 0:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
+
+DEFAULT_PORT = 9100
+
+
+def _encodeLookup(is_hash_known, aggregate):
+    """ lookups are exchanged with shard workers and servers as JSON-compatible lists """
+    if aggregate is None:
+        return [is_hash_known]
+    return [is_hash_known, list(aggregate.families), aggregate.has_library, aggregate.adjustment_value, aggregate.is_unique]
+
+
+def _decodeLookup(encoded):
+    if len(encoded) == 1:
+        return encoded[0], None
+    return encoded[0], BucketAggregate(tuple(encoded[1]), encoded[2], encoded[3], encoded[4])
+
+
+def _getShardMetadata(compact_db):
+    return {key: value for key, value in compact_db.metadata.items() if key != "sections"}
+
+
+class LocalShard(object):
+    """ a shard memory-mapped into this process """
+
+    def __init__(self, shard_filepath):
+        self.compact_db = CompactDb.open(shard_filepath)
+        self.metadata = _getShardMetadata(self.compact_db)
+
+    def lookupAggregates(self, keys):
+        return [self.compact_db.lookupAggregate(blockhash, size) for blockhash, size in keys]
+
+    def close(self):
+        self.compact_db.close()
+
+
+def _shardWorkerLoop(connection, shard_filepath):
+    """ serve lookups for a single shard until None is sent """
+    compact_db = CompactDb.open(shard_filepath)
+    connection.send(_getShardMetadata(compact_db))
+    while True:
+        keys = connection.recv()
+        if keys is None:
+            break
+        connection.send([_encodeLookup(*compact_db.lookupAggregate(blockhash, size)) for blockhash, size in keys])
+    compact_db.close()
+
+
+class ProcessShard(object):
+    """ a shard owned by a separate worker process """
+
+    def __init__(self, shard_filepath):
+        self.connection, worker_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_shardWorkerLoop, args=(worker_connection, shard_filepath), daemon=True)
+        self.process.start()
+        self.metadata = self.connection.recv()
+        # requests and replies on the pipe must not interleave between threads
+        self._lock = threading.Lock()
+
+    def lookupAggregates(self, keys):
+        with self._lock:
+            self.connection.send(keys)
+            return [_decodeLookup(encoded) for encoded in self.connection.recv()]
+
+    def close(self):
+        try:
+            self.connection.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+
+
+class RemoteShard(object):
+    """ a shard served by a ShardServer, e.g. on another node """
+
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        with urllib.request.urlopen(self.url + "/metadata", timeout=timeout) as response:
+            self.metadata = json.loads(response.read())
+
+    def lookupAggregates(self, keys):
+        request = urllib.request.Request(self.url + "/lookup", data=json.dumps({"keys": keys}).encode("utf-8"), headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return [_decodeLookup(encoded) for encoded in json.loads(response.read())["lookups"]]
+
+    def close(self):
+        pass
+
+
+class ShardedDb(object):
+    """
+    Coordinator for a DB split into 2 ** shard_bits shards by the top bits of the blockhash, as written by DbBuilder.buildShards().
+    Lookups are grouped by owning shard, sent to all shards concurrently and returned in the order of the requested keys,
+    so that BlockHashMatcher accumulates scores exactly as with a single DB.
+    """
+
+    def __init__(self, shards):
+        if not shards:
+            raise ValueError("A sharded DB needs at least one shard.")
+        self.shards = sorted(shards, key=lambda shard: shard.metadata["shard_index"])
+        self.shard_bits = self.shards[0].metadata["shard_bits"]
+        self.hash_bits = 8 * self.shards[0].metadata.get("hash_size", DEFAULT_HASH_SIZE)
+        if [shard.metadata["shard_index"] for shard in self.shards] != list(range(2 ** self.shard_bits)):
+            raise ValueError(f"Incomplete sharded DB, expected {2 ** self.shard_bits} shards.")
+        if len(set(shard.metadata["base_id"] for shard in self.shards)) != 1:
+            raise ValueError("Shards do not belong to the same DB.")
+        self.metadata = {key: value for key, value in self.shards[0].metadata.items() if key not in ["shard_index", "num_hashes", "num_keys", "num_entries"]}
+        self.num_hashes = sum(shard.metadata["num_hashes"] for shard in self.shards)
+        self._executor = ThreadPoolExecutor(max_workers=len(self.shards)) if any(not isinstance(shard, LocalShard) for shard in self.shards) else None
+
+    @staticmethod
+    def isShardedDb(path):
+        return os.path.isdir(path) and os.path.isfile(os.path.join(path, getShardFilename(0)))
+
+    @classmethod
+    def open(cls, shards_path, use_processes=False):
+        """ open all shards in shards_path, either memory-mapped into this process or each in a separate worker process """
+        shard_filenames = sorted(filename for filename in os.listdir(shards_path) if filename.startswith("shard-") and filename.endswith(".pbdb"))
+        shard_class = ProcessShard if use_processes else LocalShard
+        return cls([shard_class(os.path.join(shards_path, filename)) for filename in shard_filenames])
+
+    @classmethod
+    def connect(cls, shard_urls):
+        """ use shards served by ShardServers at the given URLs """
+        return cls([RemoteShard(shard_url) for shard_url in shard_urls])
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def lookupAggregates(self, keys):
+        """ return a tuple (is_hash_known, BucketAggregate or None) for each (hash, size) in keys """
+        keys_per_shard = [[] for _ in self.shards]
+        positions_per_shard = [[] for _ in self.shards]
+        for position, (blockhash, size) in enumerate(keys):
+            shard_index = getShardIndex(blockhash, self.shard_bits, hash_bits=self.hash_bits)
+            keys_per_shard[shard_index].append((blockhash, size))
+            positions_per_shard[shard_index].append(position)
+        if self._executor is None:
+            shard_lookups = [shard.lookupAggregates(shard_keys) if shard_keys else [] for shard, shard_keys in zip(self.shards, keys_per_shard)]
+        else:
+            futures = [self._executor.submit(shard.lookupAggregates, shard_keys) if shard_keys else None for shard, shard_keys in zip(self.shards, keys_per_shard)]
+            shard_lookups = [future.result() if future is not None else [] for future in futures]
+        lookups = [None] * len(keys)
+        for positions, results in zip(positions_per_shard, shard_lookups):
+            for position, result in zip(positions, results):
+                lookups[position] = result
+        return lookups
+
+    def lookupAggregate(self, blockhash, size):
+        return self.lookupAggregates([(blockhash, size)])[0]
+
+    def __len__(self):
+        return self.num_hashes
+
+    def items(self):
+        """ only available when all shards are mapped into this process """
+        for shard in self.shards:
+            if not isinstance(shard, LocalShard):
+                raise ValueError("Iterating a sharded DB requires its shards to be opened locally.")
+            yield from shard.compact_db.items()
+
+
+class _ShardRequestHandler(BaseHTTPRequestHandler):
+
+    def _sendJson(self, data):
+        encoded = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def do_GET(self):
+        if self.path == "/metadata":
+            self._sendJson(self.server.metadata)
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if self.path != "/lookup":
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        compact_db = self.server.compact_db
+        self._sendJson({"lookups": [_encodeLookup(*compact_db.lookupAggregate(blockhash, size)) for blockhash, size in request["keys"]]})
+
+    def log_message(self, format, *args):
+        LOG.debug("%s - %s", self.address_string(), format % args)
+
+
+class ShardServer(ThreadingHTTPServer):
+    """ minimal HTTP server answering lookups for a single shard, to be used with ShardedDb.connect() """
+
+    def __init__(self, shard_filepath, host="127.0.0.1", port=DEFAULT_PORT):
+        self.compact_db = CompactDb.open(shard_filepath)
+        self.metadata = _getShardMetadata(self.compact_db)
+        super().__init__((host, port), _ShardRequestHandler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a single shard of a sharded DB (see picblocks.dbbuilder --shards-only) via HTTP.")
+    parser.add_argument("shard_path", help="compact DB file of the shard.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1).")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"port to listen on (default: {DEFAULT_PORT}).")
+    args = parser.parse_args()
+    server = ShardServer(args.shard_path, host=args.host, port=args.port)
+    LOG.info("serving shard %d of %d at http://%s:%d", server.metadata["shard_index"], 2 ** server.metadata["shard_bits"], args.host, args.port)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -23,6 +23,20 @@ setup(
         ('', ['LICENSE']),
     ],
     install_requires=requirements,
+    # required by the numpy matching engine and the function index, also speeds up MinHash sample matching
+    extras_require={"numpy": ["numpy"]},
+    entry_points={
+        "console_scripts": [
+            "picblocks-hash=picblocks.batchhasher:main",
+            "picblocks-convert=picblocks.blockreport:main",
+            "picblocks-archive=picblocks.reportarchive:main",
+            "picblocks-delta=picblocks.incrementaldb:main",
+            "picblocks-build=picblocks.dbbuilder:main",
+            "picblocks-shard=picblocks.shardeddb:main",
+            "picblocks-evaluate=picblocks.evaluation:main",
+            "picblocks-migrate=picblocks.migration:main",
+        ],
+    },
     classifiers=[
         "Development Status :: 4 - Beta",
         "License :: OSI Approved :: BSD License",
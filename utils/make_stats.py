@@ -1,26 +1,24 @@
 # Simple script to generate statistics against a given database.
-# Very alpha stage, use at your own risk
-# v:0.1 alpha
+# The evaluation itself is done leave-one-out by picblocks.evaluation, this script only publishes its results for the stats web UI.
+# v:0.2 alpha
 
 import os
 import time
+import json
 import logging
-from picblocks.blockhasher import BlockHasher
 from picblocks.blockhashmatcher import BlockHashMatcher
-
-#TODO: Refactoring needed ! Importing from external and unique source
-import json
+from picblocks.evaluation import LeaveOneOutEvaluator
 
 try:
     from pymongo import MongoClient
     c       = MongoClient("mongodb://localhost:27017")
     db      = c['malpedia']
-    m_s     = db['matching_db_against_itself']
     s_s     = db['statistics']
 except:
     db = None
 
 bl = 'block-reports/'
+th = 70
 LOG_LEVEL = logging.INFO
 LOG_FORMAT = "%(asctime)-15s: %(name)-32s - %(message)s"
 logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
@@ -32,55 +30,19 @@ if os.path.exists("db/picblocksdb.json"):
     matcher.loadDb("db/picblocksdb.json")
 logging.info("Done! (%5.2fs)", (time.time() - start))
 
-# Tracing verified family DB composition
-family_verified_frequency = {}
-# Tracing verified families VS detected (recognized, calculated) families
-family_verified_vs_detected = {}
-
-def make_stats(matching_report):
-    th = 70
-
-    # checking if verified family is in the fammily frequency study
-    verified_family =  matching_report['original_family']
-
-    # keep trace of verified families
-    if verified_family in family_verified_frequency:
-            family_verified_frequency[verified_family] += 1
-    else:
-            family_verified_frequency[verified_family] = 1
-
-    if verified_family not in family_verified_vs_detected :
-        family_verified_vs_detected[verified_family] = {}
-
-    for family in matching_report['family_matches']:
-        if float(family['nonlib_perc']) < float(th):
-            continue
-
-        if verified_family not in family_verified_vs_detected:
-            family_verified_vs_detected[verified_family] = {}
-
-        if family['family'] in family_verified_vs_detected[verified_family]:
-            family_verified_vs_detected[verified_family][family['family']] += 1
-        else:
-            family_verified_vs_detected[verified_family][family['family']] = 1
-        logging.info("Adding to verified family %s, similarity to family %s (%0.3f)" % (verified_family, family['family'], family['nonlib_perc']))
-    return family_verified_vs_detected
-
-
-logging.info("Matching Existing Reports to entire DB")
+report_paths = []
 for root, subdir, files in sorted(os.walk(bl)):
     for filename in sorted(files):
-        logging.info("Working on %s" % filename)
-        f, e = os.path.splitext(filename)
-        if e == ".blocks":
-            with open(os.path.join(root, filename)) as fin:
-                bh_report = json.load(fin)
-                matching_report = matcher.match(bh_report)
-                matching_report['original_family'] = bh_report['family']
-                m_s.insert_one(matching_report)
-                logging.info("Matching report saved on DB !")
-                make_stats(matching_report)
-
-
-s_s.insert_one({'family_verified_frequency': family_verified_frequency, 'family_verified_vs_detected':family_verified_vs_detected})
-
+        if os.path.splitext(filename)[1] == ".blocks":
+            report_paths.append(os.path.join(root, filename))
+
+logging.info("Matching Existing Reports to entire DB, leaving out each report's own sample")
+evaluation = LeaveOneOutEvaluator(matcher, thresholds=[th]).evaluate(report_paths)
+with open("evaluation.json", "w") as fout:
+    json.dump(evaluation, fout, indent=1)
+logging.info("Evaluation saved to evaluation.json")
+
+if db is not None:
+    stats = evaluation["thresholds"][f"{th:g}"]
+    s_s.insert_one({'family_verified_frequency': stats["family_verified_frequency"], 'family_verified_vs_detected': stats["family_verified_vs_detected"]})
+    logging.info("Statistics saved on DB !")